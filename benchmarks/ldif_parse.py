@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+'''
+Benchmark the LDIF parser against the original regex-based implementation.
+
+Generates a synthetic slapcat-style export (including folded lines and
+base64-encoded values) and reports how many lines per second each parser can
+read. Usage: python benchmarks/ldif_parse.py [number of entries]
+'''
+
+import re
+import sys
+import time
+import base64
+from io import StringIO
+
+import ldap3
+from ezldap.ldif import _parse_ldif
+
+
+def legacy_parse(content):
+    '''
+    The ldif_read() parsing loop from ezldap 0.6.4, for comparison.
+    '''
+    operations = {
+        'add': ldap3.MODIFY_ADD,
+        'replace': ldap3.MODIFY_REPLACE,
+        'delete': ldap3.MODIFY_DELETE
+    }
+
+    entries = []
+    entry = {}
+    changetype = 'add'
+    next_change_attr = None
+    next_change_type = 'add'
+    for line in content:
+        if line[0] == '#':
+            continue
+        if line[0] == '-':
+            if next_change_type == 'delete' and len(entry[next_change_attr]) == 0:
+                entry[next_change_attr].append((ldap3.MODIFY_DELETE, []))
+
+            continue
+        elif re.match(r'dn:', line):
+            if 'dn' in entry.keys():
+                entries.append(entry)
+                changetype = 'add'
+
+            entry = {}
+
+        match = re.findall(r'(\w+):\s*(.+)', line)
+        if len(match) > 0:
+            key = match[0][0]
+            value = match[0][1].strip()
+
+            if key == 'changetype':
+                changetype = value
+                continue
+            elif key not in entry.keys() and key not in operations.keys():
+                entry[key] = []
+
+            if changetype == 'modify':
+                if key in operations.keys():
+                    next_change_type, next_change_attr = key, value
+                    if value not in entry.keys():
+                        entry[value] = []
+
+                    continue
+                elif key == next_change_attr:
+                    value = (operations[next_change_type], [value])
+                else:
+                    raise ValueError('Attribute does not match attribute to {}.'.format(next_change_type))
+
+            entry[key].append(value)
+
+    if 'dn' in entry.keys():
+        entries.append(entry)
+
+    return entries
+
+
+def generate_export(n_entries):
+    '''
+    Generate an LDIF export of n_entries users.
+    '''
+    photo = base64.b64encode(bytes(range(256)) * 4).decode()
+    folded_photo = '\n '.join(photo[i:i + 76] for i in range(0, len(photo), 76))
+    out = StringIO()
+    for i in range(n_entries):
+        out.write('# entry {}\n'.format(i))
+        out.write('dn: uid=user{0},ou=People,dc=ezldap,dc=io\n'
+            'objectClass: top\n'
+            'objectClass: posixAccount\n'
+            'objectClass: inetOrgPerson\n'
+            'uid: user{0}\n'
+            'cn: User Number {0}\n'
+            'sn: Number\n'
+            'mail: user{0}@ezldap.io\n'
+            'uidNumber: {1}\n'
+            'gidNumber: {1}\n'
+            'homeDirectory: /home/user{0}\n'
+            'loginShell: /bin/bash\n'
+            'description:: w6lsw6hlIGRlIGwnw6ljb2xl\n'.format(i, 10000 + i))
+        if i % 10 == 0:
+            out.write('jpegPhoto:: {}\n'.format(folded_photo))
+
+        out.write('\n')
+
+    return out.getvalue()
+
+
+def bench(name, parse, lines):
+    start = time.perf_counter()
+    entries = parse(iter(lines))
+    elapsed = time.perf_counter() - start
+    print('{:<8} {:>8} entries {:>12,.0f} lines/sec'.format(name, len(entries),
+        len(lines) / elapsed))
+
+
+def main():
+    n_entries = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    lines = generate_export(n_entries).splitlines(keepends=True)
+    print('Parsing {:,} lines ({:,} entries)'.format(len(lines), n_entries))
+    bench('legacy', legacy_parse, lines)
+    bench('ezldap', lambda lines: list(_parse_ldif(lines)), lines)
+
+
+if __name__ == '__main__':
+    main()
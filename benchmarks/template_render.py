@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+'''
+Benchmark rendering LDIF templates with ldif_read() against the original
+read-substitute-parse implementation.
+
+Renders the add_user.ldif template once per row (as "ezldap bulk_add_users"
+does) and reports how many rows per second each implementation can render.
+Usage: python benchmarks/template_render.py [number of rows]
+'''
+
+import re
+import sys
+import time
+from io import StringIO
+from string import Template
+
+import ldap3
+from ezldap.ldif import ldif_read
+
+TEMPLATE = 'ezldap/templates/add_user.ldif'
+
+
+def legacy_render(path, replacements):
+    '''
+    ldif_read() with replacements from ezldap 0.6.4, which reads and
+    substitutes the whole template, then parses it on every call.
+    '''
+    content = StringIO(Template(open(path).read()).substitute(replacements))
+
+    operations = {
+        'add': ldap3.MODIFY_ADD,
+        'replace': ldap3.MODIFY_REPLACE,
+        'delete': ldap3.MODIFY_DELETE
+    }
+
+    entries = []
+    entry = {}
+    changetype = 'add'
+    next_change_attr = None
+    next_change_type = 'add'
+    for line in content:
+        if line[0] == '#':
+            continue
+        if line[0] == '-':
+            if next_change_type == 'delete' and len(entry[next_change_attr]) == 0:
+                entry[next_change_attr].append((ldap3.MODIFY_DELETE, []))
+
+            continue
+        elif re.match(r'dn:', line):
+            if 'dn' in entry.keys():
+                entries.append(entry)
+                changetype = 'add'
+
+            entry = {}
+
+        match = re.findall(r'(\w+):\s*(.+)', line)
+        if len(match) > 0:
+            key = match[0][0]
+            value = match[0][1].strip()
+
+            if key == 'changetype':
+                changetype = value
+                continue
+            elif key not in entry.keys() and key not in operations.keys():
+                entry[key] = []
+
+            if changetype == 'modify':
+                if key in operations.keys():
+                    next_change_type, next_change_attr = key, value
+                    if value not in entry.keys():
+                        entry[value] = []
+
+                    continue
+                elif key == next_change_attr:
+                    value = (operations[next_change_type], [value])
+                else:
+                    raise ValueError('Attribute does not match attribute to {}.'.format(next_change_type))
+
+            entry[key].append(value)
+
+    if 'dn' in entry.keys():
+        entries.append(entry)
+
+    return entries
+
+
+def generate_rows(n_rows):
+    return [{'username': 'user{}'.format(i),
+             'peopledn': 'ou=People,dc=ezldap,dc=io',
+             'user_password': '{SSHA}bm90IGEgcmVhbCBoYXNo',
+             'uid': 10000 + i,
+             'gid': 10000 + i,
+             'homedir': '/home'} for i in range(n_rows)]
+
+
+def bench(name, render, rows):
+    start = time.perf_counter()
+    for row in rows:
+        render(TEMPLATE, row)
+
+    elapsed = time.perf_counter() - start
+    print('{:<8} {:>12,.0f} rows/sec'.format(name, len(rows) / elapsed))
+
+
+def main():
+    n_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    rows = generate_rows(n_rows)
+    assert ldif_read(TEMPLATE, rows[0]) == legacy_render(TEMPLATE, rows[0])
+    print('Rendering {} for {:,} rows'.format(TEMPLATE, n_rows))
+    bench('legacy', legacy_render, rows)
+    bench('ezldap', ldif_read, rows)
+
+
+if __name__ == '__main__':
+    main()
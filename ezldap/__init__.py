@@ -1,5 +1,74 @@
-from .api import *
-from .password import *
-from .config import *
-from .ldif import *
+'''
+Submodules depending on ldap3 are imported the first time one of their names
+is used, so that "import ezldap" stays fast for things like "ezldap --help".
+'''
+
+import importlib
+
 from .version import __version__
+from .password import random_passwd, ssha, ssha_passwd, ssha_check
+from .config import config, guess_config, readlines_to_dict, get_ldap_conf_val
+
+# public names, and the submodule each one lives in
+_EXPORTS = {
+    'api': ['ping', 'supports_starttls', 'auto_bind', 'dn_address',
+        'clean_uri', 'Connection', 'STARTTLS_CACHE_TTL', 'RDN_ATTRIBUTES',
+        'EXPORT_FORMATS', 'LDAPSocketOpenError', 'LDAPStartTLSError',
+        'LDAPSessionTerminatedByServerError', 'LDAPSocketReceiveError'],
+    'aio': ['AsyncConnection'],
+    'allocator': ['IDAllocator'],
+    'ldif': ['LDIFTemplateError', 'template', 'ldif_read', 'ldif_iter',
+        'ldif_write', 'ldif_print', 'OPERATIONS', 'CHANGETYPES', 'LINE_WIDTH',
+        'TEMPLATE_CACHE_MAX_SIZE'],
+    'mirror': ['Mirror', 'INDEXED_ATTRIBUTES', 'parse_filter'],
+    'pool': ['PoolExhaustedError', 'auto_pool', 'ConnectionPool'],
+    'terminal': ['fmt'],
+}
+
+_LAZY = {name: module for module, names in _EXPORTS.items() for name in names}
+
+# modules that "from .api import *" and friends used to leak into this
+# namespace. Not part of the API, but still importable so old scripts work.
+_COMPAT = {
+    'ldap3': ('ldap3', None),
+    'yaml': ('yaml', None),
+    'os': ('os', None),
+    'sys': ('sys', None),
+    're': ('re', None),
+    'copy': ('copy', None),
+    'getpass': ('getpass', None),
+    'ipaddress': ('ipaddress', None),
+    'base64': ('base64', None),
+    'hashlib': ('hashlib', None),
+    'string': ('string', None),
+    'StringIO': ('io', 'StringIO'),
+    'SystemRandom': ('random', 'SystemRandom'),
+    'Template': ('string', 'Template'),
+}
+
+__all__ = sorted(_LAZY) + ['__version__', 'random_passwd', 'ssha',
+    'ssha_passwd', 'ssha_check', 'config', 'guess_config', 'readlines_to_dict',
+    'get_ldap_conf_val']
+
+
+def __getattr__(name):
+    if name in _EXPORTS:
+        return importlib.import_module('.' + name, __name__)
+
+    if name in _COMPAT:
+        module, attribute = _COMPAT[name]
+        value = importlib.import_module(module)
+        return value if attribute is None else getattr(value, attribute)
+
+    module = _LAZY.get(name)
+    if module is None:
+        raise AttributeError("module 'ezldap' has no attribute '{}'".format(name))
+
+    value = getattr(importlib.import_module('.' + module, __name__), name)
+    # cache it, so __getattr__ is only called once per name
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY))
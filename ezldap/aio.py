@@ -0,0 +1,510 @@
+'''
+An asyncio interface to an LDAP directory, for services running in an event
+loop where blocking on every directory operation is not an option.
+'''
+
+import re
+import time
+import asyncio
+import collections
+import functools
+import ipaddress
+
+import ldap3
+from ldap3.core.exceptions import LDAPResponseTimeoutError, \
+    LDAPSessionTerminatedByServerError
+from ldap3.strategy.base import RESPONSE_COMPLETE
+
+from .api import Connection, dn_address, _normalize_entry, _ldif_add_entry, \
+    _ldif_modify_entry
+from .ldif import ldif_read
+from .password import ssha_passwd
+from .columnar import ColumnBuilder
+
+# seconds between checks for a response, doubled each time up to the maximum
+POLL_INTERVAL = 0.0005
+MAX_POLL_INTERVAL = 0.01
+
+# OID of the simple paged results control (RFC 2696)
+PAGED_RESULTS = '1.2.840.113556.1.4.319'
+
+# oldest and newest ldap3 releases whose asynchronous strategy internals are
+# known, and can be checked for responses directly
+INTERNALS_VERSIONS = ((2, 5), (2, 9))
+LDAP3_VERSION = tuple(int(part) for part in
+    re.findall(r'\d+', ldap3.__version__)[:2])
+
+
+class _ResponsePoller:
+    '''
+    Checks whether the response to an asynchronous request has arrived,
+    without blocking. On ldap3 releases in INTERNALS_VERSIONS, the strategy's
+    response table is inspected directly. Other releases use get_response()
+    with a timeout of 0 instead, which only relies on ldap3's public API but
+    is slower when responses are not ready yet.
+    '''
+
+    def __init__(self, con):
+        self.con = con
+        strategy = con.strategy
+        self.internals = INTERNALS_VERSIONS[0] <= LDAP3_VERSION <= \
+            INTERNALS_VERSIONS[1] and (strategy.no_real_dsa or
+            hasattr(strategy, '_events') or (hasattr(strategy, '_responses') and
+            hasattr(strategy, 'async_lock')))
+
+    def _ready(self, msgid):
+        strategy = self.con.strategy
+        if strategy.no_real_dsa:
+            # mock strategies answer as soon as a request is sent
+            return True
+
+        events = getattr(strategy, '_events', None)
+        if events is None:
+            # ldap3 < 2.9 marks complete responses in the response list itself
+            with strategy.async_lock:
+                responses = strategy._responses.get(msgid)
+                return responses is not None and responses[-1] == RESPONSE_COMPLETE
+
+        # set by ldap3's receiver thread once the response is complete
+        event = events.get(msgid)
+        return event is None or event.is_set()
+
+    def poll(self, msgid):
+        '''
+        Return (response, result) like ldap3.Connection.get_response() if the
+        response has arrived, otherwise None.
+        '''
+        if self.internals:
+            return self.con.get_response(msgid) if self._ready(msgid) else None
+
+        try:
+            return self.con.get_response(msgid, timeout=0)
+        except LDAPResponseTimeoutError:
+            return None
+
+
+class AsyncConnection:
+    '''
+    An asyncio version of ezldap.Connection with awaitable methods. Operations
+    are sent over a single connection using ldap3's asynchronous client
+    strategy, and each is matched to its response by message ID, so any number
+    of concurrent operations (for instance from asyncio.gather()) share one
+    socket without blocking the event loop. When used with the "async with"
+    keyword, the connection binds on entry and unbinds when done.
+    '''
+
+    def __init__(self, host, user=None, password=None, conf=None, timeout=None,
+        **kwargs):
+        '''
+        :param host: An LDAP server URI (eg. ldaps://someserver:636)
+        :param user: Bind user. If None, binds will be anonymous.
+        :param password: Bind password. If None, binds will be anonymous.
+        :param conf: A dict of configuration values, such as those generated by
+            ezldap.config().
+        :param timeout: Seconds to wait for the response to an operation.
+            Defaults to ldap3's RESPONSE_WAITING_TIMEOUT.
+        :param kwargs: Any other arguments are passed to ezldap.Connection().
+            The client_strategy defaults to ldap3.ASYNC.
+        '''
+        kwargs.setdefault('client_strategy', ldap3.ASYNC)
+        self.host = host
+        self.user = user
+        self.password = password
+        self.timeout = ldap3.get_config_parameter('RESPONSE_WAITING_TIMEOUT') \
+            if timeout is None else timeout
+        self.kwargs = kwargs
+        self.kwargs['conf'] = conf
+        self.con = None
+        self._poller = None
+        self._seed_lock = None
+
+    async def __aenter__(self):
+        if self.con is None:
+            await self.open()
+
+        return self
+
+    async def __aexit__(self, type_, value, traceback):
+        '''
+        Unbind when used with "async with" keyword.
+        '''
+        await self.close()
+
+    async def open(self):
+        '''
+        Bind to the directory. Binding (including the StartTLS negotiation) is
+        done in a worker thread, so the event loop is not blocked.
+        '''
+        loop = asyncio.get_running_loop()
+        self.con = await loop.run_in_executor(None, functools.partial(
+            Connection, self.host, user=self.user, password=self.password,
+            **self.kwargs))
+        if self.con.closed:
+            # ldap3's mock strategies are not opened by auto_bind
+            self.con.open()
+
+        self._poller = _ResponsePoller(self.con)
+        return self
+
+    async def close(self):
+        '''
+        Unbind from the directory.
+        '''
+        if self.con is not None and not self.con.closed:
+            self.con.unbind()
+
+    @property
+    def conf(self):
+        return self.con.conf
+
+    async def _wait(self, msgid):
+        '''
+        Wait for the response to a request without blocking the event loop.
+        Returns (response, result), like ldap3.Connection.get_response().
+        '''
+        deadline = time.monotonic() + self.timeout
+        interval = POLL_INTERVAL
+        while True:
+            response = self._poller.poll(msgid)
+            if response is not None:
+                return response
+            elif self.con.closed:
+                raise LDAPSessionTerminatedByServerError('Connection closed '
+                    'before a response was received.')
+            elif time.monotonic() > deadline:
+                raise LDAPResponseTimeoutError('No response from server.')
+
+            await asyncio.sleep(interval)
+            interval = min(interval * 2, MAX_POLL_INTERVAL)
+
+    async def _search(self, search_filter, attributes, search_base, **kwargs):
+        '''
+        Run a search and return the raw ldap3 response for each entry found,
+        and the search result.
+        '''
+        if search_base is None:
+            search_base = await self.base_dn()
+
+        response, result = await self._wait(self.con.search(search_base,
+            search_filter, attributes=attributes, **kwargs))
+        return [res for res in response or []
+            if res['type'] == 'searchResEntry'], result
+
+    async def base_dn(self):
+        '''
+        Detect the base DN/naming context of the directory.
+        '''
+        info = self.con.server.info
+        if info is not None and info.naming_contexts:
+            return info.naming_contexts[0]
+
+        if self.con._base_dn is None:
+            response, _ = await self._search('(objectClass=*)',
+                ['namingContexts'], '', search_scope=ldap3.BASE)
+            if not response or not response[0]['attributes'].get('namingContexts'):
+                raise ValueError('Could not determine the base DN of the directory.')
+
+            self.con._base_dn = response[0]['attributes']['namingContexts'][0]
+
+        return self.con._base_dn
+
+    async def search_list(self, search_filter='(objectClass=*)',
+                          attributes=ldap3.ALL_ATTRIBUTES, search_base=None,
+                          **kwargs):
+        '''
+        Search a directory, returning a list of dicts like
+        Connection.search_list().
+        '''
+        response, _ = await self._search(search_filter, attributes,
+            search_base, **kwargs)
+        return [_normalize_entry(res) for res in response]
+
+    async def iter_search(self, search_filter='(objectClass=*)',
+                          attributes=ldap3.ALL_ATTRIBUTES, search_base=None,
+                          page_size=500, **kwargs):
+        '''
+        An async generator version of search_list(), for use with "async for".
+        Results are fetched from the server in pages of page_size entries using
+        the simple paged results control (RFC 2696).
+        '''
+        cookie = None
+        while True:
+            response, result = await self._search(search_filter, attributes,
+                search_base, paged_size=page_size, paged_cookie=cookie,
+                **kwargs)
+            for res in response:
+                yield _normalize_entry(res)
+
+            try:
+                cookie = result['controls'][PAGED_RESULTS]['value']['cookie']
+            except (KeyError, TypeError):
+                # the server returned everything at once
+                cookie = None
+
+            if not cookie:
+                break
+
+    async def search_list_t(self, search_filter='(objectClass=*)',
+                            attributes=ldap3.ALL_ATTRIBUTES, search_base=None,
+                            unpack_lists=True, unpack_delimiter='|',
+                            explode=None, **kwargs):
+        '''
+        Search a directory, returning a dict of lists like
+        Connection.search_list_t().
+        '''
+        builder = ColumnBuilder(attributes, unpack_lists=unpack_lists,
+            unpack_delimiter=unpack_delimiter, explode=explode)
+        response, _ = await self._search(search_filter, attributes,
+            search_base, **kwargs)
+        for res in response:
+            builder.add(res['dn'], res['attributes'])
+
+        return builder.columns()
+
+    async def exists(self, dn):
+        '''
+        Returns true if a given DN exists in an LDAP directory.
+        '''
+        response, _ = await self._search('(objectClass=*)',
+            ldap3.NO_ATTRIBUTES, dn, search_scope=ldap3.BASE)
+        return len(response) == 1
+
+    async def _conf_basedn_key(self, key):
+        try:
+            return self.conf[key]
+        except KeyError:
+            return await self.base_dn()
+
+    async def get_user(self, user, basedn=None, index='uid'):
+        '''
+        Return given user as a dict or None if none is found. Searches entire
+        directory if no base search dn given.
+        '''
+        if basedn is None:
+            basedn = await self._conf_basedn_key('peopledn')
+
+        query = await self.search_list('({}={})'.format(index, user),
+            search_base=basedn)
+        return query[0] if query else None
+
+    async def get_group(self, group, basedn=None, index='cn'):
+        '''
+        Return a given group. Searches entire directory if no base search dn given.
+        '''
+        if basedn is None:
+            basedn = await self._conf_basedn_key('groupdn')
+
+        return await self.get_user(group, basedn=basedn, index=index)
+
+    async def get_host(self, host, basedn=None, index='cn'):
+        '''
+        Return a given host. Searches entire directory if no base search dn given.
+        '''
+        if basedn is None:
+            basedn = await self._conf_basedn_key('hostsdn')
+
+        return await self.get_user(host, basedn=basedn, index=index)
+
+    async def add(self, dn, object_class=None, attributes=None, controls=None):
+        '''
+        Add an entry to the directory and return the result.
+        '''
+        return (await self._wait(self.con.add(dn, object_class, attributes,
+            controls)))[1]
+
+    async def modify(self, dn, changes, controls=None):
+        '''
+        Modify an entry and return the result.
+        '''
+        return (await self._wait(self.con.modify(dn, changes, controls)))[1]
+
+    async def delete(self, dn, controls=None):
+        '''
+        Delete an entry and return the result.
+        '''
+        return (await self._wait(self.con.delete(dn, controls)))[1]
+
+    async def modify_dn(self, dn, relative_dn, delete_old_dn=True,
+                        new_superior=None, controls=None):
+        '''
+        Rename or move an entry and return the result.
+        '''
+        return (await self._wait(self.con.modify_dn(dn, relative_dn,
+            delete_old_dn, new_superior, controls)))[1]
+
+    async def modify_replace(self, dn, attrib, value, replace_with=None):
+        '''
+        Change a single attribute on an object.
+        '''
+        if value is None:
+            raise ValueError('value cannot be None when performing a replace operation.')
+
+        if replace_with is None:
+            return await self.modify(dn, {attrib: [(ldap3.MODIFY_REPLACE, [value])]})
+
+        await self.modify_delete(dn, attrib, value)
+        return await self.modify_add(dn, attrib, replace_with)
+
+    async def modify_add(self, dn, attrib, value):
+        '''
+        Add a single attribute to an object.
+        '''
+        return await self.modify(dn, {attrib: [(ldap3.MODIFY_ADD, [value])]})
+
+    async def modify_delete(self, dn, attrib, value=None):
+        '''
+        Delete a single attribute from an object.
+        If value is None, deletes all attributes of that name.
+        '''
+        values = [] if value is None else [value]
+        return await self.modify(dn, {attrib: [(ldap3.MODIFY_DELETE, values)]})
+
+    async def _send_all(self, operation, entries, max_in_flight):
+        '''
+        Send operation(entry) for each entry, with up to max_in_flight
+        operations awaiting a response at once. Entries are read as they are
+        sent, so generators are never consumed ahead of the requests in flight.
+        Results are returned in order.
+        '''
+        results = []
+        in_flight = collections.deque()
+        try:
+            for entry in entries:
+                in_flight.append(asyncio.ensure_future(self._wait(operation(entry))))
+                if len(in_flight) >= max_in_flight:
+                    results.append((await in_flight.popleft())[1])
+
+            while in_flight:
+                results.append((await in_flight.popleft())[1])
+        except BaseException:
+            for task in in_flight:
+                task.cancel()
+            raise
+
+        return results
+
+    async def ldif_add(self, ldif, max_in_flight=16):
+        '''
+        Perform an add operation using an LDIF object. Up to max_in_flight
+        adds are pipelined over the connection at once. Results are returned
+        in the same order as the LDIF entries.
+        '''
+        return await self._send_all(lambda entry: _ldif_add_entry(self.con, entry),
+            ldif, max_in_flight)
+
+    async def ldif_modify(self, ldif, max_in_flight=16):
+        '''
+        Perform an LDIF modify operation from an LDIF object, pipelined like
+        ldif_add().
+        '''
+        return await self._send_all(lambda entry: _ldif_modify_entry(self.con, entry),
+            ldif, max_in_flight)
+
+    async def _next_id(self, search_filter, search_base, id_start, attribute,
+                       counter_key, reserve):
+        '''
+        Return the next free ID from the connection's IDAllocator, seeding it
+        with an asynchronous search the first time.
+        '''
+        if self.conf.get(counter_key) is not None:
+            raise ValueError('ID counters ({}) are not supported by '
+                'AsyncConnection.'.format(counter_key))
+
+        allocator = self.con.id_allocator(search_filter, search_base, id_start,
+            attribute, fill_gaps=self.conf.get('fill_id_gaps', False))
+        if self._seed_lock is None:
+            self._seed_lock = asyncio.Lock()
+
+        # concurrent callers must not seed (and hand out IDs) twice
+        async with self._seed_lock:
+            if allocator._used is None:
+                used = set()
+                async for entry in self.iter_search(search_filter, [attribute],
+                        search_base):
+                    used.update(entry.get(attribute, []))
+
+                allocator.seed(used)
+
+        if reserve:
+            return allocator.allocate()
+
+        return allocator.peek()
+
+    async def next_uidn(self, search_filter='(objectClass=posixAccount)',
+                        search_base=None, uid_start=10000,
+                        uid_attribute='uidNumber', reserve=False):
+        '''
+        Determine the next available uid number in a directory tree. If reserve
+        is True, the uid number will not be returned again.
+        '''
+        return await self._next_id(search_filter, search_base, uid_start,
+            uid_attribute, 'uid_counter_dn', reserve)
+
+    async def next_gidn(self, search_filter='(objectClass=posixGroup)',
+                        search_base=None, gid_start=10000,
+                        gid_attribute='gidNumber', reserve=False):
+        '''
+        Determine the next available gid number in a directory tree.
+        '''
+        return await self._next_id(search_filter, search_base, gid_start,
+            gid_attribute, 'gid_counter_dn', reserve)
+
+    async def add_group(self, groupname,
+                        ldif_path='~/.ezldap/add_group.ldif', **kwargs):
+        '''
+        Adds a group from an LDIF template.
+        '''
+        replace = {'groupname': groupname, 'gid': None}
+        replace.update(self.conf)
+        replace.update(kwargs)
+        if replace['gid'] is None:
+            replace['gid'] = await self.next_gidn(reserve=True)
+
+        return await self.ldif_add(ldif_read(ldif_path, replace))
+
+    async def add_to_group(self, username, groupname,
+                           ldif_path='~/.ezldap/add_to_group.ldif', **kwargs):
+        '''
+        Adds a user to a group.
+        The user and group in question must already exist.
+        '''
+        replace = {'username': username, 'groupname': groupname}
+        replace.update(self.conf)
+        replace.update(kwargs)
+        return await self.ldif_modify(ldif_read(ldif_path, replace))
+
+    async def add_user(self, username, groupname, password,
+                       ldif_path='~/.ezldap/add_user.ldif', **kwargs):
+        '''
+        Adds a user. Does not create or modify groups.
+        "groupname" may be None if "gid" is specified.
+        '''
+        replace = {'username': username,
+                   'user_password': ssha_passwd(password),
+                   'uid': None,
+                   'gid': None}
+        replace.update(self.conf)
+        replace.update(kwargs)
+        if replace['gid'] is None:
+            group = await self.get_group(groupname)
+            if group is None:
+                raise ValueError('Group does not exist')
+
+            replace['gid'] = group['gidNumber'][0]
+
+        if replace['uid'] is None:
+            replace['uid'] = await self.next_uidn(reserve=True)
+
+        return await self.ldif_add(ldif_read(ldif_path, replace))
+
+    async def add_host(self, hostname, ip_address,
+                       ldif_path='~/.ezldap/add_host.ldif', **kwargs):
+        '''
+        Add a host to a directory, like Connection.add_host().
+        '''
+        replace = {'hostname': hostname,
+                   'ip': str(ipaddress.ip_address(ip_address)),
+                   'hostname_fq': hostname + '.' + dn_address(await self.base_dn())}
+        replace.update(self.conf)
+        replace.update(kwargs)
+        return await self.ldif_add(ldif_read(ldif_path, replace))
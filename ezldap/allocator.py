@@ -0,0 +1,184 @@
+'''
+Hand out unused uid/gid numbers without rescanning the directory every time.
+'''
+
+import bisect
+
+import ldap3
+from ldap3.core.results import RESULT_NO_SUCH_ATTRIBUTE
+
+
+class IDAllocator:
+    '''
+    Allocates numeric IDs (like uidNumber or gidNumber) for new entries. The
+    directory is scanned once to find every ID currently in use, after which
+    IDs are handed out from memory. IDs used by entries added through the same
+    connection are tracked automatically.
+
+    If counter_dn is set, IDs are instead reserved from a counter attribute
+    stored on that entry. The counter holds the next free ID and is advanced
+    with a single delete/add modify, which the server applies atomically. If
+    another client advanced the counter first, the delete fails and the
+    reservation is retried, so concurrent provisioners never receive the same
+    ID. The directory is not scanned in this mode: the counter is trusted,
+    and only IDs used through this connection are skipped.
+    '''
+
+    def __init__(self, con, search_filter='(objectClass=posixAccount)',
+        search_base=None, id_start=10000, attribute='uidNumber',
+        fill_gaps=False, counter_dn=None, counter_attribute=None):
+        '''
+        :param con: An ezldap.Connection.
+        :param search_filter: Filter matching entries whose IDs are in use.
+        :param search_base: Where to search for used IDs. If None, the
+            directory base DN will be used.
+        :param id_start: The lowest ID that will be handed out.
+        :param attribute: The attribute holding IDs, for instance uidNumber.
+        :param fill_gaps: Hand out the lowest free ID at or above id_start
+            instead of the ID after the highest one in use.
+        :param counter_dn: DN of an entry used to reserve IDs atomically.
+        :param counter_attribute: Attribute of the counter entry holding the
+            next free ID. Defaults to the same attribute as the IDs themselves.
+        '''
+        self.con = con
+        self.search_filter = search_filter
+        self.search_base = search_base
+        self.id_start = id_start
+        self.attribute = attribute
+        self.fill_gaps = fill_gaps
+        self.counter_dn = counter_dn
+        self.counter_attribute = attribute if counter_attribute is None \
+            else counter_attribute
+        self._used = None
+        self._cursor = id_start
+
+    def seed(self, used=None):
+        '''
+        (Re)load the IDs currently in use with a single paged search.
+
+        :param used: The IDs in use, if they have already been looked up. The
+            directory is not searched if given.
+        '''
+        if used is None:
+            used = set()
+            for entry in self.con.iter_search(self.search_filter,
+                    attributes=[self.attribute], search_base=self.search_base):
+                for value in entry.get(self.attribute, []):
+                    used.add(int(value))
+        else:
+            used = {int(value) for value in used}
+
+        self._used = sorted(used)
+        if self.fill_gaps or len(self._used) == 0:
+            self._cursor = self.id_start
+        else:
+            self._cursor = max(self.id_start, self._used[-1] + 1)
+
+    def _load(self):
+        '''
+        Seed the IDs in use if that hasn't been done yet. In counter mode, only
+        IDs used through this connection are tracked.
+        '''
+        if self._used is None:
+            if self.counter_dn is None:
+                self.seed()
+            else:
+                self._used = []
+
+    def _free_from(self, candidate):
+        '''
+        Return the lowest unused ID at or above candidate.
+        '''
+        i = bisect.bisect_left(self._used, candidate)
+        while i < len(self._used) and self._used[i] == candidate:
+            candidate += 1
+            i += 1
+
+        return candidate
+
+    def mark_used(self, id_number):
+        '''
+        Record that an ID is in use, so it will not be handed out.
+        '''
+        self._load()
+
+        id_number = int(id_number)
+        i = bisect.bisect_left(self._used, id_number)
+        if i == len(self._used) or self._used[i] != id_number:
+            self._used.insert(i, id_number)
+
+    def release(self, id_number):
+        '''
+        Record that an ID is no longer in use (for instance, if its entry was
+        deleted), so it may be handed out again when filling gaps.
+        '''
+        self._load()
+
+        id_number = int(id_number)
+        i = bisect.bisect_left(self._used, id_number)
+        if i < len(self._used) and self._used[i] == id_number:
+            del self._used[i]
+
+        if self.fill_gaps and self.id_start <= id_number < self._cursor:
+            self._cursor = id_number
+
+    def peek(self):
+        '''
+        Return the next ID that would be allocated, without reserving it.
+        '''
+        self._load()
+
+        if self.counter_dn is not None:
+            return self._free_from(self._read_counter())
+
+        self._cursor = self._free_from(self._cursor)
+        return self._cursor
+
+    def allocate(self):
+        '''
+        Reserve and return an unused ID.
+        '''
+        if self.counter_dn is None:
+            id_number = self.peek()
+        else:
+            id_number = self.reserve()
+            while id_number in self:
+                # taken by something that bypassed the counter, skip it
+                id_number = self.reserve()
+
+        self.mark_used(id_number)
+        return id_number
+
+    def __contains__(self, id_number):
+        self._load()
+
+        i = bisect.bisect_left(self._used, id_number)
+        return i < len(self._used) and self._used[i] == id_number
+
+    def _read_counter(self):
+        query = self.con.search_list(search_base=self.counter_dn,
+            search_scope=ldap3.BASE, attributes=[self.counter_attribute])
+        try:
+            return int(query[0][self.counter_attribute][0])
+        except (IndexError, KeyError):
+            raise ValueError('Counter entry "{}" has no {} attribute.'
+                .format(self.counter_dn, self.counter_attribute))
+
+    def reserve(self, count=1):
+        '''
+        Atomically reserve a block of "count" IDs from the directory counter
+        entry. Returns the first ID of the block.
+        '''
+        if self.counter_dn is None:
+            raise ValueError('No counter_dn configured for this allocator.')
+
+        while True:
+            current = self._read_counter()
+            self.con.modify(self.counter_dn, {self.counter_attribute: [
+                (ldap3.MODIFY_DELETE, [str(current)]),
+                (ldap3.MODIFY_ADD, [str(current + count)])]})
+            if self.con.result['result'] == 0:
+                return current
+            elif self.con.result['result'] != RESULT_NO_SUCH_ATTRIBUTE:
+                raise ValueError('Could not update counter entry "{}": {}'
+                    .format(self.counter_dn, self.con.result['description']))
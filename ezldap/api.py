@@ -2,21 +2,51 @@
 Bind to an LDAP directory and perform various operations.
 '''
 
+import os
 import sys
 import getpass
 import copy
 import re
+import csv
+import time
 import ipaddress
+import itertools
+import importlib.util
+import collections
+from concurrent.futures import ThreadPoolExecutor
 
 import ldap3
 from ldap3.core.exceptions import LDAPSocketOpenError, LDAPStartTLSError, \
-    LDAPSessionTerminatedByServerError, LDAPSocketReceiveError
-
-from .ldif import ldif_read
-from .password import ssha_passwd
+    LDAPSessionTerminatedByServerError, LDAPSocketReceiveError, \
+    LDAPInvalidDnError
+from ldap3.protocol.rfc4512 import DsaInfo, SchemaInfo
+from ldap3.utils.conv import escape_filter_chars
+from ldap3.utils.dn import to_dn, parse_dn
+
+from .ldif import ldif_read, ldif_write, _entries_to_handle, _is_modify, \
+    _value_str
+from .password import ssha_passwd, random_passwd
 from .config import config
+from .cache import cache_read, cache_write, host_key, EntryCache
+from .allocator import IDAllocator
+from .columnar import ColumnBuilder, column_types, arrow_schema, record_batch, \
+    to_string, typed_dataframe
 from .terminal import fmt
 
+# how long (in seconds) the result of a StartTLS probe is trusted for
+STARTTLS_CACHE_TTL = 3600
+_starttls_cache = {}
+
+# attributes commonly used to name entries, searched by Connection.search_dn()
+RDN_ATTRIBUTES = ['cn', 'uid', 'ou', 'dc', 'o', 'l', 'c', 'st', 'mail']
+
+# file extensions recognized by Connection.export()
+EXPORT_FORMATS = {'.parquet': 'parquet', '.pq': 'parquet', '.arrow': 'arrow',
+    '.feather': 'arrow', '.ipc': 'arrow', '.csv': 'csv'}
+
+# characters that only appear in a DN between or around RDN values
+_DN_SPECIAL = set(',=+<>#;\\"')
+
 
 def ping(uri):
     '''
@@ -33,24 +63,49 @@ def ping(uri):
         return False
 
 
-def supports_starttls(uri):
+def supports_starttls(uri, ttl=STARTTLS_CACHE_TTL, persist=False):
     '''
     Determine if the server actually supports StartTLS (both the server software
     itself supports it, and the server instance itself has been configured with
     SSL support).
+
+    The result of this check is cached per URI for "ttl" seconds, so repeat
+    connections to the same server do not need to probe it again (a ttl of 0
+    disables the cache). If persist is True, results are also stored in
+    ~/.ezldap/cache/starttls.yml and reused across sessions.
     '''
+    uri = clean_uri(uri)
+    now = time.time()
+    if ttl:
+        cached = _starttls_cache.get(uri)
+        if cached is None and persist:
+            cached = cache_read('starttls.yml').get(uri)
+
+        if cached is not None and now - cached['checked'] < ttl:
+            _starttls_cache[uri] = cached
+            return cached['starttls']
+
     try:
-        uri = clean_uri(uri)
         con = ldap3.Connection(uri, auto_bind=ldap3.AUTO_BIND_TLS_BEFORE_BIND)
         con.unbind()
-        return True
+        supported = True
     except LDAPStartTLSError:
-        return False
+        supported = False
 
+    _starttls_cache[uri] = {'starttls': supported, 'checked': now}
+    if persist:
+        persisted = cache_read('starttls.yml')
+        persisted[uri] = _starttls_cache[uri]
+        cache_write('starttls.yml', persisted)
 
-def auto_bind(conf=None, server_info=True):
+    return supported
+
+
+def auto_bind(conf=None, server_info=True, **kwargs):
     '''
     Automatically detects LDAP config values and returns a directory binding.
+    server_info and any extra keyword arguments are passed to
+    ezldap.Connection().
     '''
     if conf is None:
         conf = config()
@@ -59,7 +114,7 @@ def auto_bind(conf=None, server_info=True):
         conf['bindpw'] = getpass.getpass('Enter bind DN password...')
 
     return Connection(conf['host'], user=conf['binddn'],
-        password=conf['bindpw'], conf=conf)
+        password=conf['bindpw'], conf=conf, server_info=server_info, **kwargs)
 
 
 def dn_address(dn):
@@ -85,6 +140,167 @@ def clean_uri(uri):
     return re.sub(r'/$', '', uri)
 
 
+def _normalize_entry(res):
+    '''
+    Convert an ldap3 search response into an ezldap entry dict, with the DN and
+    every attribute encapsulated in a list.
+    '''
+    entry = {'dn': [res['dn']]}
+    for k, v in res['attributes'].items():
+        entry[k] = v if isinstance(v, list) else [v]
+
+    return entry
+
+
+def _unescape_dn_value(value):
+    '''
+    Undo the escaping of an attribute value in a DN (RFC 4514), for example
+    "Smith\\, John" becomes "Smith, John".
+    '''
+    if '\\' not in value:
+        return value
+
+    out = bytearray()
+    i = 0
+    while i < len(value):
+        char = value[i]
+        if char == '\\' and i + 1 < len(value):
+            pair = value[i + 1:i + 3]
+            if len(pair) == 2 and all(c in '0123456789abcdefABCDEF' for c in pair):
+                out.append(int(pair, 16))
+                i += 3
+                continue
+
+            char = value[i + 1]
+            i += 1
+
+        out.extend(char.encode('utf-8'))
+        i += 1
+
+    return out.decode('utf-8', errors='replace')
+
+
+def _split_dn(dn):
+    '''
+    Split a DN into its first RDN, as a list of (attribute, value) pairs, and
+    its parent DN. Returns None if the DN is not valid.
+    '''
+    try:
+        parts = parse_dn(dn)
+    except LDAPInvalidDnError:
+        return None
+
+    rdn = []
+    for i, (attribute, value, separator) in enumerate(parts):
+        rdn.append((attribute, _unescape_dn_value(value)))
+        if separator != '+':
+            break
+
+    parent = parts[i + 1:]
+    return rdn, ','.join('{}={}'.format(a, v) for a, v, _ in parent)
+
+
+def _dn_key(dn):
+    '''
+    A comparable form of a DN that ignores case, spacing and escaping.
+    Returns None if the DN is not valid.
+    '''
+    try:
+        parts = parse_dn(dn)
+    except LDAPInvalidDnError:
+        return None
+
+    key = []
+    rdn = []
+    for attribute, value, separator in parts:
+        rdn.append((attribute.lower(), _unescape_dn_value(value).lower()))
+        if separator != '+':
+            key.append(tuple(sorted(rdn)))
+            rdn = []
+
+    return tuple(key)
+
+
+def _raw_value(value):
+    '''
+    The bytes a value is stored as on the server, for comparing values.
+    '''
+    value = _value_str(value)
+    return value if isinstance(value, bytes) else value.encode('utf-8')
+
+
+def _diff_values(desired, current):
+    '''
+    Return the changes (in ldap3.Connection.modify() format) that turn the
+    current values of an attribute into the desired ones, or [] if they are
+    the same. Values are compared exactly, as they are stored on the server.
+    '''
+    wanted = {}
+    for value in desired:
+        wanted.setdefault(_raw_value(value), value)
+
+    current = set(current)
+    if set(wanted) == current:
+        return []
+    elif not current:
+        return [(ldap3.MODIFY_ADD, list(wanted.values()))]
+    elif not wanted:
+        return [(ldap3.MODIFY_DELETE, [])]
+
+    removed = [value for value in current if value not in wanted]
+    added = [value for raw, value in wanted.items() if raw not in current]
+    if len(removed) + len(added) >= len(wanted):
+        # rewriting every value is no more work than changing them one by one
+        return [(ldap3.MODIFY_REPLACE, list(wanted.values()))]
+
+    changes = []
+    if removed:
+        changes.append((ldap3.MODIFY_DELETE, removed))
+    if added:
+        changes.append((ldap3.MODIFY_ADD, added))
+
+    return changes
+
+
+def _ldif_add_entry(con, entry):
+    '''
+    Send the add operation for an LDIF entry over con.
+    '''
+    # the caller's entries are never modified or copied, the attributes
+    # are just everything except the dn and objectClass
+    attributes = {k: v for k, v in entry.items()
+                  if k not in ('dn', 'objectClass', 'changetype')}
+    #TODO fix for 389 directory server and "objectClasses"
+    return con.add(dn=entry['dn'][0], object_class=entry.get('objectClass'),
+        attributes=attributes)
+
+
+def _ldif_modify_entry(con, entry):
+    '''
+    Send the operation for an LDIF change record over con. Delete, modrdn and
+    add records are sent as delete, modify DN and add operations. Modify
+    records without any changes raise a ValueError.
+    '''
+    dn = entry['dn'][0]
+    changetype = entry.get('changetype', ['modify'])[0]
+    if changetype == 'add':
+        return _ldif_add_entry(con, entry)
+    elif changetype == 'delete':
+        return con.delete(dn)
+    elif changetype in ('modrdn', 'moddn'):
+        return con.modify_dn(dn, entry['newrdn'][0],
+            delete_old_dn=entry.get('deleteoldrdn', ['1'])[0] == '1',
+            new_superior=entry.get('newsuperior', [None])[0])
+
+    changes = {k: v for k, v in entry.items()
+               if k != 'dn' and k != 'changetype'}
+    if not any(isinstance(change, tuple) for values in changes.values()
+            for change in values):
+        raise ValueError('The LDIF modify record for "{}" has no changes.'.format(dn))
+
+    return con.modify(dn, changes)
+
+
 class Connection(ldap3.Connection):
     '''
     An object-oriented wrapper around an LDAP connection.
@@ -118,7 +334,9 @@ class Connection(ldap3.Connection):
             supported.
         :param server_info: Whether to fetch information about the server like
             schema and supported controls. Setting this to False will
-            significantly increase speed of the bind.
+            significantly increase speed of the bind. If the "persistent_cache"
+            config value is set, this information is cached on disk and only
+            downloaded again when the server's schema changes.
         :return: Returns a directory binding used to perform operations on a
             directory.
         '''
@@ -132,19 +350,35 @@ class Connection(ldap3.Connection):
         conf.pop('binddn', None)
         conf.pop('bindpw', None)
         self.conf = conf
+        self._allocators = {}
+        # IDs used by asynchronous adds still awaiting a result, by message id
+        self._pending_ids = {}
+        self._base_dn = None
+        self.cache = None
 
         # for whatever reason, ldap3 can't deal with ldap:/// identifiers
         host = clean_uri(host)
-        if server_info:
+        self.host = host
+        # server info is loaded from the on-disk cache after binding instead
+        cached_info = server_info and conf.get('persistent_cache', False) \
+            and client_strategy == ldap3.SYNC
+        if server_info and not cached_info:
             self.server = ldap3.Server(host, get_info=ldap3.ALL)
         else:
             self.server = ldap3.Server(host, get_info=ldap3.NONE)
 
-        if supports_starttls(host):
+        # the TLS mode may be declared in the config to skip probing entirely
+        starttls = conf.get('starttls')
+        if starttls is None:
+            starttls = supports_starttls(host,
+                persist=conf.get('persistent_cache', False))
+            if not starttls:
+                print(fmt('Warning: server does not appear to support SSL/StartTLS, '
+                    'proceeding without...', color='yellow'), file=sys.stderr)
+
+        if starttls:
             auto_bind_mode = ldap3.AUTO_BIND_TLS_BEFORE_BIND
         else:
-            print(fmt('Warning: server does not appear to support SSL/StartTLS, '
-                'proceeding without...', color='yellow'), file=sys.stderr)
             auto_bind_mode = ldap3.AUTO_BIND_NO_TLS
 
         if user is None or password is None:
@@ -158,6 +392,65 @@ class Connection(ldap3.Connection):
                 sasl_mechanism=sasl_mechanism, sasl_credentials=sasl_credentials,
                 client_strategy=client_strategy, auto_bind=auto_bind_mode)
 
+        # ldap3 assigns get_response per connection, so wrap it here
+        self._strategy_get_response = self.get_response
+        self.get_response = self._get_response
+
+        if cached_info:
+            self._load_server_info()
+
+    def _read_entry(self, dn, attributes, search_filter='(objectClass=*)'):
+        '''
+        Read the attributes of a single entry, returns None if it was not found.
+        '''
+        msgid = self.search(dn, search_filter, search_scope=ldap3.BASE,
+            attributes=attributes)
+        if self.strategy.sync:
+            response = self.response
+        else:
+            response, _ = self.get_response(msgid)
+
+        for res in response or []:
+            if res['type'] == 'searchResEntry':
+                return res['attributes']
+
+        return None
+
+    def _load_server_info(self):
+        '''
+        Load the server info and schema from ~/.ezldap/cache/, downloading
+        them only if the schema's modifyTimestamp differs from the cached copy.
+        '''
+        root = self._read_entry('', ['subschemaSubentry'])
+        schema_dn = root.get('subschemaSubentry') if root else None
+        if isinstance(schema_dn, list):
+            schema_dn = schema_dn[0] if schema_dn else None
+
+        timestamp = None
+        if schema_dn:
+            schema = self._read_entry(schema_dn, ['modifyTimestamp'],
+                search_filter='(objectClass=subschema)')
+            if schema and schema.get('modifyTimestamp'):
+                timestamp = str(schema['modifyTimestamp'][0])
+
+        name = '{}.schema.json'.format(host_key(self.host))
+        cached = cache_read(name)
+        if timestamp is not None and cached.get('modifyTimestamp') == timestamp:
+            schema_info = SchemaInfo.from_json(cached['schema'])
+            self.server.attach_schema_info(schema_info)
+            self.server.attach_dsa_info(DsaInfo.from_json(cached['info'],
+                schema=schema_info))
+            return
+
+        self.server.get_info = ldap3.ALL
+        self.refresh_server_info()
+        self.server.get_info = ldap3.NONE
+        if timestamp is not None and self.server.info and self.server.schema:
+            cache_write(name, {
+                'modifyTimestamp': timestamp,
+                'info': self.server.info.to_json(),
+                'schema': self.server.schema.to_json()})
+
     def __enter__(self):
         return self
 
@@ -175,12 +468,88 @@ class Connection(ldap3.Connection):
 
     def base_dn(self):
         '''
-        Detect the base DN/naming context from an LDAP connection.
+        Detect the base DN/naming context from an LDAP connection. If server
+        info was not fetched when binding, the rootDSE is queried once instead.
+        '''
+        if self.server.info is not None and self.server.info.naming_contexts:
+            return self.server.info.naming_contexts[0]
+
+        if self._base_dn is None:
+            root = self._cached(('namingContexts',),
+                lambda: self._read_entry('', ['namingContexts']))
+            if not root or not root.get('namingContexts'):
+                raise ValueError('Could not determine the base DN of the directory.')
+
+            if self.cache is not None:
+                # the cache decides how long the naming context is kept
+                return root['namingContexts'][0]
+
+            self._base_dn = root['namingContexts'][0]
+
+        return self._base_dn
+
+    def enable_cache(self, max_size=1024, ttl=60):
+        '''
+        Cache the results of get_user(), get_group(), get_host() and naming
+        context lookups made through this connection. Cached entries are
+        dropped when this connection adds, modifies, deletes or renames them,
+        but changes made by other clients are only seen once ttl expires.
+        Returns the ezldap.cache.EntryCache used, whose stats() method reports
+        hits and misses.
+
+        :param max_size: Maximum number of lookups cached.
+        :param ttl: Seconds a lookup is cached for.
+        '''
+        self.cache = EntryCache(max_size=max_size, ttl=ttl)
+        return self.cache
+
+    def disable_cache(self):
+        '''
+        Stop caching lookups and drop everything cached so far.
         '''
-        return self.server.info.naming_contexts[0]
+        self.cache = None
+
+    def _cached(self, key, load):
+        '''
+        Return load(), or a copy of its cached result if caching is enabled.
+        '''
+        if self.cache is None:
+            return load()
+
+        found, value = self.cache.get(key)
+        if not found:
+            value = load()
+            self.cache.put(key, value)
+
+        return copy.deepcopy(value)
+
+    def _invalidate(self, dn):
+        '''
+        Drop cached entries at or below dn, along with cached misses (which
+        a new entry might now satisfy).
+        '''
+        if self.cache is None:
+            return
+
+        key = _dn_key(dn)
+        if key is None:
+            self.cache.discard()
+            return
+
+        def stale(value):
+            if value is None:
+                return True
+            elif not isinstance(value, dict) or 'dn' not in value:
+                return False
+
+            entry_key = _dn_key(value['dn'][0])
+            return entry_key is None or entry_key[len(entry_key) - len(key):] == key
+
+        self.cache.discard(stale)
 
     def search_list(self, search_filter='(objectClass=*)',
-                    attributes=ldap3.ALL_ATTRIBUTES, search_base=None, **kwargs):
+                    attributes=ldap3.ALL_ATTRIBUTES, search_base=None,
+                    stream=False, page_size=500, **kwargs):
         '''
         A wrapper around search() with better defaults and output format.
         A list of dictionaries will be returned, with one dict per output
@@ -190,115 +559,594 @@ class Connection(ldap3.Connection):
         :param attributes: Attributes to return. If not specified,
             all defaults will be returned. None will return no attributes.
         :param search_base: Level of directory to begin search at, for example ou=People.
+        :param stream: Return a generator that fetches results one page at a
+            time instead of a list (see iter_search()).
+        :param page_size: Number of entries fetched per page when streaming.
         :return: A list of dicts, one per entry returned.
         '''
+        if stream:
+            return self.iter_search(search_filter, attributes=attributes,
+                search_base=search_base, page_size=page_size, **kwargs)
+
+        return [_normalize_entry(res) for res in self._responses(search_filter,
+            attributes, search_base, **kwargs)]
+
+    def _responses(self, search_filter, attributes, search_base, stream=False,
+                   page_size=500, **kwargs):
+        '''
+        Run a search and yield the raw ldap3 response for each entry found,
+        either from a single search or fetched in pages.
+        '''
         if search_base is None:
             search_base = self.base_dn()
 
-        self.search(search_base, search_filter, attributes=attributes, **kwargs)
-        query = []
-        for res in self.response:
-            result = {'dn': [res['dn']]}
-            # ensure every attribute is encapsulated in a list
-            for k, v in res['attributes'].items():
-                if not isinstance(v, list):
-                    res['attributes'][k] = [v]
+        if stream:
+            responses = self.extend.standard.paged_search(search_base,
+                search_filter, attributes=attributes, paged_size=page_size,
+                generator=True, **kwargs)
+        else:
+            self.search(search_base, search_filter, attributes=attributes, **kwargs)
+            responses = self.response
 
-            result.update(res['attributes'])
-            query.append(result)
+        for res in responses:
+            if res['type'] == 'searchResEntry':
+                yield res
 
-        return query
+    def iter_search(self, search_filter='(objectClass=*)',
+                    attributes=ldap3.ALL_ATTRIBUTES, search_base=None,
+                    page_size=500, **kwargs):
+        '''
+        A generator version of search_list(). Results are fetched from the
+        server in pages of page_size entries using the simple paged results
+        control (RFC 2696), so memory use is bounded by the page size rather
+        than the number of entries returned, and server size limits are not
+        hit on large directories.
+
+        :param search_filter: An LDAP search filter.
+        :param attributes: Attributes to return. If not specified,
+            all defaults will be returned. None will return no attributes.
+        :param search_base: Level of directory to begin search at, for example ou=People.
+        :param page_size: Number of entries to fetch per page.
+        :return: A generator of dicts, one per entry returned.
+        '''
+        for res in self._responses(search_filter, attributes, search_base,
+                stream=True, page_size=page_size, **kwargs):
+            yield _normalize_entry(res)
+
+    def _iter_dns(self, search_filter, search_base, page_size):
+        for entry in self.iter_search(search_filter, attributes=ldap3.NO_ATTRIBUTES,
+                search_base=search_base, page_size=page_size):
+            yield entry['dn'][0]
+
+    def search_dn(self, keyword='', regex=False, ignore_case=False,
+                  search_base=None, rdn_attributes=RDN_ATTRIBUTES, page_size=500):
+        '''
+        Find the DNs that contain a keyword. DNs are returned by a generator as
+        they are found.
+
+        The keyword is searched for on the server with a substring filter on
+        the attributes entries are usually named by (rdn_attributes), and
+        matches are returned as each page arrives. Every entry below a match
+        also matches, so the rest of them are fetched afterwards with one more
+        search under the closest ancestor shared by the top-most matches. Only
+        the matches that may have children are kept in memory until then:
+        those the server reports with hasSubordinates, or every match if the
+        server does not support it. Entries whose own RDN uses an attribute
+        missing from rdn_attributes are only found if a parent matches. For
+        regular expressions and keywords spanning several RDNs (containing
+        "," or "=") every DN is scanned instead, one page at a time.
+
+        :param keyword: Text (or a regular expression) to search for.
+        :param regex: Treat the keyword as a regular expression.
+        :param ignore_case: Match regardless of case.
+        :param search_base: Where to search. If None, the directory base DN
+            will be used.
+        :param rdn_attributes: Attributes searched for the keyword.
+        :param page_size: Number of entries fetched per page.
+        :return: A generator of matching DNs.
+        :raises ValueError: If regex is True and keyword is not a valid
+            regular expression.
+        '''
+        if regex:
+            try:
+                pattern = re.compile(keyword, re.IGNORECASE if ignore_case else 0)
+            except re.error as e:
+                raise ValueError('Invalid regular expression "{}": {}'
+                    .format(keyword, e)) from e
+
+            match = lambda dn: pattern.search(dn) is not None
+        elif ignore_case:
+            match = lambda dn: keyword.lower() in dn.lower()
+        else:
+            match = lambda dn: keyword in dn
+
+        # compile the pattern before the generator starts, so errors are raised
+        # when search_dn() is called
+        return self._search_dn(keyword, match, regex, search_base,
+            rdn_attributes, page_size)
+
+    def _search_dn(self, keyword, match, regex, search_base, rdn_attributes,
+                   page_size):
+        if search_base is None:
+            search_base = self.base_dn()
+
+        if regex or keyword.strip() != keyword or keyword == '' \
+                or _DN_SPECIAL & set(keyword) or match(search_base):
+            # no filter can narrow this down, check every DN
+            for dn in self._iter_dns('(objectClass=*)', search_base, page_size):
+                if match(dn):
+                    yield dn
+
+            return
+
+        terms = []
+        for attribute in rdn_attributes:
+            if keyword.lower() in attribute.lower():
+                # the keyword matches the attribute name itself ("uid=...")
+                terms.append('({}=*)'.format(attribute))
+            else:
+                terms.append('({}=*{}*)'.format(attribute,
+                    escape_filter_chars(keyword)))
+
+        # entries without children need no further searches, if the server
+        # can tell us which ones those are
+        schema = self.server.schema
+        attributes = ['hasSubordinates'] if schema is None \
+            or 'hasSubordinates' in schema.attribute_types else ldap3.NO_ATTRIBUTES
+
+        # substring filters ignore case and match any value, not just the one
+        # in the RDN, so the DNs returned still need to be checked
+        parents = {}
+        for entry in self.iter_search('(|{})'.format(''.join(terms)),
+                attributes, search_base, page_size):
+            dn = entry['dn'][0]
+            if match(dn):
+                yield dn
+                # a boolean with the server schema loaded, "FALSE" without
+                leaf = [str(v).upper() for v in entry.get('hasSubordinates', [])]
+                if leaf != ['FALSE']:
+                    parents[','.join(to_dn(dn.lower()))] = dn
+
+        if not parents:
+            return
+
+        # ancestors have shorter keys, so they are always seen first
+        top_most = set()
+        common = None
+        for key in sorted(parents, key=len):
+            rdns = to_dn(key)
+            if any(','.join(rdns[i:]) in top_most for i in range(1, len(rdns))):
+                continue
+
+            top_most.add(key)
+            names = to_dn(parents[key])
+            if common is None:
+                common = names
+            else:
+                # shrink to the closest ancestor shared with this match
+                size = min(len(common), len(names))
+                while size and [n.lower() for n in common[-size:]] != \
+                        [n.lower() for n in names[-size:]]:
+                    size -= 1
+
+                common = common[len(common) - size:]
+
+        # every entry below a match also matches, and the ones matching the
+        # filter were already returned, so fetch the rest in a single search
+        exclude = '(&{})'.format(''.join('(!{})'.format(t) for t in terms))
+        for dn in self._iter_dns(exclude, ','.join(common) or search_base,
+                page_size):
+            rdns = to_dn(dn.lower())
+            if any(','.join(rdns[i:]) in top_most for i in range(1, len(rdns))):
+                yield dn
 
     def search_list_t(self, search_filter='(objectClass=*)',
                       attributes=ldap3.ALL_ATTRIBUTES, search_base=None,
-                      unpack_lists=True, unpack_delimiter='|', **kwargs):
+                      unpack_lists=True, unpack_delimiter='|', explode=None,
+                      stream=False, page_size=500, **kwargs):
         '''
         A utility function that returns the transposed result of search_list()
         (a dict of lists, with one list per attribute.)
         This is very useful for tasks like retrieving all uidNumbers currently
         assigned or emails used by users. The DN of each entry is always output.
+        Columns are filled directly from the search results in a single pass.
+
+        :param unpack_lists: Return single values as-is and join multiple
+            values into a string with unpack_delimiter. If False, every value
+            is kept as a list.
+        :param explode: An attribute (or list of attributes) whose values are
+            each given their own row, with the entry's other values repeated.
+        :param stream: Fetch results in pages of page_size entries instead of
+            with a single search.
         '''
-        response = self.search_list(search_filter, attributes=attributes,
-            search_base=search_base, **kwargs)
-
-        all_attribs = {'dn'}
-        if attributes == ldap3.ALL_ATTRIBUTES:
-            # iterate through and determine all possible attributes returned
-            for res in response:
-                all_attribs.update(res.keys())
-        elif attributes is None:
-            # skip over this case, we do not want a list of None
-            pass
-        else:
-            if not isinstance(attributes, list):
-                attributes = [attributes]
-
-            all_attribs.update(attributes)
-
-        query = {attrib: [] for attrib in all_attribs}
-
-        for res in response:
-            for k in all_attribs:
-                try:
-                    v = res[k]
-                    if unpack_lists and isinstance(v, list):
-                        if len(v) > 1:
-                            # coerces to string
-                            v = unpack_delimiter.join([str(x) for x in v])
-                        else:
-                            # string coercion avoided for 1-element lists
-                            v = v[0]
-
-                except KeyError:
-                    v = None
+        builder = ColumnBuilder(attributes, unpack_lists=unpack_lists,
+            unpack_delimiter=unpack_delimiter, explode=explode)
+        for res in self._responses(search_filter, attributes, search_base,
+                stream=stream, page_size=page_size, **kwargs):
+            builder.add(res['dn'], res['attributes'])
 
-                query[k].append(v)
-
-        return query
+        return builder.columns()
 
     def search_df(self, search_filter='(objectClass=*)',
-                  attributes=ldap3.ALL_ATTRIBUTES, search_base=None, **kwargs):
+                  attributes=ldap3.ALL_ATTRIBUTES, search_base=None,
+                  typed=False, **kwargs):
         '''
         A convenience function to search an LDAP directory and return a Pandas
         DataFrame. Very useful for analyzing the contents of your directory,
         computing stats, etc. Requires the pandas package to be installed.
+        Extra keyword arguments (such as unpack_lists, explode or stream) are
+        passed to search_list_t().
+
+        :param typed: Use the server schema to give integer, timestamp and
+            boolean attributes a matching dtype (for instance uidNumber becomes
+            Int64). Columns holding multiple values are left as-is. Off by
+            default, so columns hold the same values as search_list_t().
         '''
         try:
-            from pandas import DataFrame
+            import pandas
         except ModuleNotFoundError as e:
             raise ModuleNotFoundError('This function requires the pandas package to be installed.') from e
 
         query = self.search_list_t(search_filter, attributes=attributes,
             search_base=search_base, **kwargs)
-        return DataFrame(query)
+        df = pandas.DataFrame(query)
+        if not typed:
+            return df
+
+        return typed_dataframe(df, column_types(self.server.schema, df.columns))
+
+    def _attribute_names(self, search_filter, attributes, search_base,
+                         page_size, **kwargs):
+        '''
+        Return the attribute names a search would return. If attributes
+        includes "*" or "+", the names are discovered with a paged search that
+        only returns attribute types (not values).
+        '''
+        if attributes is None:
+            return []
+        elif isinstance(attributes, str):
+            attributes = [attributes]
+
+        names = [name for name in attributes if name not in ('*', '+', '1.1')]
+        if '*' not in attributes and '+' not in attributes:
+            return names
+
+        seen = {name.lower() for name in names}
+        for res in self._responses(search_filter, attributes, search_base,
+                stream=True, page_size=page_size, types_only=True, **kwargs):
+            for name in res['attributes']:
+                if name.lower() not in seen:
+                    seen.add(name.lower())
+                    names.append(name)
+
+        return names
+
+    def _column_batches(self, search_filter, attributes, search_base,
+                        unpack_lists, unpack_delimiter, batch_size, page_size,
+                        **kwargs):
+        '''
+        Yield the column names, then the columns of every batch_size entries
+        from a paged search. Every batch has the same columns.
+        '''
+        names = self._attribute_names(search_filter, attributes, search_base,
+            page_size, **kwargs)
+        yield ['dn'] + names
+
+        builder = ColumnBuilder(names, unpack_lists=unpack_lists,
+            unpack_delimiter=unpack_delimiter)
+        for res in self._responses(search_filter, attributes, search_base,
+                stream=True, page_size=page_size, **kwargs):
+            builder.add(res['dn'], res['attributes'])
+            if builder.rows >= batch_size:
+                yield builder.flush()
+
+        if builder.rows > 0:
+            yield builder.flush()
+
+    def _arrow_batches(self, search_filter, attributes, search_base,
+                       unpack_lists, unpack_delimiter, batch_size, page_size,
+                       **kwargs):
+        '''
+        Return the pyarrow schema of a search and a generator of its
+        RecordBatches.
+        '''
+        if importlib.util.find_spec('pyarrow') is None:
+            raise ModuleNotFoundError('This function requires the pyarrow package to be installed.')
+
+        batches = self._column_batches(search_filter, attributes, search_base,
+            unpack_lists, unpack_delimiter, batch_size, page_size, **kwargs)
+        names = next(batches)
+        schema = arrow_schema(self.server.schema, names, unpack_lists)
+        types = column_types(self.server.schema, names,
+            single_valued=unpack_lists)
+        return schema, (record_batch(columns, schema, types) for columns in batches)
+
+    def iter_arrow(self, search_filter='(objectClass=*)',
+                   attributes=ldap3.ALL_ATTRIBUTES, search_base=None,
+                   unpack_lists=True, unpack_delimiter='|', batch_size=10000,
+                   page_size=500, **kwargs):
+        '''
+        Search a directory and yield the results as pyarrow RecordBatches of up
+        to batch_size entries each, so that large trees can be processed with
+        bounded memory. Results are fetched in pages of page_size entries.
+        Requires the pyarrow package to be installed.
+
+        Integer, timestamp, boolean and binary attributes are given a matching
+        arrow type using the server schema, all other attributes are strings.
+        If attributes includes "*" or "+", the columns are found with an extra
+        (attribute names only) search first, so that every batch has the same
+        schema.
+
+        :param unpack_lists: Return single values as-is and join multiple
+            values into a string with unpack_delimiter. If False, every column
+            is a list.
+        :param batch_size: Number of entries per RecordBatch.
+        '''
+        _, batches = self._arrow_batches(search_filter, attributes, search_base,
+            unpack_lists, unpack_delimiter, batch_size, page_size, **kwargs)
+        yield from batches
+
+    def search_arrow(self, search_filter='(objectClass=*)',
+                     attributes=ldap3.ALL_ATTRIBUTES, search_base=None,
+                     **kwargs):
+        '''
+        Like search_df(), but returns a pyarrow Table. Requires the pyarrow
+        package to be installed. Extra keyword arguments (such as unpack_lists
+        or batch_size) are passed to iter_arrow().
+        '''
+        schema, batches = self._arrow_batches(search_filter, attributes,
+            search_base, kwargs.pop('unpack_lists', True),
+            kwargs.pop('unpack_delimiter', '|'), kwargs.pop('batch_size', 10000),
+            kwargs.pop('page_size', 500), **kwargs)
+        import pyarrow
+        return pyarrow.Table.from_batches(list(batches), schema=schema)
+
+    def export(self, path, format=None, search_filter='(objectClass=*)',
+               attributes=ldap3.ALL_ATTRIBUTES, search_base=None,
+               unpack_lists=True, unpack_delimiter='|', batch_size=10000,
+               page_size=500, **kwargs):
+        '''
+        Write a snapshot of a directory to a Parquet, Arrow IPC or CSV file.
+        Entries are written batch_size at a time as they are fetched, so the
+        whole directory is never held in memory. Arrow files can be
+        memory-mapped with pyarrow.memory_map() and pyarrow.ipc.open_file().
+        Parquet and Arrow files require the pyarrow package to be installed.
+
+        :param path: File to write.
+        :param format: "parquet", "arrow" or "csv". If None, the format is
+            guessed from the file extension.
+        :return: The number of rows written.
+        '''
+        if format is None:
+            format = EXPORT_FORMATS.get(os.path.splitext(path)[1].lower())
+            if format is None:
+                raise ValueError('Could not guess the export format of "{}", '
+                    'use one of: parquet, arrow, csv.'.format(path))
+        elif format not in EXPORT_FORMATS.values():
+            raise ValueError('Unknown export format "{}", use one of: parquet, '
+                'arrow, csv.'.format(format))
+
+        rows = 0
+        if format == 'csv':
+            batches = self._column_batches(search_filter, attributes,
+                search_base, True, unpack_delimiter, batch_size, page_size,
+                **kwargs)
+            with open(path, 'w', newline='') as handle:
+                writer = csv.writer(handle)
+                writer.writerow(next(batches))
+                for columns in batches:
+                    for row in zip(*columns.values()):
+                        writer.writerow([to_string(v) for v in row])
+                        rows += 1
+
+            return rows
+
+        schema, batches = self._arrow_batches(search_filter, attributes,
+            search_base, unpack_lists, unpack_delimiter, batch_size, page_size,
+            **kwargs)
+        if format == 'parquet':
+            import pyarrow.parquet
+            writer = pyarrow.parquet.ParquetWriter(path, schema)
+        else:
+            import pyarrow.ipc
+            writer = pyarrow.ipc.new_file(path, schema)
+
+        with writer:
+            for batch in batches:
+                writer.write_batch(batch)
+                rows += batch.num_rows
+
+        return rows
 
     def exists(self, dn):
         '''
-        Returns true if a given DN exists in an LDAP directory.
+        Returns true if a given DN exists in an LDAP directory. No attributes
+        are requested, so only the DN of the entry is sent back.
         '''
-        query = self.search_list(search_base=dn, search_scope=ldap3.BASE)
+        query = self.search_list(search_base=dn, search_scope=ldap3.BASE,
+            attributes=ldap3.NO_ATTRIBUTES)
         if len(query) == 1:
             return True
         else:
             return False
 
+    def exists_many(self, dns, chunk_size=200, max_in_flight=16):
+        '''
+        Check whether many DNs exist at once. Returns the set of DNs (from dns)
+        that exist in the directory.
+
+        On connections using an asynchronous client strategy (like ldap3.ASYNC),
+        a base search is sent for each DN with up to max_in_flight searches
+        pipelined at once. Otherwise, DNs are grouped by their parent entry
+        and looked up with one search per chunk_size DNs under each parent.
+        Either way, no attributes are requested.
+        '''
+        # invalid DNs can't exist (and ldap3 refuses to search for them)
+        dns = [dn for dn in dict.fromkeys(dns) if _dn_key(dn) is not None]
+        if not self.strategy.sync:
+            results = self._send_all(lambda dn: self.search(dn, '(objectClass=*)',
+                search_scope=ldap3.BASE, attributes=ldap3.NO_ATTRIBUTES),
+                dns, max_in_flight)
+            return {dn for dn, result in zip(dns, results)
+                if result['result'] == 0}
+
+        # requested DNs, keyed by parent and then by normalized DN
+        by_parent = collections.defaultdict(dict)
+        for dn in dns:
+            split = _split_dn(dn)
+            if split is not None:
+                rdn, parent = split
+                by_parent[parent].setdefault(_dn_key(dn), []).append((dn, rdn))
+
+        found = set()
+        for parent, wanted in by_parent.items():
+            if parent == '':
+                # entries without a parent can only be found with base searches
+                found.update(dn for entries in wanted.values()
+                    for dn, _ in entries if self.exists(dn))
+                continue
+
+            terms = []
+            for entries in wanted.values():
+                _, rdn = entries[0]
+                terms.append('(&{})'.format(''.join('({}={})'.format(attribute,
+                    escape_filter_chars(value)) for attribute, value in rdn)))
+
+            for i in range(0, len(terms), chunk_size):
+                search_filter = '(|{})'.format(''.join(terms[i:i + chunk_size]))
+                for res in self._responses(search_filter, ldap3.NO_ATTRIBUTES,
+                        parent, search_scope=ldap3.LEVEL):
+                    for dn, _ in wanted.get(_dn_key(res['dn']), []):
+                        found.add(dn)
+
+        return found
+
+    def id_allocator(self, search_filter='(objectClass=posixAccount)',
+        search_base=None, id_start=10000, attribute='uidNumber', **kwargs):
+        '''
+        Return the IDAllocator for a given set of search parameters. Allocators
+        are created once per connection, so the directory is only scanned the
+        first time a given kind of ID is requested. Extra keyword arguments
+        (fill_gaps, counter_dn, counter_attribute) are passed to IDAllocator()
+        when it is first created.
+        '''
+        key = (search_filter, search_base, id_start, attribute)
+        if key not in self._allocators:
+            self._allocators[key] = IDAllocator(self, search_filter,
+                search_base, id_start, attribute, **kwargs)
+
+        return self._allocators[key]
+
+    def reset_allocators(self):
+        '''
+        Forget the ID numbers known to be used, so the directory is scanned
+        again the next time an ID is requested. Use this when other clients may
+        have added entries since this connection last allocated an ID.
+        '''
+        self._allocators.clear()
+
     def next_uidn(self, search_filter='(objectClass=posixAccount)',
-        search_base=None, uid_start=10000, uid_attribute='uidNumber'):
+        search_base=None, uid_start=10000, uid_attribute='uidNumber',
+        reserve=False):
         """
-        Determine the next available uid number in a directory tree.
+        Determine the next available uid number in a directory tree. The
+        directory is only scanned the first time this is called. If reserve is
+        True, the uid number is marked as taken and will not be returned again.
+        The "uid_counter_dn" and "fill_id_gaps" config values control how
+        numbers are allocated (see IDAllocator).
         """
-        users = self.search_list_t(search_filter, uid_attribute, search_base=search_base)
-        if len(users['dn']) == 0:
-            return uid_start
+        allocator = self.id_allocator(search_filter, search_base, uid_start,
+            uid_attribute, fill_gaps=self.conf.get('fill_id_gaps', False),
+            counter_dn=self.conf.get('uid_counter_dn'))
+        if reserve:
+            return allocator.allocate()
 
-        return max(users[uid_attribute]) + 1
+        return allocator.peek()
 
     def next_gidn(self, search_filter='(objectClass=posixGroup)',
-        search_base=None, gid_start=10000, gid_attribute='gidNumber'):
+        search_base=None, gid_start=10000, gid_attribute='gidNumber',
+        reserve=False):
         """
         Determine the next available gid number in a directory tree.
+        The "gid_counter_dn" and "fill_id_gaps" config values control how
+        numbers are allocated (see IDAllocator).
         """
-        return self.next_uidn(search_filter, search_base, gid_start, gid_attribute)
+        allocator = self.id_allocator(search_filter, search_base, gid_start,
+            gid_attribute, fill_gaps=self.conf.get('fill_id_gaps', False),
+            counter_dn=self.conf.get('gid_counter_dn'))
+        if reserve:
+            return allocator.allocate()
+
+        return allocator.peek()
+
+    def add(self, dn, object_class=None, attributes=None, controls=None):
+        '''
+        Add an entry to the directory (see ldap3.Connection.add()). Once the
+        add succeeds, any IDs used by the new entry are marked as taken in this
+        connection's ID allocators. On asynchronous connections, this happens
+        when the result is read with get_response().
+        '''
+        success = super().add(dn, object_class, attributes, controls)
+        self._invalidate(dn)
+        if attributes and self._allocators:
+            if self.strategy.sync:
+                if success:
+                    self._mark_ids_used(attributes)
+            elif success:
+                # success is the message id of the request
+                self._pending_ids[success] = attributes
+
+        return success
+
+    def _mark_ids_used(self, attributes):
+        for allocator in self._allocators.values():
+            values = attributes.get(allocator.attribute, [])
+            if not isinstance(values, list):
+                values = [values]
+
+            for value in values:
+                allocator.mark_used(value)
+
+    def _get_response(self, message_id, *args, **kwargs):
+        '''
+        ldap3's get_response(), which also marks the IDs used by a pending
+        asynchronous add once it is known to have succeeded.
+        '''
+        attributes = self._pending_ids.get(message_id)
+        response = self._strategy_get_response(message_id, *args, **kwargs)
+        # only forget the add once its response has actually been read
+        self._pending_ids.pop(message_id, None)
+        if attributes is not None and response[1] is not None and \
+                response[1]['result'] == 0:
+            self._mark_ids_used(attributes)
+
+        return response
+
+    def modify(self, dn, changes, controls=None):
+        '''
+        Modify an entry (see ldap3.Connection.modify()).
+        '''
+        result = super().modify(dn, changes, controls)
+        self._invalidate(dn)
+        return result
+
+    def delete(self, dn, controls=None):
+        '''
+        Delete an entry (see ldap3.Connection.delete()).
+        '''
+        result = super().delete(dn, controls)
+        self._invalidate(dn)
+        return result
+
+    def modify_dn(self, dn, relative_dn, delete_old_dn=True, new_superior=None,
+                  controls=None):
+        '''
+        Rename or move an entry (see ldap3.Connection.modify_dn()).
+        '''
+        result = super().modify_dn(dn, relative_dn, delete_old_dn,
+            new_superior, controls)
+        self._invalidate(dn)
+        return result
 
     def _conf_basedn_key(self, key):
         '''
@@ -317,10 +1165,13 @@ class Connection(ldap3.Connection):
         if basedn is None:
             basedn = self._conf_basedn_key('peopledn')
 
-        try:
-            return self.search_list('({}={})'.format(index, user), search_base=basedn)[0]
-        except IndexError:
-            return None
+        def load():
+            try:
+                return self.search_list('({}={})'.format(index, user), search_base=basedn)[0]
+            except IndexError:
+                return None
+
+        return self._cached(('entry', basedn, index, user), load)
 
     def get_group(self, group, basedn=None, index='cn'):
         '''
@@ -340,31 +1191,247 @@ class Connection(ldap3.Connection):
 
         return self.get_user(host, basedn=basedn, index=index)
 
-    def ldif_add(self, ldif):
-        """
-        Perform an add operation using an LDIF object.
-        """
+    def get_users(self, users, basedn=None, index='uid', chunk_size=200):
+        '''
+        Look up many users at once, with one search per chunk_size names.
+        Returns a dict of {name: entry}, where entry is None if no user was
+        found, so missing names are easy to report. Names are matched
+        regardless of case. Searches entire directory if no base search dn
+        given.
+        '''
+        if basedn is None:
+            basedn = self._conf_basedn_key('peopledn')
+
+        # names are searched for as given, but the index attribute may match
+        # regardless of case, so results are matched back by lowercased value
+        results = {str(name): None for name in users}
+        wanted = collections.defaultdict(list)
+        for name in results:
+            wanted[name.lower()].append(name)
+
+        names = list(results)
+        for i in range(0, len(names), chunk_size):
+            search_filter = '(|{})'.format(''.join('({}={})'.format(index,
+                escape_filter_chars(name)) for name in names[i:i + chunk_size]))
+            for res in self._responses(search_filter, ldap3.ALL_ATTRIBUTES, basedn):
+                entry = _normalize_entry(res)
+                values = next((v for k, v in entry.items()
+                    if k.lower() == index.lower()), [])
+                for value in values:
+                    for name in wanted.get(str(value).lower(), []):
+                        if results[name] is None:
+                            results[name] = entry
+
+        return results
+
+    def get_groups(self, groups, basedn=None, index='cn', chunk_size=200):
+        '''
+        Look up many groups at once, like get_users(). Searches entire
+        directory if no base search dn given.
+        '''
+        if basedn is None:
+            basedn = self._conf_basedn_key('groupdn')
+
+        return self.get_users(groups, basedn=basedn, index=index,
+            chunk_size=chunk_size)
+
+    def get_hosts(self, hosts, basedn=None, index='cn', chunk_size=200):
+        '''
+        Look up many hosts at once, like get_users(). Searches entire
+        directory if no base search dn given.
+        '''
+        if basedn is None:
+            basedn = self._conf_basedn_key('hostsdn')
+
+        return self.get_users(hosts, basedn=basedn, index=index,
+            chunk_size=chunk_size)
+
+    def _send_all(self, operation, entries, max_in_flight):
+        '''
+        Call operation(entry) for each entry and return the result of each
+        operation in order. On connections using an asynchronous client strategy
+        (like ldap3.ASYNC), up to max_in_flight operations are sent before
+        waiting on the first result, so throughput is not limited by the round
+        trip time to the server.
+        '''
         results = []
-        for entry in ldif:
-            entry_cp = copy.deepcopy(entry)
-            dn = entry_cp.pop('dn')[0]
-            #TODO fix for 389 directory server and "objectClasses"
-            objectclass = entry_cp.pop('objectClass')
-            self.add(dn=dn, object_class=objectclass, attributes=entry_cp)
-            results.append(self.result)
+        if self.strategy.sync:
+            for entry in entries:
+                operation(entry)
+                results.append(self.result)
+
+            return results
+
+        in_flight = collections.deque()
+        for entry in entries:
+            in_flight.append(operation(entry))
+            if len(in_flight) >= max_in_flight:
+                results.append(self.get_response(in_flight.popleft())[1])
+
+        while in_flight:
+            results.append(self.get_response(in_flight.popleft())[1])
 
         return results
 
-    def ldif_modify(self, ldif):
+    def ldif_add(self, ldif, max_in_flight=16):
+        """
+        Perform an add operation using an LDIF object (any iterable of entries,
+        including generators like ldif_iter()). Entries are not modified. If
+        the connection was created with client_strategy=ldap3.ASYNC, up to
+        max_in_flight adds are pipelined over the connection at once. Results
+        are returned in the same order as the LDIF entries.
+        """
+        return self._send_all(lambda entry: _ldif_add_entry(self, entry), ldif,
+            max_in_flight)
+
+    def ldif_modify(self, ldif, max_in_flight=16):
         """
-        Perform an LDIF modify operation from an LDIF object.
+        Perform an LDIF modify operation from an LDIF object. Delete and modrdn
+        records are performed as delete and modify DN operations. Modifications
+        are pipelined on asynchronous connections, like ldif_add().
         """
+        return self._send_all(lambda entry: _ldif_modify_entry(self, entry),
+            ldif, max_in_flight)
+
+    def sync_plan(self, entries, search_base=None, search_scope=ldap3.SUBTREE,
+                  search_filter='(objectClass=*)', attributes=None,
+                  delete=False, page_size=500):
+        '''
+        Work out the changes needed to make the directory match a list of
+        desired entries, without changing anything. The current state of the
+        directory is fetched with a single paged search. See sync() for the
+        parameters.
+
+        :return: A list of LDIF change records, in the format used by
+            ldif_modify(): adds (parents before children), then modifies, then
+            deletes (children before parents).
+        '''
+        if search_base is None:
+            search_base = self.base_dn()
+
+        base_key = _dn_key(search_base)
+        depths = {ldap3.BASE: [0], ldap3.LEVEL: [1]}.get(search_scope)
+        desired = {}
+        for entry in entries:
+            key = _dn_key(entry['dn'][0])
+            if key is None or key[len(key) - len(base_key):] != base_key or \
+                    (depths is not None and len(key) - len(base_key) not in depths):
+                raise ValueError('"{}" is not a valid DN in the scope of "{}".'.format(
+                    entry['dn'][0], search_base))
+            elif key in desired:
+                raise ValueError('"{}" is listed more than once.'.format(
+                    entry['dn'][0]))
+
+            desired[key] = entry
+
+        # only the attributes that are compared are fetched
+        managed = list(attributes or [])
+        fetch = {}
+        for name in managed + [name for entry in desired.values()
+                for name in entry if name not in ('dn', 'changetype')]:
+            fetch.setdefault(name.lower(), name)
+
+        fetch = list(fetch.values()) or ldap3.NO_ATTRIBUTES
+        adds = []
+        modifies = []
+        deletes = []
+        for res in self._responses(search_filter, fetch, search_base,
+                stream=True, page_size=page_size, search_scope=search_scope):
+            key = _dn_key(res['dn'])
+            entry = desired.pop(key, None)
+            if entry is None:
+                # the search base itself is never deleted
+                if delete and key != base_key:
+                    deletes.append({'dn': [res['dn']], 'changetype': ['delete']})
+
+                continue
+
+            current = {name.lower(): values
+                for name, values in res['raw_attributes'].items()}
+            names = [name for name in entry if name not in ('dn', 'changetype')]
+            lowered = {name.lower() for name in names}
+            names.extend(name for name in managed if name.lower() not in lowered)
+
+            change = {'dn': entry['dn']}
+            for name in names:
+                values = entry.get(name, [])
+                if not isinstance(values, list):
+                    values = [values]
+
+                changes = _diff_values(values, current.get(name.lower(), []))
+                if changes:
+                    change[name] = changes
+
+            if len(change) > 1:
+                modifies.append(change)
+
+        # whatever is left was not found in the directory
+        for entry in desired.values():
+            add = {'dn': entry['dn'], 'changetype': ['add']}
+            add.update((k, v) for k, v in entry.items() if k not in ('dn', 'changetype'))
+            adds.append(add)
+
+        depth = lambda record: len(_dn_key(record['dn'][0]))
+        adds.sort(key=depth)
+        deletes.sort(key=depth, reverse=True)
+        return adds + modifies + deletes
+
+    def sync(self, entries, search_base=None, search_scope=ldap3.SUBTREE,
+             search_filter='(objectClass=*)', attributes=None, delete=False,
+             dry_run=None, workers=4, page_size=500):
+        '''
+        Make the directory match a list of desired entries (for instance, from
+        ldif_read() or a source-of-truth YAML/CSV file), with the fewest
+        changes possible. Entries that are missing are added, and only the
+        attribute values that differ from the desired ones are changed, so
+        entries that are already correct are left alone. Changes are made over
+        up to "workers" connections in parallel (parent entries are always
+        added before their children, and deleted after them).
+
+        :param entries: The desired entries, as dicts of lists with a "dn".
+        :param search_base: Only entries under this DN are synced. Every
+            desired entry must be under it. Defaults to the base DN.
+        :param search_scope: Scope of the search for current entries. Every
+            desired entry must be within it.
+        :param search_filter: Filter for the current entries to compare with.
+            Desired entries must match it.
+        :param attributes: Attributes managed by sync. If given, these
+            attributes are deleted from entries that have values for them but
+            should not. By default, only the attributes present in each
+            desired entry are compared.
+        :param delete: Delete entries found under search_base (and matching
+            search_filter) that are not in entries.
+        :param dry_run: A path or file handle. If given, the changes are
+            written there as a change LDIF (which ezldap modify_ldif can apply
+            later) instead of being made.
+        :param workers: Number of connections changes are made over at once.
+        :return: A list of (change, result) tuples, one per change made. The
+            results are None in a dry run.
+        '''
+        plan = self.sync_plan(entries, search_base=search_base,
+            search_scope=search_scope, search_filter=search_filter,
+            attributes=attributes, delete=delete, page_size=page_size)
+        if dry_run is not None:
+            if isinstance(dry_run, str):
+                ldif_write(plan, dry_run)
+            else:
+                _entries_to_handle(plan, dry_run)
+
+            return [(change, None) for change in plan]
+
+        def apply(con, change):
+            _ldif_modify_entry(con, change)
+            return con.result
+
+        # changes to entries at the same depth never depend on each other
         results = []
-        for entry in ldif:
-            entry_cp = copy.deepcopy(entry)
-            dn = entry_cp.pop('dn')[0]
-            self.modify(dn, entry_cp)
-            results.append(self.result)
+        phases = itertools.groupby(plan, lambda change: (
+            change.get('changetype', ['modify'])[0],
+            0 if _is_modify(change) else len(_dn_key(change['dn'][0]))))
+        for _, changes in phases:
+            changes = list(changes)
+            results.extend(zip(changes, self._parallel_map(apply, changes,
+                workers)))
 
         return results
 
@@ -412,9 +1479,12 @@ class Connection(ldap3.Connection):
         """
         Adds a group from an LDIF template.
         """
-        replace = {'groupname': groupname, 'gid': self.next_gidn()}
+        replace = {'groupname': groupname, 'gid': None}
         replace.update(self.conf)
         replace.update(kwargs)
+        if replace['gid'] is None:
+            replace['gid'] = self.next_gidn(reserve=True)
+
         ldif = ldif_read(ldif_path, replace)
         return self.ldif_add(ldif)
 
@@ -438,7 +1508,7 @@ class Connection(ldap3.Connection):
         '''
         replace = {'username': username,
                    'user_password': ssha_passwd(password),
-                   'uid': self.next_uidn(),
+                   'uid': None,
                    'gid': None}
 
         replace.update(self.conf)
@@ -449,6 +1519,9 @@ class Connection(ldap3.Connection):
             except IndexError:
                 raise ValueError('Group does not exist')
 
+        if replace['uid'] is None:
+            replace['uid'] = self.next_uidn(reserve=True)
+
         ldif = ldif_read(ldif_path, replace)
         return self.ldif_add(ldif)
 
@@ -467,3 +1540,144 @@ class Connection(ldap3.Connection):
         replace.update(kwargs)
         ldif = ldif_read(ldif_path, replace)
         return self.ldif_add(ldif)
+
+    def _parallel_map(self, func, items, workers=4):
+        '''
+        Call func(connection, item) for every item, using up to "workers"
+        connections bound with the same credentials as this one. Results are
+        returned in the same order as items. The worker connections share this
+        connection's entry cache, so their writes invalidate it as well.
+        '''
+        items = list(items)
+        if workers <= 1 or len(items) <= 1:
+            return [func(self, item) for item in items]
+
+        from .pool import ConnectionPool
+        conf = copy.deepcopy(self.conf)
+        conf['starttls'] = self.tls_started
+        pool = ConnectionPool(self.host, user=self.user, password=self.password,
+            conf=conf, min_size=0, max_size=workers,
+            authentication=self.authentication, server_info=False,
+            sasl_mechanism=self.sasl_mechanism,
+            sasl_credentials=self.sasl_credentials)
+
+        def pooled(item):
+            with pool.connection() as con:
+                con.cache = self.cache
+                try:
+                    return func(con, item)
+                finally:
+                    con.cache = None
+
+        with pool, ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(pooled, items))
+
+    def bulk_add_users(self, rows, workers=4,
+        ldif_user='~/.ezldap/add_user.ldif',
+        ldif_group='~/.ezldap/add_group.ldif',
+        ldif_add_to_group='~/.ezldap/add_to_group.ldif', **kwargs):
+        '''
+        Add many users at once. Each row is a dict with a "username" key, and
+        optionally "groupname" and "password" keys. If groupname is omitted, a
+        same-named group is created (like the "ezldap add_user" command). If
+        password is omitted, a random one is generated. Any other keys are used
+        as LDIF template replacements for that row only.
+
+        Existing groups are resolved with a single search and uid/gid numbers
+        are reserved up front, after which the adds are performed over up to
+        "workers" connections in parallel.
+
+        :return: A list of dicts, one per row, with the keys username,
+            groupname, password, uid, gid, success, message, and results (the
+            LDAP results of each operation performed for that row).
+        '''
+        groupdn = self._conf_basedn_key('groupdn')
+        groups = {}
+        for group in self.iter_search('(objectClass=posixGroup)',
+                attributes=['cn', 'gidNumber'], search_base=groupdn):
+            for cn in group.get('cn', []):
+                groups[cn] = group.get('gidNumber', [None])[0]
+
+        reports = []
+        new_groups = {}
+        for row in rows:
+            row = dict(row)
+            if not row.get('username'):
+                raise ValueError('Every row must have a "username".')
+
+            report = {
+                'username': row.pop('username'),
+                'groupname': row.pop('groupname', None) or None,
+                'password': row.pop('password', None) or random_passwd(),
+                'uid': row.pop('uid', None),
+                'gid': row.pop('gid', None),
+                'success': False,
+                'message': '',
+                'results': [],
+                'replacements': row
+            }
+            if report['groupname'] is None:
+                report['groupname'] = report['username']
+                if report['groupname'] not in groups:
+                    new_groups[report['groupname']] = None
+
+            reports.append(report)
+
+        # reserve every id number we need before adding anything
+        for groupname in new_groups:
+            new_groups[groupname] = self.next_gidn(reserve=True)
+
+        groups.update(new_groups)
+        for report in reports:
+            if report['gid'] is None:
+                report['gid'] = groups.get(report['groupname'])
+
+            if report['gid'] is None:
+                report['message'] = 'Group does not exist'
+            elif report['uid'] is None:
+                report['uid'] = self.next_uidn(reserve=True)
+
+        def add_group(con, groupname):
+            replace = {'groupname': groupname, 'gid': new_groups[groupname]}
+            replace.update(self.conf)
+            replace.update(kwargs)
+            return con.ldif_add(ldif_read(ldif_group, replace))
+
+        group_results = dict(zip(new_groups, self._parallel_map(add_group,
+            new_groups, workers)))
+
+        def add_user(con, report):
+            if report['message'] != '':
+                return report
+
+            results = group_results.get(report['groupname'], [])
+            if len(results) > 0 and results[0]['result'] != 0:
+                report['results'] = results
+                report['message'] = results[0]['description']
+                return report
+
+            replace = {'username': report['username'],
+                       'groupname': report['groupname'],
+                       'user_password': ssha_passwd(report['password']),
+                       'uid': report['uid'],
+                       'gid': report['gid']}
+            replace.update(self.conf)
+            replace.update(kwargs)
+            replace.update(report['replacements'])
+            results = results + con.ldif_add(ldif_read(ldif_user, replace))
+            if results[-1]['result'] == 0:
+                results += con.ldif_modify(ldif_read(ldif_add_to_group, replace))
+
+            report['results'] = results
+            report['success'] = all(res['result'] == 0 for res in results)
+            if not report['success']:
+                failed = [res for res in results if res['result'] != 0][0]
+                report['message'] = failed['message'] or failed['description']
+
+            return report
+
+        reports = self._parallel_map(add_user, reports, workers)
+        for report in reports:
+            del report['replacements']
+
+        return reports
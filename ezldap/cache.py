@@ -0,0 +1,150 @@
+'''
+Helpers for caching values between ezldap sessions under ~/.ezldap/cache/,
+and for caching entries in memory during a session.
+'''
+
+import os
+import re
+import json
+import time
+import threading
+import collections
+
+import yaml
+
+CACHE_DIR = '~/.ezldap/cache'
+
+
+def cache_path(name):
+    '''
+    Return the full path of a file stored in the ezldap cache directory.
+    '''
+    return os.path.join(os.path.expanduser(CACHE_DIR), name)
+
+
+def host_key(uri):
+    '''
+    Convert an LDAP URI into something that can safely be used as a filename.
+    '''
+    return re.sub(r'[^\w.-]', '_', uri)
+
+
+def cache_read(name):
+    '''
+    Read a cache file as a dict. Files ending in .json are read as JSON,
+    everything else as YAML. Missing or unreadable cache files are treated as
+    empty.
+    '''
+    try:
+        with open(cache_path(name)) as handle:
+            if name.endswith('.json'):
+                content = json.load(handle)
+            else:
+                content = yaml.safe_load(handle)
+    except (OSError, ValueError, yaml.YAMLError):
+        return {}
+
+    if not isinstance(content, dict):
+        return {}
+
+    return content
+
+
+def cache_write(name, content):
+    '''
+    Write a dict to a cache file, as JSON if the name ends in .json or YAML
+    otherwise. The file is written to a temporary file first and then moved
+    into place, so concurrent readers never see a partially written cache.
+    '''
+    path = cache_path(name)
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as handle:
+        if name.endswith('.json'):
+            json.dump(content, handle)
+        else:
+            yaml.safe_dump(content, handle, default_flow_style=False)
+
+    os.replace(tmp_path, path)
+
+
+class EntryCache:
+    '''
+    An in-memory least-recently-used cache with a time to live, used by
+    Connection.enable_cache() to avoid repeating the same lookups. Hit, miss
+    and eviction counts are kept in the hits, misses and evictions attributes.
+    '''
+
+    def __init__(self, max_size=1024, ttl=60):
+        '''
+        :param max_size: Maximum number of values cached. When full, the least
+            recently used value is dropped.
+        :param ttl: Seconds a value is cached for. None caches values until
+            they are invalidated or evicted.
+        '''
+        if max_size < 1:
+            raise ValueError('max_size must be at least 1.')
+
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        # values are stored as (value, expiry time)
+        self._values = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._values)
+
+    def get(self, key):
+        '''
+        Return (True, value) if key is cached, or (False, None) if it is not.
+        '''
+        with self._lock:
+            try:
+                value, expires = self._values[key]
+            except KeyError:
+                self.misses += 1
+                return False, None
+
+            if expires is not None and expires < time.monotonic():
+                del self._values[key]
+                self.misses += 1
+                return False, None
+
+            self._values.move_to_end(key)
+            self.hits += 1
+            return True, value
+
+    def put(self, key, value):
+        '''
+        Cache a value, replacing any value already cached for key.
+        '''
+        expires = None if self.ttl is None else time.monotonic() + self.ttl
+        with self._lock:
+            self._values[key] = (value, expires)
+            self._values.move_to_end(key)
+            while len(self._values) > self.max_size:
+                self._values.popitem(last=False)
+                self.evictions += 1
+
+    def discard(self, predicate=None):
+        '''
+        Drop every cached value for which predicate(value) is true, or all
+        values if predicate is None.
+        '''
+        with self._lock:
+            if predicate is None:
+                self._values.clear()
+                return
+
+            for key in [k for k, (v, _) in self._values.items() if predicate(v)]:
+                del self._values[key]
+
+    def stats(self):
+        '''
+        Return the cache's hit, miss and eviction counts and current size.
+        '''
+        return {'hits': self.hits, 'misses': self.misses,
+            'evictions': self.evictions, 'size': len(self._values)}
@@ -0,0 +1,304 @@
+'''
+Build column-oriented (one list per attribute) search results directly from
+search responses, for search_list_t(), search_df() and exports.
+'''
+
+import base64
+import itertools
+from datetime import datetime
+
+# attribute syntaxes (RFC 4517) that have a natural column type
+SYNTAX_TYPES = {
+    '1.3.6.1.4.1.1466.115.121.1.27': 'int',  # INTEGER
+    '1.3.6.1.4.1.1466.115.121.1.24': 'datetime',  # Generalized Time
+    '1.3.6.1.4.1.1466.115.121.1.7': 'bool',  # Boolean
+    '1.3.6.1.4.1.1466.115.121.1.40': 'binary',  # Octet String
+    '1.3.6.1.4.1.1466.115.121.1.28': 'binary',  # JPEG
+    '1.3.6.1.4.1.1466.115.121.1.8': 'binary',  # Certificate
+}
+
+# python type of the values ldap3 returns for each column type
+PYTHON_TYPES = {'int': int, 'datetime': datetime, 'bool': bool, 'binary': bytes}
+
+
+def _column_type(schema, name):
+    '''
+    Return the column type and whether the attribute is single-valued.
+    '''
+    attribute_type = schema.attribute_types.get(name)
+    if attribute_type is None:
+        return None, False
+
+    single_value = attribute_type.single_value
+    syntax = attribute_type.syntax
+    # attributes may inherit their syntax from a superior attribute type
+    while syntax is None and attribute_type.superior:
+        attribute_type = schema.attribute_types.get(attribute_type.superior[0])
+        if attribute_type is None:
+            break
+
+        syntax = attribute_type.syntax
+
+    if syntax is None:
+        return None, single_value
+
+    return SYNTAX_TYPES.get(syntax.split('{')[0]), single_value
+
+
+def column_types(schema, names, single_valued=False):
+    '''
+    Look up the type of each column in the server schema. Returns a dict of
+    {column: 'int'|'datetime'|'bool'|'binary'}, columns of any other type are
+    omitted.
+
+    :param schema: An ldap3 SchemaInfo (Connection.server.schema), or None.
+    :param names: Column (attribute) names.
+    :param single_valued: Only return types for single-valued attributes.
+    '''
+    types = {}
+    if schema is None:
+        return types
+
+    for name in names:
+        kind, single_value = _column_type(schema, name)
+        if kind is not None and (single_value or not single_valued):
+            types[name] = kind
+
+    return types
+
+
+def typed_dataframe(df, types):
+    '''
+    Give the typed columns of a DataFrame a matching dtype (for instance,
+    uidNumber becomes Int64). Columns that can't be converted, such as those
+    holding multiple values, are left as-is.
+
+    :param df: A pandas DataFrame.
+    :param types: Column types, from column_types().
+    '''
+    import pandas
+
+    for name, kind in types.items():
+        try:
+            if kind == 'int':
+                df[name] = pandas.to_numeric(df[name]).astype('Int64')
+            elif kind == 'datetime':
+                df[name] = pandas.to_datetime(df[name], utc=True)
+            elif kind == 'bool':
+                df[name] = df[name].astype('boolean')
+        except (TypeError, ValueError):
+            # joined or listed multiple values can't be converted
+            pass
+
+    return df
+
+
+def arrow_schema(schema, names, unpack_lists=True):
+    '''
+    Build the pyarrow schema for columns built by a ColumnBuilder. Typed
+    attributes get a matching arrow type (uidNumber becomes int64), everything
+    else is a string. Requires pyarrow.
+
+    :param schema: An ldap3 SchemaInfo (Connection.server.schema), or None.
+    :param names: Column (attribute) names, including "dn".
+    :param unpack_lists: Whether the columns were built with unpack_lists. If
+        False, every column is a list.
+    '''
+    import pyarrow
+
+    arrow_types = {
+        'int': pyarrow.int64(),
+        'datetime': pyarrow.timestamp('us', tz='UTC'),
+        'bool': pyarrow.bool_(),
+        'binary': pyarrow.binary()
+    }
+    # joined multiple values are always strings
+    types = column_types(schema, names, single_valued=unpack_lists)
+    fields = []
+    for name in names:
+        arrow_type = arrow_types.get(types.get(name), pyarrow.string())
+        if not unpack_lists:
+            arrow_type = pyarrow.list_(arrow_type)
+
+        fields.append(pyarrow.field(name, arrow_type))
+
+    return pyarrow.schema(fields)
+
+
+def to_string(value):
+    '''
+    Convert a value for a string column. Binary values are base64-encoded.
+    '''
+    if value is None or isinstance(value, str):
+        return value
+    elif isinstance(value, bytes):
+        return base64.b64encode(value).decode('ascii')
+
+    return str(value)
+
+
+def _arrow_array(values, field, kind):
+    import pyarrow
+
+    is_list = pyarrow.types.is_list(field.type)
+    if kind is None:
+        if is_list:
+            values = [None if v is None else [to_string(x) for x in v] for v in values]
+        else:
+            values = [to_string(v) for v in values]
+
+        return pyarrow.array(values, type=field.type)
+
+    try:
+        return pyarrow.array(values, type=field.type)
+    except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError):
+        # values that don't match the schema (that ldap3 could not convert)
+        # are left out instead of failing the whole batch
+        expected = PYTHON_TYPES[kind]
+        if is_list:
+            values = [None if v is None else [x for x in v if isinstance(x, expected)]
+                for v in values]
+        else:
+            values = [v if isinstance(v, expected) else None for v in values]
+
+        return pyarrow.array(values, type=field.type)
+
+
+def record_batch(columns, schema, types):
+    '''
+    Convert columns built by a ColumnBuilder into a pyarrow RecordBatch.
+
+    :param columns: A dict of columns, from ColumnBuilder.flush().
+    :param schema: The pyarrow schema, from arrow_schema().
+    :param types: Column types, from column_types().
+    '''
+    import pyarrow
+
+    arrays = [_arrow_array(columns[field.name], field, types.get(field.name))
+        for field in schema]
+    return pyarrow.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+class ColumnBuilder:
+    '''
+    Fills one list per attribute from search responses, one entry at a time,
+    without building an intermediate dict per entry. Entries missing an
+    attribute get None in that column.
+    '''
+
+    def __init__(self, attributes='*', unpack_lists=True, unpack_delimiter='|',
+        explode=None):
+        '''
+        :param attributes: Attributes requested by the search. If this includes
+            "*" or "+", columns are added for every attribute returned.
+        :param unpack_lists: Return single values as-is and join multiple
+            values into a string with unpack_delimiter. If False, every value
+            is a list.
+        :param explode: An attribute (or list of attributes) whose values are
+            split into one row each, with the entry's other values repeated.
+        '''
+        if attributes is None:
+            attributes = []
+        elif isinstance(attributes, str):
+            attributes = [attributes]
+
+        if isinstance(explode, str):
+            explode = [explode]
+
+        self.unpack_lists = unpack_lists
+        self.unpack_delimiter = unpack_delimiter
+        self.discover = '*' in attributes or '+' in attributes
+        self.explode = {name.lower() for name in explode or []}
+        self.rows = 0
+        # attribute names are case-insensitive, map them to their column
+        self._names = {}
+        self._columns = {}
+        self._add_column('dn')
+        for name in attributes:
+            if name not in ('*', '+', '1.1'):
+                self._add_column(name)
+
+    def _add_column(self, name):
+        self._names[name.lower()] = name
+        self._columns[name] = [None] * self.rows
+
+    def _cell(self, values):
+        if not isinstance(values, list):
+            values = [values]
+
+        if not self.unpack_lists:
+            return values
+        elif len(values) == 1:
+            return values[0]
+        elif len(values) == 0:
+            return None
+
+        return self.unpack_delimiter.join(to_string(v) for v in values)
+
+    def _append(self, row):
+        for name, value in row.items():
+            column = self._columns[name]
+            if len(column) < self.rows:
+                column.extend([None] * (self.rows - len(column)))
+
+            column.append(value)
+
+        self.rows += 1
+
+    def add(self, dn, attributes):
+        '''
+        Add an entry (or several rows, if exploding a multi-valued attribute).
+
+        :param dn: The entry's DN.
+        :param attributes: The entry's attributes, as returned by ldap3 in a
+            search response.
+        '''
+        row = {'dn': self._cell(dn)}
+        exploded = []
+        for name, values in attributes.items():
+            key = name.lower()
+            if key not in self._names:
+                if not self.discover:
+                    continue
+
+                self._add_column(name)
+
+            column = self._names[key]
+            if key in self.explode:
+                if not isinstance(values, list):
+                    values = [values]
+
+                exploded.append((column, values or [None]))
+            else:
+                row[column] = self._cell(values)
+
+        if not exploded:
+            self._append(row)
+            return
+
+        names = [column for column, _ in exploded]
+        for combination in itertools.product(*[values for _, values in exploded]):
+            exploded_row = dict(row)
+            exploded_row.update(zip(names, combination))
+            self._append(exploded_row)
+
+    def columns(self):
+        '''
+        Return the columns built so far as a dict of equal-length lists.
+        '''
+        for column in self._columns.values():
+            if len(column) < self.rows:
+                column.extend([None] * (self.rows - len(column)))
+
+        return self._columns
+
+    def flush(self):
+        '''
+        Return the columns built so far and start over with empty columns.
+        Columns that have been seen are kept, so every batch has the same
+        columns.
+        '''
+        columns = self.columns()
+        self._columns = {name: [] for name in columns}
+        self.rows = 0
+        return columns
@@ -4,21 +4,59 @@ Ideally the user should have to do nothing aside from specify a password.
 '''
 
 import os
-import yaml
+import copy
+import threading
+
+# parsed files by path, along with the mtime and size they were read at
+_FILES = {}
+_FILES_LOCK = threading.Lock()
+
+
+def _read_cached(path, parse):
+    '''
+    Parse a file with parse(handle), or return the result of parsing it
+    before if it has not changed since. Returns a copy, so callers can modify
+    it without affecting later calls.
+    '''
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    version = (stat.st_mtime_ns, stat.st_size)
+    with _FILES_LOCK:
+        cached = _FILES.get(path)
+
+    if cached is None or cached[0] != version or cached[1] is not parse:
+        with open(path) as handle:
+            cached = (version, parse, parse(handle))
+
+        with _FILES_LOCK:
+            _FILES[path] = cached
+
+    return copy.deepcopy(cached[2])
+
+
+def _load_yaml(handle):
+    # yaml is only imported when needed, it is slow to import
+    import yaml
+
+    # the C loader is much faster, but is only there if libyaml is installed
+    return yaml.load(handle, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
+
 
 def config(path=None):
     '''
     Attempts to generate a dictionary of config values for LDAP details from
     the following config files, in order: the environment variable EZLDAP_CONFIG,
     ~/.ezldap/config.yml, or guess from /etc/openldap/ldap.conf + /usr/bin/ldapwhoami.
+    Config files are only parsed again if they have changed, and every call
+    returns a new copy of the config.
     '''
     if path is not None:
-        return yaml.load(open(os.path.expanduser(path)))
+        return _read_cached(os.path.expanduser(path), _load_yaml)
     elif 'EZLDAP_CONFIG' in os.environ.keys():
         # EZLDAP_CONFIG will have already been expanded by the user's shell
-        return yaml.load(open(os.environ['EZLDAP_CONFIG']))
+        return _read_cached(os.environ['EZLDAP_CONFIG'], _load_yaml)
     elif os.path.exists(os.path.expanduser('~/.ezldap/config.yml')):
-        return yaml.load(open(os.path.expanduser('~/.ezldap/config.yml')))
+        return _read_cached(os.path.expanduser('~/.ezldap/config.yml'), _load_yaml)
     else:
         return guess_config()
 
@@ -53,6 +91,10 @@ def readlines_to_dict(list_of_strings):
     return conf
 
 
+def _read_conf(handle):
+    return readlines_to_dict(handle.readlines())
+
+
 def get_ldap_conf_val(field):
     if os.path.exists('/etc/openldap/ldap.conf'):
         # redhat distros
@@ -64,7 +106,7 @@ def get_ldap_conf_val(field):
         return None
 
     try:
-        ldap_conf = readlines_to_dict(open(path).readlines())
+        ldap_conf = _read_cached(path, _read_conf)
         return ldap_conf[field][0]
     except KeyError:
         return None
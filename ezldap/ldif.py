@@ -3,10 +3,12 @@ Utility functions for reading/writing to LDIF files.
 '''
 
 import os
-import re
-import copy
-from io import StringIO
+import sys
+import base64
+from datetime import datetime, timezone
 from string import Template
+from urllib.parse import urlparse
+from urllib.request import url2pathname
 
 import ldap3
 
@@ -19,6 +21,14 @@ class LDIFTemplateError(KeyError):
     pass
 
 
+# templates larger than this are read line by line instead of being compiled
+# and cached, so that huge LDIF files are never held in memory
+TEMPLATE_CACHE_MAX_SIZE = 64 * 1024
+
+# compiled templates by path, along with the mtime and size they were read at
+_TEMPLATES = {}
+
+
 def template(path, replacements=None):
     '''
     Read a file and substitute replacment entries for placeholders designated
@@ -28,14 +38,140 @@ def template(path, replacements=None):
     if replacements is None:
         return open(path).read()
     else:
+        compiled = _compiled_template(path)
+        content = Template(open(path).read()) if compiled is None else compiled.text
         try:
-            content = Template(open(path).read())
             return content.substitute(replacements)
         except KeyError as e:
             raise LDIFTemplateError('No value provided for LDIF key "{}"'
                 .format(e.args[0])) from e
 
 
+def _format_string(value):
+    '''
+    Convert the placeholders in a template string into an equivalent
+    str.format() string, which is much faster to fill in. Returns None if the
+    string contains an invalid placeholder.
+    '''
+    parts = []
+    last = 0
+    for match in Template.pattern.finditer(value):
+        name = match.group('named') or match.group('braced')
+        if match.group('invalid') is not None:
+            return None
+
+        parts.append(value[last:match.start()].replace('{', '{{').replace('}', '}}'))
+        parts.append('$' if name is None else '{' + name + '}')
+        last = match.end()
+
+    parts.append(value[last:].replace('{', '{{').replace('}', '}}'))
+    return ''.join(parts)
+
+
+class _CompiledTemplate:
+    '''
+    An LDIF template split into tokens ahead of time (see _tokens()), so that
+    rendering it only fills in the values containing placeholders and builds
+    the entries, without reading or parsing any text.
+    '''
+
+    def __init__(self, content):
+        self.text = Template(content)
+        self.lines = content.splitlines(keepends=True)
+        # placeholders in the order the line by line substitution meets them
+        self.identifiers = []
+        for match in Template.pattern.finditer(content):
+            name = match.group('named') or match.group('braced')
+            if name is not None and name not in self.identifiers:
+                self.identifiers.append(name)
+
+        # (token, attribute, format string) for each line, the format string
+        # is None for lines without placeholders
+        self.tokens = None
+        if any(line[:1] == ' ' and '$' in line for line in self.lines):
+            # placeholders are substituted before lines are unfolded
+            return
+
+        tokens = []
+        for line in _unfold(self.lines):
+            if line == '':
+                tokens.append((_BLANK, None, None))
+            elif line[0] == '-':
+                tokens.append((_SEPARATOR, None, None))
+            else:
+                name, sep, value = line.partition(':')
+                if sep == '' or '$' in name:
+                    # let the line by line substitution deal with these
+                    return
+                elif '$' in value or value[:1] == '<':
+                    # values from URLs are read again every time
+                    value = _format_string(value)
+                    if value is None:
+                        return
+
+                    tokens.append((None, name, value))
+                else:
+                    tokens.append(((name, _decode_value(value)), None, None))
+
+        self.tokens = tokens
+        # placeholders outside of values (in comments) must still be given
+        filled = ''.join(value for _, _, value in tokens if value is not None)
+        self.unused = [name for name in self.identifiers
+            if '{' + name + '}' not in filled]
+
+    def _missing(self, replacements):
+        '''
+        The error for the first placeholder without a value.
+        '''
+        for name in self.identifiers:
+            try:
+                replacements[name]
+            except KeyError:
+                return LDIFTemplateError('No value provided for LDIF key "{}"'
+                    .format(name))
+
+    def render(self, replacements):
+        '''
+        Return the entries of the template with placeholders substituted.
+        '''
+        if self.tokens is None:
+            return list(_parse_ldif(_substitute(self.lines, replacements)))
+
+        try:
+            for name in self.unused:
+                replacements[name]
+
+            tokens = [token if value is None else
+                (name, _decode_value(value.format_map(replacements)))
+                for token, name, value in self.tokens]
+        except KeyError as e:
+            raise self._missing(replacements) from e
+
+        return list(_build_entries(tokens))
+
+
+def _compiled_template(path):
+    '''
+    Return the compiled template at path, compiling it if it has not been
+    compiled since it was last modified. Returns None for files larger than
+    TEMPLATE_CACHE_MAX_SIZE.
+    '''
+    path = os.path.expanduser(path)
+    stat = os.stat(path)
+    version = (stat.st_mtime_ns, stat.st_size)
+    cached = _TEMPLATES.get(path)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    elif stat.st_size > TEMPLATE_CACHE_MAX_SIZE:
+        return None
+
+    with open(path) as handle:
+        compiled = _CompiledTemplate(handle.read())
+
+    _TEMPLATES[path] = (version, compiled)
+    return compiled
+
+
 def ldif_read(path, replacements=None):
     '''
     Read an LDIF file into a list of dicts appropriate for use with ezldap.
@@ -44,130 +180,446 @@ def ldif_read(path, replacements=None):
     :param replacements: A dictionary of replacement values to replace
         $placeholders in the LDIF template.
     '''
-    # read into a string buffer first
-    path = os.path.expanduser(path)
-    content = StringIO(template(path, replacements))
-
-    operations = {
-        'add': ldap3.MODIFY_ADD,
-        'replace': ldap3.MODIFY_REPLACE,
-        'delete': ldap3.MODIFY_DELETE
-    }
-
-    entries = []
-    entry = {}
-    changetype = 'add'
-    next_change_attr = None
-    next_change_type = 'add'
-    for line in content:
-        if line[0] == '#':
+    return list(ldif_iter(path, replacements))
+
+
+def ldif_iter(path, replacements=None):
+    '''
+    Read an LDIF file one entry at a time. This works like ldif_read(), but
+    returns a generator that reads the file incrementally and yields each entry
+    as soon as it has been read, so memory use does not depend on the size of
+    the file. The generator can be passed directly to Connection.ldif_add()
+    or Connection.ldif_modify().
+
+    With replacements, templates (files up to TEMPLATE_CACHE_MAX_SIZE bytes)
+    are parsed once and cached until the file is modified, so rendering the
+    same template many times only fills in the placeholders.
+
+    :param path: Path of an LDIF file to read.
+    :param replacements: A dictionary of replacement values to replace
+        $placeholders in the LDIF template.
+    '''
+    if replacements is not None:
+        # templates are compiled once and rendered from the cache afterwards
+        compiled = _compiled_template(path)
+        if compiled is not None:
+            yield from compiled.render(replacements)
+            return
+
+    with open(os.path.expanduser(path)) as handle:
+        if replacements is None:
+            yield from _parse_ldif(handle)
+        else:
+            yield from _parse_ldif(_substitute(handle, replacements))
+
+
+def _substitute(lines, replacements):
+    '''
+    Substitute $placeholders line by line.
+    '''
+    for line in lines:
+        try:
+            yield Template(line).substitute(replacements)
+        except KeyError as e:
+            raise LDIFTemplateError('No value provided for LDIF key "{}"'
+                .format(e.args[0])) from e
+
+
+# ldap3 modify operations for each LDIF change type
+OPERATIONS = {
+    'add': ldap3.MODIFY_ADD,
+    'replace': ldap3.MODIFY_REPLACE,
+    'delete': ldap3.MODIFY_DELETE
+}
+
+CHANGETYPES = {'add', 'modify', 'delete', 'modrdn', 'moddn'}
+
+_OPERATION_NAMES = {operation: name for name, operation in OPERATIONS.items()}
+
+
+def _unfold(lines):
+    '''
+    Join folded (continuation) lines and drop comments, yielding one logical
+    LDIF line at a time without line endings. Entry separators are yielded as
+    empty strings.
+    '''
+    current = None
+    folded = None
+    in_comment = False
+    for line in lines:
+        if line[-1:] == '\n':
+            line = line[:-2] if line[-2:] == '\r\n' else line[:-1]
+
+        if line[:1] == ' ' and not line.isspace():
+            # a continuation line, the leading space is not part of the value
+            if current is not None:
+                if folded is None:
+                    folded = [current]
+
+                folded.append(line[1:])
+                continue
+            elif in_comment:
+                continue
+
+        if current is not None:
+            if folded is None:
+                yield current
+            else:
+                yield ''.join(folded)
+                folded = None
+
+            current = None
+
+        if line[:1] == '#':
+            # comments can be folded too
+            in_comment = True
+        elif line == '' or line.isspace():
+            in_comment = False
+            yield ''
+        else:
+            in_comment = False
+            current = line
+
+    if current is not None:
+        yield current if folded is None else ''.join(folded)
+
+
+def _read_url(url):
+    '''
+    Read the value of a "attribute:< URL" line. Only file:// URLs are supported.
+    '''
+    parsed = urlparse(url)
+    if parsed.scheme != 'file':
+        raise ValueError('Unsupported URL in LDIF: "{}" (only file:// URLs '
+            'are supported).'.format(url))
+
+    with open(url2pathname(parsed.path), 'rb') as handle:
+        return handle.read()
+
+
+def _decode_value(value):
+    '''
+    Decode the part of an LDIF line after the attribute name and colon.
+    '''
+    if value[:1] == ':':
+        # base64-encoded value, used for binary or non-ASCII data
+        decoded = base64.b64decode(value[1:].strip())
+        try:
+            return decoded.decode('utf-8')
+        except UnicodeDecodeError:
+            return decoded
+    elif value[:1] == '<':
+        return _read_url(value[1:].strip())
+    else:
+        return value.strip()
+
+
+def _end_change(entry, attribute, operation, values):
+    '''
+    Add a change to an entry once all of its values have been read. All the
+    values of a change are one operation (RFC 2849), and a change with no
+    values replaces or deletes every value of an attribute.
+    '''
+    if attribute is not None and (values or operation != ldap3.MODIFY_ADD):
+        entry.setdefault(attribute, []).append((operation, values))
+
+
+def _end_entry(entry, changetype, attribute, operation, values):
+    '''
+    Finish an entry. Modify records without any changes keep their
+    changetype, so they are not mistaken for (empty) content records.
+    '''
+    _end_change(entry, attribute, operation, values)
+    if changetype == 'modify' and len(entry) == 1:
+        entry['changetype'] = ['modify']
+
+
+# markers for blank lines and "-" lines in a stream of LDIF tokens
+_BLANK = object()
+_SEPARATOR = object()
+
+
+def _tokens(lines):
+    '''
+    Split LDIF lines into tokens: (attribute, value) pairs, with values
+    decoded, or the _BLANK and _SEPARATOR markers.
+    '''
+    for line in _unfold(lines):
+        if line == '':
+            yield _BLANK
+        elif line[0] == '-':
+            yield _SEPARATOR
+        else:
+            name, sep, value = line.partition(':')
+            if sep == '':
+                raise ValueError('Invalid LDIF line: "{}"'.format(line))
+
+            yield name, _decode_value(value)
+
+
+def _parse_ldif(lines):
+    '''
+    Parse an iterable of LDIF lines (RFC 2849), yielding each entry as soon as
+    it is complete.
+
+    Content records are returned as {attribute: [values]}, and
+    "changetype: add" records the same way with a "changetype" key. "changetype: modify" records are returned as
+    {attribute: [(operation, [values])]}, the format used by
+    ldap3.Connection.modify(), with one tuple for each change (all the values
+    listed between an operation line and the next "-"). Modify records
+    without any changes (from empty template placeholders) are returned with
+    a "changetype" key. Delete and modrdn records are returned with a
+    "changetype" key and the fields of the record (newrdn, deleteoldrdn,
+    newsuperior). Empty values are skipped, so that empty template
+    placeholders omit an attribute instead of adding an empty one.
+    '''
+    return _build_entries(_tokens(lines))
+
+
+def _build_entries(tokens):
+    '''
+    Build entries from LDIF tokens (see _tokens()), yielding each entry as
+    soon as it is complete.
+    '''
+    entry = None
+    changetype = None
+    change_attr = None
+    change_op = None
+    change_values = None
+    for token in tokens:
+        if token is _BLANK:
+            # blank line- the entry is complete
+            if entry is not None:
+                _end_entry(entry, changetype, change_attr, change_op, change_values)
+                yield entry
+
+            entry = None
             continue
-        if line[0] == '-':
-            if next_change_type == 'delete' and len(entry[next_change_attr]) == 0:
-                # The last entry ended with no entries and was also a "delete"
-                # change. This should result in a delete change that deletes all
-                # entries for that attribute.
-                entry[next_change_attr].append((ldap3.MODIFY_DELETE, []))
+        elif token is _SEPARATOR:
+            # end of one change in a changetype: modify record
+            if entry is not None:
+                _end_change(entry, change_attr, change_op, change_values)
 
+            change_attr = None
             continue
-        elif re.match(r'dn:', line):
-            # new dn- add last entry, and start a new one
-            if 'dn' in entry.keys():
-                entries.append(entry)
-                changetype = 'add'
 
-            entry = {}
+        name, value = token
+        if name == 'dn':
+            # a new dn without a separating blank line also ends an entry
+            if entry is not None:
+                _end_entry(entry, changetype, change_attr, change_op, change_values)
+                yield entry
 
-        match = re.findall(r'(\w+):\s*(.+)', line)
-        if len(match) > 0:
-            key = match[0][0]
-            value = match[0][1].strip()
+            entry = {'dn': [value]}
+            changetype = None
+            change_attr = None
+            continue
+        elif entry is None:
+            if name == 'version':
+                continue
 
-            if key == 'changetype':
-                # determine changetype and skip line
-                changetype = value
+            raise ValueError('LDIF record does not start with a dn: "{}: {}"'
+                .format(name, value))
+
+        if changetype is None and len(entry) == 1:
+            if name == 'control':
+                # controls are not supported, skip them
                 continue
-            elif key not in entry.keys() and key not in operations.keys():
-                entry[key] = []
-
-            if changetype == 'modify':
-                # handle ldif-change LDIFs
-                if key in operations.keys():
-                    next_change_type, next_change_attr = key, value
-                    if value not in entry.keys():
-                        # a check in case the attribute has not already been added
-                        entry[value] = []
-
-                    continue
-                elif key == next_change_attr:
-                    # each change is handled separately,
-                    # not the most efficient, but is an easier implementation
-                    value = (operations[next_change_type], [value])
-                else:
-                    raise ValueError('Attribute does not match attribute to {}.'.format(next_change_type))
+            elif name == 'changetype':
+                if value not in CHANGETYPES:
+                    raise ValueError('Unknown LDIF changetype "{}".'.format(value))
 
-            entry[key].append(value)
+                changetype = value
+                if changetype in {'add', 'delete', 'modrdn', 'moddn'}:
+                    entry['changetype'] = [value]
 
-    # last ldif object won't be added otherwise
-    if 'dn' in entry.keys():
-        entries.append(entry)
+                continue
 
-    return entries
+        if changetype == 'modify':
+            if name in OPERATIONS and (change_attr is None or name != change_attr):
+                # start of a new change
+                _end_change(entry, change_attr, change_op, change_values)
+                change_op, change_attr = OPERATIONS[name], value
+                change_values = []
+            elif name == change_attr:
+                if value != '':
+                    change_values.append(value)
+            else:
+                raise ValueError('Attribute does not match attribute to {}.'
+                    .format(change_op))
+        elif changetype == 'delete':
+            raise ValueError('Unexpected line in delete record: "{}: {}"'
+                .format(name, value))
+        elif value != '':
+            values = entry.get(name)
+            if values is None:
+                entry[name] = [value]
+            else:
+                values.append(value)
+
+    # last ldif object won't be yielded otherwise
+    if entry is not None:
+        _end_entry(entry, changetype, change_attr, change_op, change_values)
+        yield entry
 
 
 def ldif_write(entries, path):
     '''
-    Write self.entries as LDIF file.
+    Write entries to an LDIF file. Entries are written one at a time as they
+    are read from "entries", so a generator (such as Connection.iter_search())
+    is never held in memory all at once.
 
-    :param entries: A list of dicts, such as that returned by
-        Connection.search_list()
+    :param entries: An iterable of dicts, such as that returned by
+        Connection.search_list() or Connection.iter_search().
     :param path: File to write.
     '''
     with open(os.path.expanduser(path), 'w') as handle:
         _entries_to_handle(entries, handle)
 
 
-def ldif_print(entries):
+def ldif_print(entries, handle=None):
     '''
-    Print an LDIF entry to stdout.
+    Print entries as LDIF. Each entry is written as soon as it is read from
+    "entries", so search results can be streamed as they arrive.
 
-    :param entries: A list of dicts, such as that returned by
-        Connection.search_list().
+    :param entries: An iterable of dicts, such as that returned by
+        Connection.search_list() or Connection.iter_search().
+    :param handle: File handle to write to. Defaults to stdout.
     '''
-    with StringIO() as strbuf:
-        _entries_to_handle(entries, strbuf)
-        strbuf.seek(0)
-        print(''.join(strbuf.readlines()), end='')
+    if handle is None:
+        handle = sys.stdout
+
+    _entries_to_handle(entries, handle)
+
+
+def _is_modify(entry):
+    '''
+    Whether an entry is a "changetype: modify" record, with values of the form
+    [(operation, [values])] (as returned by ldif_read()).
+    '''
+    return entry.get('changetype', ['modify']) == ['modify'] and any(
+        isinstance(values, list) and len(values) > 0 and isinstance(values[0], tuple)
+        for key, values in entry.items() if key not in ('dn', 'changetype'))
+
+
+def _dump_changes(key, changes):
+    '''
+    Convert the changes to one attribute of a modify record into LDIF lines,
+    one change per operation (so a multi-valued replace stays one replace).
+    '''
+    out = []
+    for operation, values in changes:
+        out.append('{}: {}\n'.format(_OPERATION_NAMES[operation], key))
+        out.extend(_dump_attributes(key, values))
+        out.append('-\n')
+
+    return out
 
 
 def _entries_to_handle(entries, handle):
     '''
-    Write entries to a filehandle.
+    Write entries to a filehandle, one write() per entry. Change records (with
+    a "changetype" key, or modify records from ldif_read()) are written as
+    LDIF change records.
     '''
-    # because we're modifying the entries contained as we iterate through.
-    entries_cp = copy.deepcopy(entries)
-    for entry in entries_cp:
-        handle.writelines(_dump_attributes('dn', entry.pop('dn')))
-        #TODO only works with ldif-add, needs the ability to handle ldif-change
-        if 'objectClass' in entry.keys():
-            handle.writelines(_dump_attributes('objectClass', entry.pop('objectClass')))
+    for entry in entries:
+        lines = _dump_attributes('dn', entry['dn'])
+        if _is_modify(entry):
+            lines.append('changetype: modify\n')
+            for k, v in entry.items():
+                if k not in ('dn', 'changetype'):
+                    lines.extend(_dump_changes(k, v))
+        else:
+            if 'changetype' in entry:
+                lines.extend(_dump_attributes('changetype', entry['changetype']))
+
+            if 'objectClass' in entry:
+                lines.extend(_dump_attributes('objectClass', entry['objectClass']))
+
+            for k, v in entry.items():
+                if k not in ('dn', 'objectClass', 'changetype'):
+                    lines.extend(_dump_attributes(k, v))
+
+        lines.append('\n')
+        handle.write(''.join(lines))
+
+
+# maximum line length before a line is folded (RFC 2849 recommends 76)
+LINE_WIDTH = 76
+
+# characters that may not start a SAFE-STRING (RFC 2849)
+_UNSAFE_INIT = {' ', ':', '<'}
 
-        for k, v in entry.items():
-            handle.writelines(_dump_attributes(k, v))
 
-        handle.write('\n')
+def _value_str(value):
+    '''
+    Convert an attribute value returned by ldap3 into a string, or bytes if it
+    is not valid UTF-8.
+    '''
+    if isinstance(value, bytes):
+        try:
+            return value.decode('utf-8')
+        except UnicodeDecodeError:
+            return value
+    elif isinstance(value, bool):
+        return 'TRUE' if value else 'FALSE'
+    elif isinstance(value, datetime):
+        # ldap3 returns timestamps as datetimes, write them back out as
+        # generalized time
+        if value.tzinfo is not None:
+            value = value.astimezone(timezone.utc)
+
+        return value.strftime('%Y%m%d%H%M%SZ')
+
+    return str(value)
+
+
+def _safe_string(value):
+    '''
+    Whether a value can be written as-is (a SAFE-STRING from RFC 2849). Other
+    values must be base64-encoded.
+    '''
+    if value == '':
+        return True
+
+    if value[0] in _UNSAFE_INIT or value[-1] == ' ' or not value.isascii():
+        return False
+
+    return '\0' not in value and '\n' not in value and '\r' not in value
+
+
+def _fold(line):
+    '''
+    Fold a line longer than LINE_WIDTH into continuation lines, each beginning
+    with a single space.
+    '''
+    if len(line) <= LINE_WIDTH:
+        return line + '\n'
+
+    width = LINE_WIDTH - 1
+    parts = [line[:LINE_WIDTH]]
+    parts.extend(line[i:i + width] for i in range(LINE_WIDTH, len(line), width))
+    return '\n '.join(parts) + '\n'
 
 
 def _dump_attributes(key, values):
     '''
-    Convert a dictionary key/value pair (key: [value1, value2]) to a list of the
-    form: ['key: value1', 'key: value2'].
+    Convert a dictionary key/value pair (key: [value1, value2]) to a list of
+    LDIF lines of the form: ['key: value1', 'key: value2']. Binary and
+    non-ASCII values are base64-encoded and long lines are folded.
     '''
     if not isinstance(values, list):
         values = [values]
 
     out = []
     for v in values:
-        out.append('{}: {}\n'.format(key, v))
+        v = _value_str(v)
+        if isinstance(v, str) and _safe_string(v):
+            out.append(_fold('{}: {}'.format(key, v)))
+        else:
+            if isinstance(v, str):
+                v = v.encode('utf-8')
+
+            out.append(_fold('{}:: {}'.format(key, base64.b64encode(v).decode('ascii'))))
 
     return out
@@ -0,0 +1,546 @@
+'''
+Keep a local SQLite copy of selected subtrees of a directory, refreshed
+incrementally by modifyTimestamp, and search it like a Connection.
+'''
+
+import re
+import json
+import time
+import base64
+import sqlite3
+from datetime import datetime
+
+import ldap3
+from ldap3.core.exceptions import LDAPInvalidFilterError
+
+from .api import _dn_key
+from .ldif import _value_str
+from .columnar import ColumnBuilder, column_types, typed_dataframe
+
+# attributes whose values can be looked up with an index
+INDEXED_ATTRIBUTES = ['uid', 'cn', 'uidNumber', 'gidNumber']
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    dn TEXT NOT NULL,
+    depth INTEGER NOT NULL,
+    attributes TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS attribute_index (
+    key TEXT NOT NULL,
+    name TEXT NOT NULL,
+    value TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS attribute_index_value ON attribute_index (name, value);
+CREATE INDEX IF NOT EXISTS attribute_index_key ON attribute_index (key);
+CREATE TABLE IF NOT EXISTS subtrees (
+    base TEXT PRIMARY KEY,
+    search_filter TEXT NOT NULL,
+    attributes TEXT NOT NULL,
+    last_modified TEXT,
+    refreshed REAL
+);
+CREATE TABLE IF NOT EXISTS attribute_types (
+    name TEXT PRIMARY KEY,
+    kind TEXT NOT NULL
+);
+'''
+
+
+def _key(dn):
+    '''
+    Convert a DN into the key entries are stored under. Keys list RDNs from
+    the root down, so the keys of a subtree sort together right after the key
+    of its base.
+    '''
+    key = _dn_key(dn)
+    if key is None:
+        raise ValueError('"{}" is not a valid DN.'.format(dn))
+
+    return '\x00'.join('\x01'.join('{}={}'.format(a, v) for a, v in rdn)
+        for rdn in reversed(key)), len(key)
+
+
+def _subtree(column, key):
+    '''
+    SQL matching every key at or below key.
+    '''
+    if not key:
+        return '1', []
+
+    return '({0} = ? OR ({0} >= ? AND {0} < ?))'.format(column), \
+        [key, key + '\x00', key + '\x01']
+
+
+def _encode(value):
+    if isinstance(value, bytes):
+        return {'base64': base64.b64encode(value).decode('ascii')}
+    elif isinstance(value, datetime):
+        return {'datetime': value.isoformat()}
+    elif isinstance(value, (str, int, float)):
+        return value
+
+    return str(value)
+
+
+def _decode(value):
+    if len(value) == 1:
+        if isinstance(value.get('base64'), str):
+            return base64.b64decode(value['base64'])
+        elif isinstance(value.get('datetime'), str):
+            return datetime.fromisoformat(value['datetime'])
+
+    return value
+
+
+def _unescape(value):
+    '''
+    Undo the escaping of a value in a search filter (RFC 4515).
+    '''
+    try:
+        return re.sub(rb'\\([0-9a-fA-F]{2})', lambda m: bytes([int(m.group(1), 16)]),
+            value.encode('utf-8')).decode('utf-8')
+    except UnicodeDecodeError:
+        raise LDAPInvalidFilterError('Invalid escape in "{}".'.format(value))
+
+
+def parse_filter(search_filter):
+    '''
+    Parse an LDAP search filter (RFC 4515) into nested tuples: ("&", [...]),
+    ("|", [...]), ("!", filter), ("present", attribute), ("substring",
+    attribute, [initial, any..., final]) or (operator, attribute, value) for
+    the =, >=, <= and ~= operators. Extensible matches are not supported.
+    '''
+    search_filter = search_filter.strip()
+    node, end = _parse(search_filter, 0)
+    if end != len(search_filter):
+        raise LDAPInvalidFilterError('Unexpected text after filter: "{}".'.format(
+            search_filter[end:]))
+
+    return node
+
+
+def _parse(text, i):
+    '''
+    Parse the filter starting at position i of text. Returns the filter and
+    the position just after it.
+    '''
+    if text[i:i + 1] != '(':
+        raise LDAPInvalidFilterError('Expected "(" at position {} of "{}".'.format(i, text))
+
+    i += 1
+    operator = text[i:i + 1]
+    if operator in ('&', '|'):
+        i += 1
+        children = []
+        while text[i:i + 1] == '(':
+            child, i = _parse(text, i)
+            children.append(child)
+
+        node = (operator, children)
+    elif operator == '!':
+        child, i = _parse(text, i + 1)
+        node = ('!', child)
+    else:
+        # parentheses in values are always escaped (as \28 and \29)
+        end = text.find(')', i)
+        if end < 0:
+            raise LDAPInvalidFilterError('Missing ")" in "{}".'.format(text))
+
+        node = _parse_item(text[i:end])
+        i = end
+
+    if text[i:i + 1] != ')':
+        raise LDAPInvalidFilterError('Expected ")" at position {} of "{}".'.format(i, text))
+
+    return node, i + 1
+
+
+def _parse_item(item):
+    match = re.match(r'([^=~<>]*)(~=|>=|<=|=)(.*)$', item, re.DOTALL)
+    if match is None:
+        raise LDAPInvalidFilterError('Invalid filter item "({})".'.format(item))
+
+    attribute, operator, value = match.groups()
+    if ':' in attribute:
+        raise LDAPInvalidFilterError('Extensible match filters are not supported.')
+    elif not re.match(r'^[\w.-]+(;[\w-]+)*$', attribute):
+        raise LDAPInvalidFilterError('Invalid attribute "{}".'.format(attribute))
+
+    if operator == '=' and value == '*':
+        return ('present', attribute)
+    elif operator == '=' and '*' in value:
+        return ('substring', attribute, [_unescape(part) for part in value.split('*')])
+
+    return (operator, attribute, _unescape(value))
+
+
+def _as_text(value):
+    value = _value_str(value)
+    return None if isinstance(value, bytes) else value.lower()
+
+
+def _compare(value, target):
+    '''
+    Compare a value with a filter value, as numbers if both are integers.
+    Returns -1, 0 or 1.
+    '''
+    try:
+        value, target = int(value), int(target)
+    except ValueError:
+        pass
+
+    return (value > target) - (value < target)
+
+
+def _matches(node, entry):
+    '''
+    Whether an entry (a dict of lowercase attribute names to lists of values)
+    matches a parsed filter. Values are compared ignoring case.
+    '''
+    operator = node[0]
+    if operator == '&':
+        return all(_matches(child, entry) for child in node[1])
+    elif operator == '|':
+        return any(_matches(child, entry) for child in node[1])
+    elif operator == '!':
+        return not _matches(node[1], entry)
+
+    if operator == 'present' and node[1].lower() == 'objectclass':
+        # every entry has one, even if the mirror doesn't store it
+        return True
+
+    values = entry.get(node[1].lower())
+    if not values:
+        return False
+    elif operator == 'present':
+        return True
+
+    values = [value for value in map(_as_text, values) if value is not None]
+    if operator == 'substring':
+        pattern = '.*'.join(re.escape(part.lower()) for part in node[2])
+        return any(re.fullmatch(pattern, value, re.DOTALL) for value in values)
+
+    target = node[2].lower()
+    if operator in ('=', '~='):
+        return target in values
+    elif operator == '>=':
+        return any(_compare(value, target) >= 0 for value in values)
+
+    return any(_compare(value, target) <= 0 for value in values)
+
+
+class Mirror:
+    '''
+    A local SQLite copy of selected subtrees of a directory. The first
+    refresh() of a subtree loads it with a paged search. Later refreshes only
+    fetch entries with a newer modifyTimestamp, and find deleted (or moved)
+    entries by comparing DNs. That still lists the DN of every entry in the
+    subtree (without any attributes), so it can be skipped with
+    find_deleted=False when only changed entries matter.
+
+    The mirror can be searched with search_list(), iter_search(),
+    search_list_t() and search_df(), which take the same arguments as the
+    Connection methods. Filters are evaluated locally, and equality matches on
+    indexed attributes (uid, cn, uidNumber and gidNumber by default) are
+    looked up with an index instead of scanning every entry.
+    '''
+
+    def __init__(self, path, indexed=INDEXED_ATTRIBUTES):
+        '''
+        :param path: SQLite database to store the mirror in. It is created if
+            it does not exist.
+        :param indexed: Attributes whose values are indexed.
+        '''
+        self.path = path
+        self.indexed = {name.lower() for name in indexed}
+        self.db = sqlite3.connect(path)
+        self.db.executescript(_SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.db.close()
+
+    def subtrees(self):
+        '''
+        Return the subtrees mirrored so far, as a dict of
+        {base: {'search_filter': ..., 'attributes': ..., 'last_modified': ...,
+        'refreshed': ...}}.
+        '''
+        rows = self.db.execute('SELECT base, search_filter, attributes, '
+            'last_modified, refreshed FROM subtrees')
+        return {base: {'search_filter': search_filter,
+                       'attributes': json.loads(attributes),
+                       'last_modified': last_modified,
+                       'refreshed': refreshed}
+                for base, search_filter, attributes, last_modified, refreshed in rows}
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+
+    def _store(self, responses):
+        '''
+        Insert or replace entries from search responses. Returns the number of
+        entries stored and the newest modifyTimestamp seen.
+        '''
+        stored = 0
+        newest = None
+        for res in responses:
+            key, depth = _key(res['dn'])
+            attributes = res['attributes']
+            for name, raw in res['raw_attributes'].items():
+                if name.lower() == 'modifytimestamp' and raw:
+                    timestamp = raw[0].decode('utf-8')
+                    if newest is None or timestamp > newest:
+                        newest = timestamp
+
+            self.db.execute('DELETE FROM attribute_index WHERE key = ?', (key,))
+            self.db.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)',
+                (key, res['dn'], depth, json.dumps({name: [_encode(v) for v in
+                (values if isinstance(values, list) else [values])]
+                for name, values in attributes.items()})))
+            self.db.executemany('INSERT INTO attribute_index VALUES (?, ?, ?)',
+                [(key, name.lower(), text)
+                 for name, values in attributes.items() if name.lower() in self.indexed
+                 for text in map(_as_text, values if isinstance(values, list) else [values])
+                 if text is not None])
+            stored += 1
+
+        return stored, newest
+
+    def _delete(self, keys):
+        for key in keys:
+            self.db.execute('DELETE FROM entries WHERE key = ?', (key,))
+            self.db.execute('DELETE FROM attribute_index WHERE key = ?', (key,))
+
+    def _save_types(self, con, responses):
+        '''
+        Record the column type of every attribute stored, from the server
+        schema, as responses pass through.
+        '''
+        seen = set()
+        for res in responses:
+            seen.update(res['attributes'])
+            yield res
+
+        types = column_types(con.server.schema if con.server else None, seen)
+        self.db.executemany('INSERT OR REPLACE INTO attribute_types VALUES (?, ?)',
+            types.items())
+
+    def refresh(self, con, search_base=None, search_filter=None,
+                attributes=None, full=False, find_deleted=True, page_size=500):
+        '''
+        Bring a subtree of the mirror up to date. The first time a subtree is
+        refreshed (or if full is True), every entry is fetched. After that,
+        only entries modified since the last refresh are fetched, and entries
+        that were deleted are removed. The search_filter and attributes used
+        the first time are used again by later refreshes unless others are
+        given (which fetches every entry again).
+
+        :param con: A bound Connection to fetch entries with.
+        :param search_base: Subtree to mirror. Defaults to the base DN.
+        :param search_filter: Only mirror entries matching this filter.
+            Defaults to every entry.
+        :param attributes: Attributes to mirror. Defaults to all of them.
+        :param full: Fetch every entry again, even if the subtree has been
+            mirrored before.
+        :param find_deleted: Find entries that were deleted or moved since the
+            last refresh. This fetches the DN of every entry in the subtree
+            with a paged search, which is most of the cost of refreshing a
+            large subtree that barely changed. If False, deleted entries stay
+            in the mirror until a refresh that looks for them.
+        :param page_size: Number of entries fetched per page.
+        :return: A dict with the number of entries "updated" and "deleted".
+        '''
+        if search_base is None:
+            search_base = con.base_dn()
+
+        if isinstance(attributes, str):
+            attributes = [attributes]
+
+        base_key, _ = _key(search_base)
+        previous = self.subtrees().get(search_base, {})
+        if search_filter is None:
+            search_filter = previous.get('search_filter', '(objectClass=*)')
+        if attributes is None:
+            attributes = previous.get('attributes', [ldap3.ALL_ATTRIBUTES])
+
+        last_modified = previous.get('last_modified')
+        if full or search_filter != previous.get('search_filter') or \
+                attributes != previous.get('attributes'):
+            last_modified = None
+
+        # modifyTimestamp is operational, so must be asked for. objectClass is
+        # always kept, so filters on it work like they would on the server.
+        fetch = list(attributes or []) + ['objectClass', 'modifyTimestamp']
+        where, params = _subtree('key', base_key)
+        deleted = 0
+        with self.db:
+            if last_modified is None:
+                self.db.execute('DELETE FROM entries WHERE ' + where, params)
+                self.db.execute('DELETE FROM attribute_index WHERE ' + where, params)
+                updated, newest = self._store(self._save_types(con, con._responses(
+                    search_filter, fetch, search_base, stream=True,
+                    page_size=page_size)))
+            else:
+                updated, newest = self._store(self._save_types(con, con._responses(
+                    '(&{}(modifyTimestamp>={}))'.format(search_filter, last_modified),
+                    fetch, search_base, stream=True, page_size=page_size)))
+
+            if last_modified is not None and find_deleted:
+                # entries deleted since, or moved along with a parent (without
+                # their own modifyTimestamp changing), are found by their DN
+                mirrored = {key for key, in self.db.execute(
+                    'SELECT key FROM entries WHERE ' + where, params)}
+                dns = {}
+                for res in con._responses(search_filter, ldap3.NO_ATTRIBUTES,
+                        search_base, stream=True, page_size=page_size):
+                    dns[_key(res['dn'])[0]] = res['dn']
+
+                self._delete(mirrored - set(dns))
+                deleted = len(mirrored - set(dns))
+                for key in set(dns) - mirrored:
+                    moved, _ = self._store(self._save_types(con, con._responses(
+                        search_filter, fetch, dns[key], search_scope=ldap3.BASE)))
+                    updated += moved
+
+            if newest is None or (last_modified is not None and newest < last_modified):
+                newest = last_modified
+
+            self.db.execute('INSERT OR REPLACE INTO subtrees VALUES (?, ?, ?, ?, ?)',
+                (search_base, search_filter, json.dumps(attributes), newest, time.time()))
+
+        return {'updated': updated, 'deleted': deleted}
+
+    def _index_sql(self, node):
+        '''
+        Convert the parts of a filter that can use the index into SQL. Returns
+        None if no part of the filter can.
+        '''
+        operator = node[0]
+        if operator == '=' and node[1].lower() in self.indexed:
+            return 'key IN (SELECT key FROM attribute_index WHERE name = ? AND value = ?)', \
+                [node[1].lower(), node[2].lower()]
+        elif operator == 'present' and node[1].lower() in self.indexed:
+            return 'key IN (SELECT key FROM attribute_index WHERE name = ?)', \
+                [node[1].lower()]
+        elif operator == '&':
+            parts = [part for part in map(self._index_sql, node[1]) if part is not None]
+            if parts:
+                return ' AND '.join(sql for sql, _ in parts), \
+                    [param for _, params in parts for param in params]
+        elif operator == '|' and node[1]:
+            parts = list(map(self._index_sql, node[1]))
+            if None not in parts:
+                return '(' + ' OR '.join(sql for sql, _ in parts) + ')', \
+                    [param for _, params in parts for param in params]
+
+        return None
+
+    def _entries(self, search_filter, attributes, search_base,
+                 search_scope=ldap3.SUBTREE):
+        '''
+        Yield the (dn, attributes) of every mirrored entry matching a search.
+        '''
+        node = parse_filter(search_filter)
+        if attributes is None:
+            wanted = set()
+        elif isinstance(attributes, str):
+            wanted = {attributes.lower()}
+        else:
+            wanted = {name.lower() for name in attributes}
+
+        everything = '*' in wanted or '+' in wanted
+        clauses, params = [], []
+        if search_base is not None:
+            key, depth = _key(search_base)
+            if search_scope == ldap3.BASE:
+                clauses.append('key = ?')
+                params.append(key)
+            else:
+                sql, subtree_params = _subtree('key', key)
+                clauses.append(sql)
+                params.extend(subtree_params)
+                if search_scope == ldap3.LEVEL:
+                    clauses.append('depth = ?')
+                    params.append(depth + 1)
+
+        index = self._index_sql(node)
+        if index is not None:
+            clauses.append(index[0])
+            params.extend(index[1])
+
+        query = 'SELECT dn, attributes FROM entries'
+        if clauses:
+            query += ' WHERE ' + ' AND '.join(clauses)
+
+        for dn, stored in self.db.execute(query + ' ORDER BY key', params):
+            stored = json.loads(stored, object_hook=_decode)
+            if _matches(node, {name.lower(): values for name, values in stored.items()}):
+                yield dn, {name: values for name, values in stored.items()
+                    if everything or name.lower() in wanted}
+
+    def iter_search(self, search_filter='(objectClass=*)',
+                    attributes=ldap3.ALL_ATTRIBUTES, search_base=None,
+                    search_scope=ldap3.SUBTREE, **kwargs):
+        '''
+        Search the mirror, and yield one dict per entry found (like
+        Connection.iter_search()).
+        '''
+        for dn, entry in self._entries(search_filter, attributes, search_base,
+                search_scope):
+            yield dict([('dn', [dn])] + list(entry.items()))
+
+    def search_list(self, search_filter='(objectClass=*)',
+                    attributes=ldap3.ALL_ATTRIBUTES, search_base=None,
+                    search_scope=ldap3.SUBTREE, **kwargs):
+        '''
+        Search the mirror, and return a list of dicts, one per entry found
+        (like Connection.search_list()).
+        '''
+        return list(self.iter_search(search_filter, attributes, search_base,
+            search_scope))
+
+    def search_list_t(self, search_filter='(objectClass=*)',
+                      attributes=ldap3.ALL_ATTRIBUTES, search_base=None,
+                      unpack_lists=True, unpack_delimiter='|', explode=None,
+                      search_scope=ldap3.SUBTREE, **kwargs):
+        '''
+        Search the mirror, and return a dict of lists with one list per
+        attribute (like Connection.search_list_t()).
+        '''
+        builder = ColumnBuilder(attributes, unpack_lists=unpack_lists,
+            unpack_delimiter=unpack_delimiter, explode=explode)
+        for dn, entry in self._entries(search_filter, attributes, search_base,
+                search_scope):
+            builder.add(dn, entry)
+
+        return builder.columns()
+
+    def search_df(self, search_filter='(objectClass=*)',
+                  attributes=ldap3.ALL_ATTRIBUTES, search_base=None,
+                  typed=False, **kwargs):
+        '''
+        Search the mirror, and return a Pandas DataFrame (like
+        Connection.search_df()). If typed is True, column types come from the
+        server schema at the time entries were mirrored.
+        '''
+        try:
+            import pandas
+        except ModuleNotFoundError as e:
+            raise ModuleNotFoundError('This function requires the pandas package to be installed.') from e
+
+        df = pandas.DataFrame(self.search_list_t(search_filter,
+            attributes=attributes, search_base=search_base, **kwargs))
+        if not typed:
+            return df
+
+        types = dict(self.db.execute('SELECT name, kind FROM attribute_types'))
+        return typed_dataframe(df, {name: types[name] for name in df.columns
+            if name in types})
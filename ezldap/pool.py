@@ -0,0 +1,328 @@
+'''
+A thread-safe pool of bound directory connections, for long-running services
+that would otherwise pay the cost of a new bind for every operation.
+'''
+
+import copy
+import time
+import getpass
+import threading
+import collections
+from contextlib import contextmanager
+
+from ldap3.core.exceptions import LDAPException, LDAPCommunicationError
+
+from .api import Connection
+from .config import config
+
+
+class PoolExhaustedError(RuntimeError):
+    '''
+    Raised when no connection could be checked out of a pool before the
+    checkout timeout expired.
+    '''
+    pass
+
+
+def auto_pool(conf=None, **kwargs):
+    '''
+    Automatically detects LDAP config values and returns a connection pool.
+    Behaves like ezldap.auto_bind(), but for ConnectionPool. Any extra keyword
+    arguments are passed to ConnectionPool().
+    '''
+    if conf is None:
+        conf = config()
+
+    if conf['binddn'] is not None and conf['bindpw'] is None:
+        conf['bindpw'] = getpass.getpass('Enter bind DN password...')
+
+    return ConnectionPool(conf['host'], user=conf['binddn'],
+        password=conf['bindpw'], conf=conf, **kwargs)
+
+
+class ConnectionPool:
+    '''
+    A thread-safe pool of ezldap Connections. Connections are created on demand
+    (up to max_size), validated on checkout, and transparently replaced if they
+    have been dropped by the server. Use ConnectionPool.connection() with the
+    "with" keyword to check out a connection and automatically return it when
+    done. When used with the "with" keyword itself, the pool is closed (and all
+    connections unbound) when done.
+    '''
+
+    def __init__(self, host, user=None, password=None, conf=None,
+        min_size=1, max_size=10, idle_timeout=300, max_lifetime=3600,
+        checkout_timeout=None, validate=True, **kwargs):
+        '''
+        :param host: An LDAP server URI (eg. ldaps://someserver:636)
+        :param user: Bind user. If None, binds will be anonymous.
+        :param password: Bind password. If None, binds will be anonymous.
+        :param conf: A dict of configuration values, such as those generated by
+            ezldap.config(). Each connection receives its own copy.
+        :param min_size: Number of connections to open immediately and keep
+            open even when idle. Connections that are dropped (for instance,
+            after max_lifetime) are replaced to keep the pool at this size.
+        :param max_size: Maximum number of connections open at once.
+        :param idle_timeout: Seconds an idle connection (beyond min_size) is
+            kept before it is unbound. None keeps idle connections forever.
+        :param max_lifetime: Seconds after which a connection is unbound and
+            replaced, regardless of use. None keeps connections forever.
+        :param checkout_timeout: Seconds to wait for a free connection when the
+            pool is at max_size. None waits forever.
+        :param validate: Whether to check that a connection is still alive
+            (using a "Who am I?" operation) before handing it out.
+        :param kwargs: Any other arguments are passed to ezldap.Connection().
+        '''
+        if host is None:
+            raise ValueError('LDAP host cannot be None.')
+
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError('Pool sizes must satisfy 0 <= min_size <= max_size '
+                'and max_size >= 1.')
+
+        if conf is None:
+            conf = config()
+
+        conf.pop('binddn', None)
+        conf.pop('bindpw', None)
+        self.host = host
+        self.user = user
+        self.password = password
+        self.conf = conf
+        self.kwargs = kwargs
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.max_lifetime = max_lifetime
+        self.checkout_timeout = checkout_timeout
+        self.validate = validate
+        self.closed = False
+
+        self._cond = threading.Condition()
+        # idle connections are stored as (connection, created, last_used)
+        self._idle = collections.deque()
+        # creation times of checked out connections, keyed by id()
+        self._in_use = {}
+        self._size = 0
+
+        for _ in range(min_size):
+            self._size += 1
+            self._idle.append((self._connect(), time.time(), time.time()))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type_, value, traceback):
+        '''
+        Close the pool when used with "with" keyword.
+        '''
+        self.close()
+
+    def __len__(self):
+        '''
+        Number of connections currently open (both idle and checked out).
+        '''
+        return self._size
+
+    def _connect(self):
+        return Connection(self.host, user=self.user, password=self.password,
+            conf=copy.deepcopy(self.conf), **self.kwargs)
+
+    def _expired(self, created, now):
+        return self.max_lifetime is not None and now - created > self.max_lifetime
+
+    def _prune(self, now):
+        '''
+        Remove expired and long-idle connections from the idle queue. Must be
+        called with the lock held, returns the connections to unbind.
+        '''
+        dropped = []
+        keep = collections.deque()
+        for con, created, last_used in self._idle:
+            idle_expired = self.idle_timeout is not None \
+                and now - last_used > self.idle_timeout \
+                and self._size - len(dropped) > self.min_size
+            if con.closed or idle_expired or self._expired(created, now):
+                dropped.append(con)
+            else:
+                keep.append((con, created, last_used))
+
+        self._idle = keep
+        self._size -= len(dropped)
+        return dropped
+
+    def _replenish(self):
+        '''
+        Open new connections until the pool is back to min_size, after
+        connections were dropped. Must be called without the lock held.
+        '''
+        with self._cond:
+            missing = 0 if self.closed else max(self.min_size - self._size, 0)
+            self._size += missing
+
+        for _ in range(missing):
+            try:
+                con = self._connect()
+            except LDAPException:
+                # try again the next time connections are dropped
+                with self._cond:
+                    self._size -= 1
+                    self._cond.notify()
+
+                continue
+
+            with self._cond:
+                closed = self.closed
+                if closed:
+                    self._size -= 1
+                else:
+                    now = time.time()
+                    self._idle.appendleft((con, now, now))
+                    self._cond.notify()
+
+            if closed:
+                self._unbind([con])
+
+    def _healthy(self, con):
+        '''
+        Cheaply check that a connection is still bound and responsive.
+        '''
+        if con.closed or not con.bound:
+            return False
+
+        try:
+            con.who_am_i()
+        except LDAPException:
+            return False
+
+        return con.result is not None and con.result['result'] == 0
+
+    @staticmethod
+    def _unbind(connections):
+        for con in connections:
+            try:
+                con.unbind()
+            except LDAPException:
+                # the connection is being thrown away, we don't care
+                pass
+
+    def checkout(self, timeout=None):
+        '''
+        Check out a connection from the pool. The connection must be returned
+        with checkin() when done (or use connection() instead).
+
+        :param timeout: Seconds to wait for a connection if the pool is
+            exhausted. Defaults to the pool's checkout_timeout.
+        :return: A bound ezldap.Connection.
+        '''
+        if timeout is None:
+            timeout = self.checkout_timeout
+
+        deadline = None if timeout is None else time.time() + timeout
+        con = None
+        dropped = []
+        try:
+            with self._cond:
+                while True:
+                    if self.closed:
+                        raise PoolExhaustedError('Connection pool is closed.')
+
+                    dropped.extend(self._prune(time.time()))
+                    if self._idle:
+                        # most recently used connections are reused first
+                        con, created, _ = self._idle.pop()
+                        break
+                    elif self._size < self.max_size:
+                        self._size += 1
+                        break
+
+                    remaining = None if deadline is None else deadline - time.time()
+                    if remaining is not None and remaining <= 0:
+                        raise PoolExhaustedError('No connection available '
+                            'after {} seconds.'.format(timeout))
+
+                    self._cond.wait(remaining)
+        finally:
+            self._unbind(dropped)
+
+        if con is not None and self.validate and not self._healthy(con):
+            # drop the broken connection and bind a new one in its place
+            self._unbind([con])
+            con = None
+
+        if con is None:
+            try:
+                con = self._connect()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                    self._cond.notify()
+
+                raise
+
+            created = time.time()
+
+        with self._cond:
+            self._in_use[id(con)] = created
+
+        if dropped:
+            self._replenish()
+
+        return con
+
+    def checkin(self, con, discard=False):
+        '''
+        Return a connection to the pool.
+
+        :param con: A connection previously returned by checkout().
+        :param discard: Unbind the connection instead of keeping it for reuse
+            (for instance, if it is known to be broken).
+        '''
+        now = time.time()
+        with self._cond:
+            created = self._in_use.pop(id(con))
+            if discard or self.closed or con.closed \
+                    or self._expired(created, now):
+                self._size -= 1
+                con_unbind = [con]
+            else:
+                self._idle.append((con, created, now))
+                con_unbind = []
+
+            self._cond.notify()
+
+        self._unbind(con_unbind)
+        if con_unbind:
+            self._replenish()
+
+    @contextmanager
+    def connection(self, timeout=None):
+        '''
+        Check out a connection for use with the "with" keyword. The connection
+        is returned to the pool when done.
+        '''
+        con = self.checkout(timeout)
+        try:
+            yield con
+        except LDAPCommunicationError:
+            self.checkin(con, discard=True)
+            raise
+        except BaseException:
+            self.checkin(con)
+            raise
+        else:
+            self.checkin(con)
+
+    def close(self):
+        '''
+        Unbind all idle connections. Connections that are currently checked out
+        are unbound when they are returned.
+        '''
+        with self._cond:
+            self.closed = True
+            idle = [con for con, _, _ in self._idle]
+            self._idle.clear()
+            self._size -= len(idle)
+            self._cond.notify_all()
+
+        self._unbind(idle)
@@ -17,6 +17,7 @@ setup(
     scripts=['bin/ezldap'],
     include_package_data=True,
     zip_safe=False,
+    python_requires='>=3.7',
     install_requires=[
         'PyYAML',
         'ldap3'
@@ -30,9 +31,11 @@ setup(
         'docker-compose'
     ],
     classifiers=[
-        'Programming Language :: Python :: 3.4',
-        'Programming Language :: Python :: 3.5',
-        'Programming Language :: Python :: 3.6',
+        'Programming Language :: Python :: 3.7',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
         'Programming Language :: Python :: 3 :: Only',
         'Operating System :: POSIX :: Linux',
         'Operating System :: Unix',
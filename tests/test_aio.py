@@ -0,0 +1,152 @@
+'''
+Test AsyncConnection against ldap3's in-process mock server, and slapd.
+'''
+
+import copy
+import asyncio
+import pytest
+import ldap3
+from ldap3.core.exceptions import LDAPResponseTimeoutError
+import ezldap
+import ezldap.aio
+
+PREFIX = 'ezldap/templates/'
+MOCK_CONF = {
+    'starttls': False,
+    'groupdn': 'ou=Group,dc=ezldap,dc=io',
+    'peopledn': 'ou=People,dc=ezldap,dc=io',
+    'hostsdn': 'ou=Hosts,dc=ezldap,dc=io',
+    'homedir': '/home'
+}
+
+
+async def mock_connection():
+    '''
+    An AsyncConnection to an in-memory directory with the usual OUs.
+    '''
+    con = ezldap.AsyncConnection('ldap://localhost', conf=dict(MOCK_CONF),
+        client_strategy=ldap3.MOCK_ASYNC, server_info=False)
+    await con.open()
+    strategy = con.con.strategy
+    strategy.add_entry('dc=ezldap,dc=io', {'objectClass': ['top', 'domain'],
+        'dc': 'ezldap'})
+    for ou in ['People', 'Group', 'Hosts']:
+        strategy.add_entry('ou={},dc=ezldap,dc=io'.format(ou),
+            {'objectClass': ['organizationalUnit'], 'ou': ou})
+
+    # the mock server has no rootDSE to read the naming context from
+    con.con._base_dn = 'dc=ezldap,dc=io'
+    return con
+
+
+@pytest.fixture(params=['internals', 'get_response'])
+def poll_mode(request, monkeypatch):
+    '''
+    Run a test with both ways of checking for responses: reading ldap3's
+    internals, and the get_response() fallback used for unknown ldap3 versions.
+    '''
+    if request.param == 'get_response':
+        monkeypatch.setattr(ezldap.aio, 'LDAP3_VERSION', (0, 0))
+
+    return request.param
+
+
+def test_async_concurrent_users():
+    '''
+    Do concurrent add_user() calls share one connection and get unique uids?
+    '''
+    async def run():
+        async with await mock_connection() as con:
+            await con.add_group('async_group', ldif_path=PREFIX+'add_group.ldif')
+            results = await asyncio.gather(*[con.add_user('async{}'.format(i),
+                'async_group', 'password', ldif_path=PREFIX+'add_user.ldif')
+                for i in range(20)])
+            users = await asyncio.gather(*[con.get_user('async{}'.format(i))
+                for i in range(20)])
+            return results, users
+
+    results, users = asyncio.run(run())
+    assert all(res[0]['result'] == 0 for res in results)
+    assert len({user['uidNumber'][0] for user in users}) == 20
+
+
+def test_async_search(poll_mode):
+    '''
+    Do searches, paged searches and modifications work when awaited?
+    '''
+    async def run():
+        async with await mock_connection() as con:
+            assert con._poller.internals == (poll_mode == 'internals')
+            ldif = [{'dn': ['cn=async{},ou=Hosts,dc=ezldap,dc=io'.format(i)],
+                     'objectClass': ['device'],
+                     'cn': ['async{}'.format(i)]} for i in range(12)]
+            ldif.insert(5, ldif[0])
+            added = await con.ldif_add((entry for entry in ldif), max_in_flight=4)
+            paged = [entry async for entry in con.iter_search('(objectClass=device)',
+                ['cn'], page_size=5)]
+            await con.modify_replace('cn=async1,ou=Hosts,dc=ezldap,dc=io',
+                'description', 'changed')
+            return added, paged, await con.search_list_t('(cn=async1)',
+                ['description']), await con.exists('cn=async99,ou=Hosts,dc=ezldap,dc=io')
+
+    added, paged, query, exists = asyncio.run(run())
+    assert [res['result'] == 0 for res in added].count(True) == 12
+    assert added[5]['result'] != 0
+    assert len(paged) == 12
+    assert query['description'] == ['changed']
+    assert not exists
+
+
+def test_async_pending_ids_timeout(monkeypatch):
+    '''
+    Are explicit uidNumbers marked used when the first get_response() call
+    times out before the add has completed?
+    '''
+    monkeypatch.setattr(ezldap.aio, 'LDAP3_VERSION', (0, 0))
+
+    async def run():
+        async with await mock_connection() as con:
+            uidn = await con.next_uidn()
+            get_response = con.con._strategy_get_response
+            timed_out = []
+
+            def slow_get_response(msgid, *args, **kwargs):
+                if msgid not in timed_out:
+                    timed_out.append(msgid)
+                    raise LDAPResponseTimeoutError('no response yet')
+                return get_response(msgid, *args, **kwargs)
+
+            monkeypatch.setattr(con.con, '_strategy_get_response',
+                slow_get_response)
+            result = await con.add('uid=explicit,ou=People,dc=ezldap,dc=io',
+                ['posixAccount', 'account'], {'uid': 'explicit', 'cn': 'explicit',
+                'uidNumber': uidn, 'gidNumber': 10000,
+                'homeDirectory': '/home/explicit'})
+            return uidn, result, timed_out, await con.next_uidn()
+
+    uidn, result, timed_out, next_uidn = asyncio.run(run())
+    assert result['result'] == 0
+    assert timed_out
+    assert next_uidn != uidn
+
+
+def test_async_slapd(slapd, config, poll_mode):
+    '''
+    Are concurrent operations over a real asynchronous connection matched to
+    the right responses?
+    '''
+    groupname = 'async_slapd_' + poll_mode
+
+    async def run():
+        async with ezldap.AsyncConnection(config['host'], config['binddn'],
+                config['bindpw'], conf=copy.deepcopy(config)) as con:
+            await con.add_group(groupname, ldif_path=PREFIX+'add_group.ldif')
+            return await asyncio.gather(con.get_group(groupname),
+                con.get_user('nobody_here'), con.exists('ou=People,dc=ezldap,dc=io'),
+                con.base_dn())
+
+    group, user, exists, base_dn = asyncio.run(run())
+    assert group['cn'] == [groupname]
+    assert user is None
+    assert exists
+    assert base_dn == 'dc=ezldap,dc=io'
@@ -2,7 +2,10 @@
 Test ldap operations on a test instance of slapd.
 '''
 
+import sys
+import copy
 import pytest
+import ldap3
 import ezldap
 
 PREFIX = 'ezldap/templates/'
@@ -29,6 +32,52 @@ def test_starttls(slapd):
     assert not slapd.server.ssl
 
 
+def test_starttls_cache(slapd, config):
+    '''
+    Is the result of the StartTLS probe cached per URI?
+    '''
+    assert ezldap.supports_starttls(config['host'])
+    cached = ezldap.api._starttls_cache[ezldap.clean_uri(config['host'])]
+    assert cached['starttls']
+    assert ezldap.supports_starttls(config['host'] + '/')
+
+
+def test_starttls_declared(slapd, config):
+    '''
+    Declaring the TLS mode in the config should skip the probe.
+    '''
+    conf = dict(config)
+    conf['starttls'] = False
+    with ezldap.Connection(conf['host'], conf=conf) as con:
+        assert not con.tls_started
+
+
+def test_server_info_cache(slapd, config, tmpdir, monkeypatch):
+    '''
+    Server info and schema should be cached on disk and reused.
+    '''
+    monkeypatch.setattr(ezldap.cache, 'CACHE_DIR', str(tmpdir))
+    conf = dict(config)
+    conf['persistent_cache'] = True
+    with ezldap.Connection(conf['host'], conf=dict(conf)) as con:
+        assert con.base_dn() == 'dc=ezldap,dc=io'
+        assert 'posixAccount' in con.server.schema.object_classes
+
+    assert len(tmpdir.listdir(lambda p: p.ext == '.json')) == 1
+    with ezldap.Connection(conf['host'], conf=dict(conf)) as con:
+        assert con.base_dn() == 'dc=ezldap,dc=io'
+        assert 'posixAccount' in con.server.schema.object_classes
+
+
+def test_no_server_info(slapd, config):
+    '''
+    base_dn() should still work without server info.
+    '''
+    with ezldap.auto_bind(dict(config), server_info=False) as con:
+        assert con.server.info is None
+        assert con.base_dn() == 'dc=ezldap,dc=io'
+
+
 def test_636(slapd):
     ssl = ezldap.Connection('ldaps://localhost')
     assert ssl.server.ssl
@@ -85,6 +134,74 @@ def test_search_list_encapsulation(slapd):
             assert isinstance(v, list)
 
 
+def test_iter_search(slapd):
+    '''
+    Does the paged iter_search() return the same entries as search_list()?
+    '''
+    query = slapd.search_list()
+    paged = list(slapd.iter_search(page_size=2))
+    assert len(paged) == len(query)
+    assert {res['dn'][0] for res in paged} == {res['dn'][0] for res in query}
+    for res in paged:
+        for v in res.values():
+            assert isinstance(v, list)
+
+
+def test_search_dn(slapd):
+    '''
+    search_dn() should find the same DNs as checking every DN.
+    '''
+    every_dn = [e['dn'][0] for e in slapd.iter_search(attributes=None)]
+    for keyword in ['People', 'people', 'Manager', 'uid', 'ezldap', 'ou=G']:
+        expected = sorted(dn for dn in every_dn if keyword in dn)
+        assert sorted(slapd.search_dn(keyword)) == expected
+
+    expected = sorted(dn for dn in every_dn if 'people' in dn.lower())
+    assert sorted(slapd.search_dn('people', ignore_case=True)) == expected
+    expected = sorted(dn for dn in every_dn if dn.startswith('ou='))
+    assert sorted(slapd.search_dn('^ou=', regex=True)) == expected
+    with pytest.raises(ValueError):
+        slapd.search_dn('(', regex=True)
+
+
+def test_search_dn_searches(slapd, monkeypatch):
+    '''
+    Are descendants of matches fetched in one search, not one per match?
+    '''
+    slapd.add_group('searchdn', ldif_path=PREFIX+'add_group.ldif')
+    for i in range(5):
+        slapd.add_user('searchdn{}'.format(i), 'searchdn', 'test1234',
+            ldif_path=PREFIX+'add_user.ldif')
+
+    searches = []
+    search = slapd.search
+
+    def counted_search(*args, **kwargs):
+        searches.append(args)
+        return search(*args, **kwargs)
+
+    monkeypatch.setattr(slapd, 'search', counted_search)
+    base = 'dc=ezldap,dc=io'
+    # leaf entries are reported by hasSubordinates and need no more searches
+    assert len(list(slapd.search_dn('searchdn', search_base=base))) == 6
+    assert len(searches) == 1
+    # ou=People has children, which are fetched with a single extra search
+    searches.clear()
+    dns = list(slapd.search_dn('People', search_base=base))
+    assert 'uid=searchdn0,ou=People,dc=ezldap,dc=io' in dns
+    assert len(dns) == len(set(dns))
+    assert len(searches) == 2
+
+
+def test_search_list_stream(slapd):
+    '''
+    search_list(stream=True) should return a generator instead of a list.
+    '''
+    stream = slapd.search_list('(objectClass=organizationalUnit)', stream=True)
+    assert not isinstance(stream, list)
+    assert {res['ou'][0] for res in stream} == {'Group', 'People', 'Hosts'}
+
+
 def test_search_list_t(slapd):
     '''
     Does search_list_t() return data properly?
@@ -136,6 +253,75 @@ def test_search_df(slapd):
     assert 'dcObject' in ezldapio['objectClass'].iloc[0]
 
 
+def test_search_list_t_columns(slapd):
+    '''
+    Can search_list_t() keep lists, explode values and stream pages?
+    '''
+    query = slapd.search_list_t('(objectClass=organizationalUnit)', ['ou'],
+        unpack_lists=False)
+    assert ['People'] in query['ou']
+    assert all(isinstance(dn, list) for dn in query['dn'])
+
+    query = slapd.search_list_t('(dc=ezldap)', ['dc', 'objectClass'],
+        explode='objectClass', stream=True, page_size=1)
+    assert set(query['objectClass']) == {'top', 'dcObject', 'organization'}
+    assert query['dn'] == ['dc=ezldap,dc=io'] * len(query['objectClass'])
+    assert query['dc'] == ['ezldap'] * len(query['objectClass'])
+
+
+def test_search_df_typed(slapd):
+    '''
+    Are integer and timestamp attributes given a matching dtype?
+    '''
+    slapd.add_group('typed_df_test', ldif_path=PREFIX+'add_group.ldif')
+    df = slapd.search_df('(objectClass=posixGroup)',
+        ['cn', 'gidNumber', 'modifyTimestamp'], typed=True)
+    assert str(df['gidNumber'].dtype) == 'Int64'
+    assert str(df['modifyTimestamp'].dtype).startswith('datetime64')
+    assert str(slapd.search_df('(objectClass=posixGroup)',
+        ['gidNumber'])['gidNumber'].dtype) != 'Int64'
+
+
+def test_search_arrow(slapd, tmpdir):
+    '''
+    Are arrow results typed and written to Parquet, Arrow and CSV files?
+    '''
+    pyarrow = pytest.importorskip('pyarrow')
+    import pyarrow.parquet
+    slapd.add_group('arrow_test', ldif_path=PREFIX+'add_group.ldif')
+    table = slapd.search_arrow('(objectClass=posixGroup)',
+        ['cn', 'gidNumber', 'modifyTimestamp'])
+    assert 'arrow_test' in table.column('cn').to_pylist()
+    assert table.schema.field('gidNumber').type == pyarrow.int64()
+    assert pyarrow.types.is_timestamp(table.schema.field('modifyTimestamp').type)
+
+    # batches of one entry at a time still produce the same table
+    batches = list(slapd.iter_arrow('(objectClass=posixGroup)', batch_size=1))
+    assert len(batches) == table.num_rows
+    assert all(batch.schema == batches[0].schema for batch in batches)
+
+    path = str(tmpdir.join('snapshot.parquet'))
+    rows = slapd.export(path, search_filter='(objectClass=posixGroup)')
+    assert pyarrow.parquet.read_table(path).num_rows == rows == table.num_rows
+    path = str(tmpdir.join('snapshot.arrow'))
+    slapd.export(path, search_filter='(objectClass=posixGroup)', batch_size=1)
+    with pyarrow.memory_map(path) as source:
+        assert pyarrow.ipc.open_file(source).read_all().num_rows == rows
+    path = str(tmpdir.join('snapshot.csv'))
+    slapd.export(path, search_filter='(objectClass=posixGroup)')
+    with open(path) as handle:
+        assert len(handle.readlines()) == rows + 1
+
+
+def test_search_arrow_missing(slapd, monkeypatch):
+    '''
+    Is a missing pyarrow package reported with a helpful error?
+    '''
+    monkeypatch.setitem(sys.modules, 'pyarrow', None)
+    with pytest.raises(ModuleNotFoundError, match='requires the pyarrow'):
+        slapd.search_arrow('(objectClass=posixGroup)')
+
+
 def test_exists(slapd):
     '''
     Can we properly detect if entities exist or not.
@@ -144,6 +330,84 @@ def test_exists(slapd):
     assert not slapd.exists('uid=ooga,ou=booga,dc=ezldap,dc=io')
 
 
+def test_exists_many(slapd, config):
+    '''
+    Are existing DNs found with both grouped and pipelined searches?
+    '''
+    dns = ['ou=People,dc=ezldap,dc=io', 'OU=group,dc=ezldap,dc=io',
+        'dc=ezldap,dc=io', 'ou=nope,dc=ezldap,dc=io',
+        'uid=ooga,ou=booga,dc=ezldap,dc=io', 'not a dn']
+    expected = set(dns[:3])
+    assert slapd.exists_many(dns) == expected
+    assert slapd.exists_many(dns, chunk_size=1) == expected
+    with ezldap.Connection(config['host'], conf=dict(config),
+            client_strategy=ldap3.ASYNC) as con:
+        assert con.exists_many(dns, max_in_flight=2) == expected
+
+
+def test_next_uidn(slapd):
+    '''
+    Are reserved uid numbers unique and never handed out twice?
+    '''
+    first = slapd.next_uidn(reserve=True)
+    second = slapd.next_uidn(reserve=True)
+    assert second > first
+    assert slapd.next_uidn() not in {first, second}
+    assert first in slapd.id_allocator()
+
+    allocator = slapd.id_allocator()
+    slapd.reset_allocators()
+    assert slapd.id_allocator() is not allocator
+
+
+def test_id_allocator_fill_gaps(slapd):
+    '''
+    Does the allocator hand out the lowest free ID when filling gaps?
+    '''
+    allocator = ezldap.IDAllocator(slapd, '(objectClass=posixGroup)',
+        id_start=10000, attribute='gidNumber', fill_gaps=True)
+    allocator.mark_used(10000)
+    allocator.mark_used(10002)
+    taken = allocator.allocate()
+    assert taken >= 10001
+    assert taken not in {10000, 10002}
+    allocator.release(taken)
+    assert allocator.peek() == taken
+
+
+def test_id_allocator_counter(slapd, monkeypatch):
+    '''
+    Are IDs reserved atomically from a counter entry, without scanning the
+    directory?
+    '''
+    slapd.add_group('id_counter', gid=60000, ldif_path=PREFIX+'add_group.ldif')
+    counter_dn = 'cn=id_counter,ou=Group,dc=ezldap,dc=io'
+    allocator = ezldap.IDAllocator(slapd, counter_dn=counter_dn,
+        counter_attribute='gidNumber')
+
+    def no_scan(*args, **kwargs):
+        raise AssertionError('counter mode should not scan the directory')
+
+    monkeypatch.setattr(slapd, 'iter_search', no_scan)
+    assert allocator.peek() == 60000
+    assert allocator.allocate() == 60000
+    assert allocator.reserve(10) == 60001
+    assert slapd.get_group('id_counter')['gidNumber'][0] == 60011
+
+
+def test_failed_add_keeps_id(slapd):
+    '''
+    IDs should only be marked as used once an add succeeds.
+    '''
+    slapd.add_group('failed_add', gid=61000, ldif_path=PREFIX+'add_group.ldif')
+    allocator = slapd.id_allocator('(objectClass=posixGroup)',
+        attribute='gidNumber')
+    assert 61001 not in allocator
+    assert not slapd.add('cn=failed_add,ou=Group,dc=ezldap,dc=io',
+        ['posixGroup'], {'cn': 'failed_add', 'gidNumber': 61001})
+    assert 61001 not in allocator
+
+
 def test_add_group(slapd):
     '''
     Test adding a group.
@@ -173,6 +437,61 @@ def test_add_user(slapd):
     assert ezldap.ssha_check(passwd, 'test1234')
 
 
+def test_get_users(slapd):
+    '''
+    Are many users looked up at once, with missing users reported as None?
+    '''
+    slapd.add_group('getusers', ldif_path=PREFIX+'add_group.ldif')
+    for name in ['getusers1', 'getusers2', 'getusers3']:
+        slapd.add_user(name, 'getusers', 'test1234', ldif_path=PREFIX+'add_user.ldif')
+
+    users = slapd.get_users(['getusers1', 'GETUSERS2', 'getusers3',
+        'getusers*', 'nobody)(uid=*'], chunk_size=2)
+    assert users['getusers1']['uid'] == ['getusers1']
+    assert users['GETUSERS2']['dn'] == ['uid=getusers2,ou=People,dc=ezldap,dc=io']
+    assert users['getusers3'] is not None
+    # filter characters are escaped, not used as wildcards
+    assert users['getusers*'] is None
+    assert users['nobody)(uid=*'] is None
+    assert slapd.get_groups(['getusers', 'nogroup']) == \
+        {'getusers': slapd.get_group('getusers'), 'nogroup': None}
+
+    # homeDirectory is case-sensitive, so names are searched for as given
+    slapd.add_user('GetUsersCase', 'getusers', 'test1234',
+        ldif_path=PREFIX+'add_user.ldif')
+    home = slapd.get_user('GetUsersCase')['homeDirectory'][0]
+    users = slapd.get_users([home], index='homeDirectory')
+    assert users[home]['uid'] == ['GetUsersCase']
+
+
+def test_entry_cache(slapd, config):
+    '''
+    Are repeated lookups cached, and dropped when this connection changes them?
+    '''
+    with ezldap.auto_bind(dict(config)) as con:
+        cache = con.enable_cache()
+        assert con.get_group('cached_group') is None
+        con.add_group('cached_group', ldif_path=PREFIX+'add_group.ldif')
+        gid = con.get_group('cached_group')['gidNumber']
+        assert con.get_group('cached_group')['gidNumber'] == gid
+        assert cache.stats()['hits'] == 1
+
+        con.modify_replace(con.get_group('cached_group')['dn'][0],
+            'description', 'changed')
+        assert con.get_group('cached_group')['description'] == ['changed']
+
+        # writes made over parallel worker connections invalidate it too
+        assert con.get_user('cached_bulk') is None
+        reports = con.bulk_add_users([{'username': 'cached_bulk'},
+            {'username': 'cached_bulk2'}], workers=2,
+            ldif_user=PREFIX+'add_user.ldif', ldif_group=PREFIX+'add_group.ldif',
+            ldif_add_to_group=PREFIX+'add_to_group.ldif')
+        assert all(r['success'] for r in reports)
+        assert con.get_user('cached_bulk') is not None
+        con.disable_cache()
+        assert con.cache is None
+
+
 def test_add_to_group(slapd):
     '''
     Test adding a user to a group using ldif templates.
@@ -285,6 +604,25 @@ def test_ldif_add(slapd):
     assert group['cn'][0] == 'somegroup'
 
 
+def test_ldif_ops_do_not_modify(slapd):
+    '''
+    ldif_add() and ldif_modify() should never modify the caller's entries.
+    '''
+    ldif = [{'dn': ['cn=unmodified,ou=Group,dc=ezldap,dc=io'],
+             'objectClass': ['top', 'posixGroup'],
+             'cn': ['unmodified'],
+             'gidNumber': ['71000']}]
+    orig = copy.deepcopy(ldif)
+    assert slapd.ldif_add(ldif)[0]['result'] == 0
+    assert ldif == orig
+
+    changes = [{'dn': ['cn=unmodified,ou=Group,dc=ezldap,dc=io'],
+                'memberUid': [(ldap3.MODIFY_ADD, ['someone'])]}]
+    orig = copy.deepcopy(changes)
+    assert slapd.ldif_modify(changes)[0]['result'] == 0
+    assert changes == orig
+
+
 def test_ldif_add_fail(slapd):
     '''
     Does Connection.ldif_add() add entries properly?
@@ -295,6 +633,27 @@ def test_ldif_add_fail(slapd):
     assert slapd.get_user('someuser2') is None
 
 
+def test_ldif_add_pipelined(slapd, config):
+    '''
+    Are pipelined adds over an asynchronous connection returned in order?
+    '''
+    ldif = [{'dn': ['cn=pipelined{},ou=Group,dc=ezldap,dc=io'.format(i)],
+             'objectClass': ['top', 'posixGroup'],
+             'cn': ['pipelined{}'.format(i)],
+             'gidNumber': [str(70000 + i)]} for i in range(20)]
+    # a duplicate in the middle should fail without affecting the others
+    ldif.insert(10, ldif[0])
+    with ezldap.Connection(config['host'], user=config['binddn'],
+            password=config['bindpw'], conf=dict(config),
+            client_strategy=ldap3.ASYNC) as con:
+        results = con.ldif_add(ldif, max_in_flight=4)
+
+    assert len(results) == 21
+    assert [res['result'] for res in results].count(0) == 20
+    assert results[10]['result'] != 0
+    assert slapd.get_group('pipelined19')['gidNumber'][0] == 70019
+
+
 def test_ldif_modify(slapd):
     '''
     Add an object then modify it with a giant ldif-change LDIF to test the
@@ -311,3 +670,70 @@ def test_ldif_modify(slapd):
     assert 'shadowLastChange' not in user.keys()
     assert 'gecos' not in user.keys()
     assert user['cn'][0] == 'New name'
+
+
+def test_bulk_add_users(slapd):
+    '''
+    Are users (and their groups) added in bulk, with failures reported per row?
+    '''
+    slapd.add_group('bulk_group', ldif_path=PREFIX+'add_group.ldif')
+    rows = [{'username': 'bulk1'},
+            {'username': 'bulk2', 'groupname': 'bulk_group', 'password': 'pw1234'},
+            {'username': 'bulk3', 'groupname': 'bulk_nonexistent'}]
+    reports = slapd.bulk_add_users(rows, workers=2,
+        ldif_user=PREFIX+'add_user.ldif', ldif_group=PREFIX+'add_group.ldif',
+        ldif_add_to_group=PREFIX+'add_to_group.ldif')
+    assert [r['success'] for r in reports] == [True, True, False]
+    assert reports[2]['message'] == 'Group does not exist'
+    assert 'bulk1' in slapd.get_group('bulk1')['memberUid']
+    assert 'bulk2' in slapd.get_group('bulk_group')['memberUid']
+    user = slapd.get_user('bulk2')
+    assert ezldap.ssha_check(user['userPassword'][0].decode(), 'pw1234')
+    assert reports[0]['uid'] != reports[1]['uid']
+
+
+def test_ldif_modify_delete_modrdn(slapd):
+    '''
+    Are delete and modrdn change records performed by ldif_modify()?
+    '''
+    slapd.add_group('deleteme', ldif_path=PREFIX+'add_group.ldif')
+    slapd.add_group('renameme', ldif_path=PREFIX+'add_group.ldif')
+    ldif = ezldap.ldif_read(LDIF_PREFIX+'test_ldif_rfc2849.ldif')
+    results = slapd.ldif_modify(ldif[1:])
+    assert [res['result'] for res in results] == [0, 0]
+    assert not slapd.exists('cn=deleteme,ou=Group,dc=ezldap,dc=io')
+    assert slapd.exists('cn=renamed,ou=People,dc=ezldap,dc=io')
+
+
+def test_ldif_modify_no_changes(slapd):
+    '''
+    A modify record without changes should be rejected, not sent as an add.
+    '''
+    ldif = ezldap.ldif_read(PREFIX+'add_to_group.ldif', {'groupname': 'nochanges',
+        'groupdn': 'ou=Group,dc=ezldap,dc=io', 'username': ''})
+    with pytest.raises(ValueError):
+        slapd.ldif_modify(ldif)
+
+
+def test_sync(slapd, tmpdir):
+    '''
+    Does sync() only make the changes needed, and do nothing the second time?
+    '''
+    base = 'ou=Hosts,dc=ezldap,dc=io'
+    slapd.ldif_add([{'dn': ['cn=sync{},{}'.format(i, base)],
+        'objectClass': ['device'], 'cn': ['sync{}'.format(i)],
+        'description': ['old']} for i in range(3)])
+    desired = [{'dn': ['cn=sync{},{}'.format(i, base)], 'objectClass': ['device'],
+        'cn': ['sync{}'.format(i)], 'l': ['here', 'there']} for i in range(1, 5)]
+    path = str(tmpdir.join('plan.ldif'))
+    plan = slapd.sync(desired, search_base=base, search_filter='(cn=sync*)',
+        attributes=['description'], delete=True, dry_run=path)
+    assert all(res is None for _, res in plan)
+    assert slapd.exists('cn=sync0,' + base)
+
+    results = slapd.ldif_modify(ezldap.ldif_read(path))
+    assert [res['result'] for res in results] == [0] * 5
+    assert not slapd.exists('cn=sync0,' + base)
+    assert slapd.search_list_t('(cn=sync1)', ['description', 'l'])['l'] == ['here|there']
+    assert slapd.sync(desired, search_base=base, search_filter='(cn=sync*)',
+        attributes=['description'], delete=True) == []
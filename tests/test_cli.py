@@ -2,7 +2,9 @@
 Test the ezldap CLI and ensure it works properly.
 '''
 
+import os
 import re
+import sys
 import subprocess
 import ezldap
 import pytest
@@ -47,6 +49,36 @@ def test_parser_syntax():
     assert 'Valid commands:' in stdout
 
 
+def test_help_import_time():
+    '''
+    "ezldap --help" should not import any slow dependencies.
+    '''
+    proc = subprocess.run([sys.executable, '-X', 'importtime', 'bin/ezldap',
+        '--help'], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+        universal_newlines=True, check=True)
+    imports = {}
+    for line in proc.stderr.splitlines():
+        fields = line.split('|')
+        if line.startswith('import time:') and fields[1].strip().isdigit():
+            imports[fields[2].strip()] = int(fields[1])
+
+    for module in ['ldap3', 'yaml', 'pkg_resources', 'ezldap.api']:
+        assert module not in imports
+
+
+def test_lazy_exports():
+    '''
+    Names exported before submodules were imported lazily should still be
+    available from the ezldap package.
+    '''
+    for name in ['api', 'ldif', 'terminal', 'fmt', 'Connection', 'ldif_read',
+            'LDAPSocketOpenError', 'ldap3']:
+        assert getattr(ezldap, name) is not None
+
+    assert ezldap.fmt is ezldap.terminal.fmt
+    assert set(ezldap.__all__) <= set(dir(ezldap))
+
+
 def test_search(slapd):
     '''
     Does the search CLI successfully spit out a nice LDIF?
@@ -79,6 +111,21 @@ def test_search_dn(slapd):
     assert 'cn=Manager,dc=ezldap,dc=io' in stdout
 
 
+def test_search_dn_flags(slapd):
+    assert 'cn=Manager,dc=ezldap,dc=io' in cli('search_dn -i manager')
+    stdout = cli('search_dn -r "^ou=[PG]"')
+    assert 'ou=People,dc=ezldap,dc=io' in stdout
+    assert 'ou=Group,dc=ezldap,dc=io' in stdout
+    assert 'cn=Manager' not in stdout
+
+
+def test_search_dn_bad_regex(slapd):
+    with pytest.raises(subprocess.SubprocessError) as err:
+        cli('search_dn -r "("')
+    assert 'Invalid regular expression' in str(err.value)
+    assert 'Traceback' not in str(err.value)
+
+
 def test_add_group(slapd):
     cli('add_group --ldif {}/add_group.ldif cli_testgroup'.format(PREFIX))
     group1 = slapd.get_group('cli_testgroup')
@@ -129,6 +176,97 @@ def test_add_user_pw_matches(slapd):
     assert ezldap.ssha_check(ssha, pw)
 
 
+def test_bulk_add_users(slapd, tmpdir):
+    csv_path = tmpdir.join('users.csv')
+    csv_path.write('username,groupname,email\n'
+        'cli_bulk1,,bulk1@ezldap.io\n'
+        'cli_bulk2,cli_bulk1,bulk2@ezldap.io\n')
+    stdout = cli('bulk_add_users '
+        '--ldif-user tests/ldif/test_add_user_extra_keys.ldif '
+        '--ldif-group {}/add_group.ldif '
+        '--ldif-add-to-group {}/add_to_group.ldif '
+        '--fname=first --lname=last {}'.format(PREFIX, PREFIX, csv_path))
+    assert '2 users added, 0 failed' in stdout
+    assert slapd.get_user('cli_bulk2')['mail'][0] == 'bulk2@ezldap.io'
+    assert 'cli_bulk2' in slapd.get_group('cli_bulk1')['memberUid']
+
+
+def test_export(slapd, tmpdir):
+    '''
+    Does export write one CSV row per entry?
+    '''
+    path = tmpdir.join('people.csv')
+    stdout = cli('export {} ou=People ou'.format(path))
+    assert 'Exported 1 entries' in stdout
+    assert path.read().splitlines() == ['dn,ou',
+        '"ou=People,dc=ezldap,dc=io",People']
+
+
+def test_mirror(slapd, tmpdir):
+    '''
+    Does mirror load a subtree, and find nothing to update the second time?
+    '''
+    path = tmpdir.join('mirror.sqlite')
+    stdout = cli('mirror ou=People,dc=ezldap,dc=io --path {}'.format(path))
+    assert 'Mirrored' in stdout
+    stdout = cli('mirror --path {}'.format(path))
+    assert 'ou=People,dc=ezldap,dc=io: ' in stdout
+    assert ' 0 deleted.' in stdout
+
+
+def test_batch(slapd, tmpdir):
+    add_testuser('batch_user')
+    path = tmpdir.join('commands.txt')
+    path.write('# lines are run in order over one bind\n'
+        'change_shell batch_user /bin/zsh\n'
+        '\n'
+        'change_home batch_user "/home/batch home"\n'
+        'change_shell nobody_here /bin/sh\n')
+    with pytest.raises(subprocess.SubprocessError) as err:
+        cli('batch {}'.format(path))
+
+    assert '2 commands succeeded, 1 failed' in str(err.value)
+    user = slapd.get_user('batch_user')
+    assert user['loginShell'][0] == '/bin/zsh'
+    assert user['homeDirectory'][0] == '/home/batch home'
+
+    path.write('change_shell batch_user /bin/bash\n'
+        'modify uid=batch_user,ou=People,dc=ezldap,dc=io add mail batch@ezldap.io\n')
+    stdout = cli('batch --jobs 2 {}'.format(path))
+    assert '2 commands succeeded, 0 failed' in stdout
+    assert slapd.get_user('batch_user')['mail'] == ['batch@ezldap.io']
+
+
+def test_daemon(slapd, tmpdir):
+    '''
+    Commands should be forwarded to a running "ezldap daemon".
+    '''
+    env = dict(os.environ, HOME=str(tmpdir),
+        EZLDAP_CONFIG='tests/openldap_config.yml')
+    daemon = subprocess.Popen(['ezldap', 'daemon'], env=env,
+        stdout=subprocess.PIPE, universal_newlines=True)
+    try:
+        assert 'listening' in daemon.stdout.readline()
+        stdout = subprocess.check_output(['ezldap', 'add_group', '--ldif',
+            PREFIX + 'add_group.ldif', 'daemon_group'], env=env,
+            universal_newlines=True)
+        assert 'Success!' in stdout
+        assert 'add_group' in daemon.stdout.readline()
+        assert slapd.get_group('daemon_group') is not None
+
+        # errors are reported with the same exit code
+        proc = subprocess.run(['ezldap', 'change_shell', 'nobody_here',
+            '/bin/sh'], env=env, universal_newlines=True,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        assert proc.returncode == 1
+        assert 'not found' in proc.stderr
+    finally:
+        daemon.terminate()
+        daemon.wait()
+
+    assert not tmpdir.join('.ezldap', 'daemon.sock').exists()
+
+
 def test_add_to_group(slapd):
     username = 'cli_ag_user'
     groupname = 'cli_ag'
@@ -0,0 +1,49 @@
+'''
+Tests for loading config files.
+'''
+
+import os
+import pytest
+import yaml
+import ezldap
+
+
+def test_config_copies(tmpdir):
+    '''
+    Can the config returned be modified without changing later configs?
+    '''
+    path = str(tmpdir.join('config.yml'))
+    with open(path, 'w') as handle:
+        yaml.dump({'host': 'ldap://localhost', 'starttls': True}, handle)
+
+    conf = ezldap.config(path)
+    conf['starttls'] = False
+    assert ezldap.config(path) == {'host': 'ldap://localhost', 'starttls': True}
+
+
+def test_config_reloads(tmpdir):
+    '''
+    Is a config file read again once it has changed?
+    '''
+    path = str(tmpdir.join('config.yml'))
+    with open(path, 'w') as handle:
+        handle.write('host: ldap://first\n')
+
+    assert ezldap.config(path)['host'] == 'ldap://first'
+    with open(path, 'w') as handle:
+        handle.write('host: ldap://second\n')
+
+    os.utime(path, ns=(0, 0))
+    assert ezldap.config(path)['host'] == 'ldap://second'
+
+
+def test_config_safe_load(tmpdir):
+    '''
+    Config files should never be able to construct arbitrary objects.
+    '''
+    path = str(tmpdir.join('config.yml'))
+    with open(path, 'w') as handle:
+        handle.write('host: !!python/object/apply:os.getcwd []\n')
+
+    with pytest.raises(yaml.YAMLError):
+        ezldap.config(path)
@@ -2,9 +2,15 @@
 Ensure that the LDIF templating is working correctly.
 '''
 
+import os
 import pytest
 import ldap3
-from ezldap import ldif_read
+import copy
+import types
+from io import StringIO
+from ezldap import ldif_read, ldif_iter, ldif_write, ldif_print, \
+    LDIFTemplateError
+from ezldap.ldif import _parse_ldif, _substitute
 
 template = 'ezldap/templates/add_group.ldif'
 LDIF_PREFIX = 'tests/ldif/'
@@ -40,7 +46,7 @@ def test_read_ldif_change():
     ldif = ldif_read(LDIF_PREFIX+'test_ldif_change.ldif')
     assert ldif[0]['cn'][0][0] == ldap3.MODIFY_REPLACE
     assert ldif[0]['cn'][0][1][0] == 'New name'
-    assert len(ldif[0]['mail']) == 2
+    assert ldif[0]['mail'] == [(ldap3.MODIFY_ADD, ['test1@ezldap.io', 'test2@ezldap.io'])]
     assert 'shadowLastChange' in ldif[0].keys()
 
 
@@ -48,3 +54,183 @@ def test_dash_in_file():
     ldif = ldif_read(LDIF_PREFIX+'test_ldif_change.ldif')
     for key in ldif[0].keys():
         assert key.strip()[0] not in {'#', '-'}
+
+
+def test_ldif_iter():
+    '''
+    Does ldif_iter() lazily yield the same entries as ldif_read()?
+    '''
+    entries = ldif_iter(LDIF_PREFIX+'test_ldif_add.ldif')
+    assert isinstance(entries, types.GeneratorType)
+    first = next(entries)
+    assert first['dn'][0] == 'uid=someuser,ou=People,dc=ezldap,dc=io'
+    assert [first] + list(entries) == ldif_read(LDIF_PREFIX+'test_ldif_add.ldif')
+
+
+def test_ldif_iter_templating():
+    with pytest.raises(KeyError):
+        list(ldif_iter(template, replacements={'groupname': 'test'}))
+
+
+def test_rfc2849():
+    '''
+    Are folded lines, base64 values, attribute options and delete/modrdn
+    records parsed correctly?
+    '''
+    ldif = ldif_read(LDIF_PREFIX+'test_ldif_rfc2849.ldif')
+    assert len(ldif) == 3
+    assert ldif[0]['dn'][0] == 'uid=rfc2849,ou=People,dc=ezldap,dc=io'
+    assert ldif[0]['cn'][0] == 'Folded Name'
+    assert ldif[0]['cn;lang-fr'][0] == '\u00c9l\u00e8nne'
+    assert ldif[0]['jpegPhoto'][0] == b'\xff\xd8\xff\xe0\x00\x10'
+    assert ldif[1] == {'dn': ['cn=deleteme,ou=Group,dc=ezldap,dc=io'],
+                       'changetype': ['delete']}
+    assert ldif[2]['newrdn'][0] == 'cn=renamed'
+    assert ldif[2]['newsuperior'][0] == 'ou=People,dc=ezldap,dc=io'
+
+
+def test_ldif_url(tmpdir):
+    '''
+    Are values read from file:// URLs?
+    '''
+    photo = tmpdir.join('photo.jpg')
+    photo.write_binary(b'\xff\xd8\xff')
+    ldif = tmpdir.join('url.ldif')
+    ldif.write('dn: cn=url,dc=ezldap,dc=io\njpegPhoto:< file://{}\n'.format(photo))
+    assert ldif_read(str(ldif))[0]['jpegPhoto'][0] == b'\xff\xd8\xff'
+
+
+def test_empty_modify_change():
+    '''
+    A delete with no values should remove every value of the attribute.
+    '''
+    ldif = ldif_read(LDIF_PREFIX+'test_ldif_change.ldif')
+    assert ldif[0]['shadowLastChange'][0] == (ldap3.MODIFY_DELETE, [])
+
+
+def test_write_does_not_modify(tmpdir):
+    '''
+    Writing entries should leave the caller's entries untouched.
+    '''
+    ldif = ldif_read(LDIF_PREFIX+'test_ldif_add.ldif')
+    orig = copy.deepcopy(ldif)
+    path = str(tmpdir.join('out.ldif'))
+    ldif_write(ldif, path)
+    assert ldif == orig
+    assert ldif_read(path) == orig
+
+
+def test_write_rfc2849():
+    '''
+    Binary, non-ASCII and unsafe values should be base64-encoded and long
+    lines folded, and the output should read back to the same entries.
+    '''
+    entries = [{'dn': ['uid=s\u00e9bastien,ou=People,dc=ezldap,dc=io'],
+                'objectClass': ['top', 'inetOrgPerson'],
+                'jpegPhoto': [bytes(range(256))],
+                'description': ['a' * 200],
+                'sn': [' leading space']}]
+    handle = StringIO()
+    ldif_print(iter(entries), handle)
+    output = handle.getvalue()
+    assert 'dn:: ' in output
+    assert 'jpegPhoto:: ' in output
+    assert 'sn:: ' in output
+    assert max(len(l) for l in output.splitlines()) <= 76
+    handle.seek(0)
+    assert list(_parse_ldif(handle)) == entries
+
+
+def test_print_stdout(capsys):
+    ldif_print([{'dn': ['cn=test,dc=ezldap,dc=io'], 'cn': ['test']}])
+    assert capsys.readouterr().out == 'dn: cn=test,dc=ezldap,dc=io\ncn: test\n\n'
+
+
+def test_write_change_records():
+    '''
+    Are modify, add and delete records written as change records that read
+    back to the same changes?
+    '''
+    changes = [{'dn': ['cn=test,dc=ezldap,dc=io'],
+                'cn': [(ldap3.MODIFY_REPLACE, ['New name'])],
+                'mail': [(ldap3.MODIFY_ADD, ['a@ezldap.io', 'b@ezldap.io']),
+                         (ldap3.MODIFY_DELETE, ['c@ezldap.io'])],
+                'shadowLastChange': [(ldap3.MODIFY_DELETE, [])]},
+               {'dn': ['cn=gone,dc=ezldap,dc=io'], 'changetype': ['delete']}]
+    handle = StringIO()
+    ldif_print(changes, handle)
+    output = handle.getvalue()
+    assert 'changetype: modify\nreplace: cn\ncn: New name\n-\n' in output
+    assert 'add: mail\nmail: a@ezldap.io\nmail: b@ezldap.io\n-\n' in output
+    handle.seek(0)
+    assert list(_parse_ldif(handle)) == changes
+
+
+def test_compiled_template(tmpdir):
+    '''
+    Do compiled templates render the same entries as substituting the text,
+    and get recompiled when the file changes?
+    '''
+    replacements = {'groupname': 'test', 'groupdn': 'ou=Group,dc=ezldap,dc=io',
+                    'gid': 10000}
+    with open(template) as handle:
+        expected = list(_parse_ldif(_substitute(handle, replacements)))
+
+    assert ldif_read(template, replacements) == expected
+    # entries from the cache can be changed without affecting later renders
+    ldif_read(template, replacements)[0]['objectClass'].append('changed')
+    assert ldif_read(template, replacements) == expected
+
+    path = tmpdir.join('template.ldif')
+    path.write('# owned by $owner\ndn: cn=$name,dc=ezldap,dc=io\n'
+        'description: {braces} $$1 ${name}s\n')
+    assert ldif_read(str(path), {'name': 'a', 'owner': 'b'}) == \
+        [{'dn': ['cn=a,dc=ezldap,dc=io'], 'description': ['{braces} $1 as']}]
+    with pytest.raises(LDIFTemplateError) as err:
+        ldif_read(str(path), {'name': 'a'})
+    assert 'owner' in str(err.value)
+
+    path.write('dn: cn=$name,dc=ezldap,dc=io\ncn: $name\n')
+    os.utime(str(path), ns=(0, 0))
+    assert ldif_read(str(path), {'name': 'c'})[0]['cn'] == ['c']
+
+
+def test_multi_valued_replace():
+    '''
+    Is every value of a replace one operation, so that all of them are kept,
+    and does writing the change and reading it back keep its meaning?
+    '''
+    handle = StringIO('dn: cn=test,dc=ezldap,dc=io\nchangetype: modify\n'
+        'replace: mail\nmail: a@ezldap.io\nmail: b@ezldap.io\n-\n'
+        'replace: mail\nmail: c@ezldap.io\n-\n')
+    changes = list(_parse_ldif(handle))
+    assert changes[0]['mail'] == [(ldap3.MODIFY_REPLACE, ['a@ezldap.io', 'b@ezldap.io']),
+                                  (ldap3.MODIFY_REPLACE, ['c@ezldap.io'])]
+
+    output = StringIO()
+    ldif_print(changes, output)
+    assert output.getvalue() == handle.getvalue() + '\n'
+    output.seek(0)
+    assert list(_parse_ldif(output)) == changes
+
+
+def test_empty_modify_record():
+    '''
+    Does a modify record left without changes by empty placeholders stay a
+    modify record when written and read back?
+    '''
+    changes = ldif_read('ezldap/templates/add_to_group.ldif', {'groupname': 'test',
+        'groupdn': 'ou=Group,dc=ezldap,dc=io', 'username': ''})
+    assert changes == [{'dn': ['cn=test,ou=Group,dc=ezldap,dc=io'],
+                        'changetype': ['modify']}]
+    handle = StringIO()
+    ldif_print(changes, handle)
+    assert 'changetype: modify\n' in handle.getvalue()
+    handle.seek(0)
+    assert list(_parse_ldif(handle)) == changes
+
+
+def test_add_record():
+    handle = StringIO('dn: cn=test,dc=ezldap,dc=io\nchangetype: add\ncn: test\n')
+    assert list(_parse_ldif(handle)) == [{'dn': ['cn=test,dc=ezldap,dc=io'],
+                                          'changetype': ['add'], 'cn': ['test']}]
@@ -0,0 +1,77 @@
+'''
+Test the local SQLite mirror and its filter evaluation.
+'''
+
+import pytest
+import ezldap
+from ldap3.core.exceptions import LDAPInvalidFilterError
+from ezldap.mirror import parse_filter, _matches
+
+PREFIX = 'ezldap/templates/'
+
+
+def test_parse_filter():
+    assert parse_filter('(&(uid=ab*c*d)(!(cn=x\\2a))(|(uidNumber>=5)(mail=*)))') == \
+        ('&', [('substring', 'uid', ['ab', 'c', 'd']), ('!', ('=', 'cn', 'x*')),
+               ('|', [('>=', 'uidNumber', '5'), ('present', 'mail')])])
+    for invalid in ['uid=a', '(uid=a', '(uid=a))', '(cn:dn:=a)', '(&(uid=a)']:
+        with pytest.raises(LDAPInvalidFilterError):
+            parse_filter(invalid)
+
+
+def test_filter_matches():
+    '''
+    Are filters evaluated like a server would, ignoring case and comparing
+    numbers as numbers?
+    '''
+    entry = {'uid': ['Someone'], 'uidnumber': [10000], 'mail': ['a@b.io', 'c@d.io']}
+    assert _matches(parse_filter('(uid=someone)'), entry)
+    assert _matches(parse_filter('(&(uidNumber>=9999)(uidNumber<=10000))'), entry)
+    assert _matches(parse_filter('(mail=c@*.io)'), entry)
+    assert _matches(parse_filter('(!(cn=*))'), entry)
+    assert _matches(parse_filter('(objectClass=*)'), entry)
+    assert not _matches(parse_filter('(|(uid=some)(gidNumber=*))'), entry)
+
+
+def test_mirror_refresh(slapd, tmpdir):
+    '''
+    Does a refresh only fetch what changed, and find deleted entries?
+    '''
+    slapd.add_group('mirror1', ldif_path=PREFIX+'add_group.ldif')
+    slapd.add_group('mirror2', ldif_path=PREFIX+'add_group.ldif')
+    with ezldap.Mirror(str(tmpdir.join('mirror.sqlite'))) as mirror:
+        first = mirror.refresh(slapd, 'ou=Group,dc=ezldap,dc=io')
+        assert first['updated'] == len(slapd.search_list(
+            search_base='ou=Group,dc=ezldap,dc=io'))
+        assert mirror.search_list_t('(cn=MIRROR1)', ['cn'])['cn'] == ['mirror1']
+
+        slapd.modify_replace('cn=mirror1,ou=Group,dc=ezldap,dc=io',
+            'description', 'changed')
+        slapd.delete('cn=mirror2,ou=Group,dc=ezldap,dc=io')
+        second = mirror.refresh(slapd, 'ou=Group,dc=ezldap,dc=io')
+        assert second['deleted'] == 1
+        assert second['updated'] < first['updated']
+        assert mirror.search_list('(cn=mirror1)')[0]['description'] == ['changed']
+        assert mirror.search_list('(cn=mirror2)') == []
+
+        df = mirror.search_df('(gidNumber=*)', ['cn', 'gidNumber'], typed=True)
+        assert str(df['gidNumber'].dtype) == 'Int64'
+
+
+def test_mirror_attributes(slapd, tmpdir):
+    '''
+    Do mirrors of only some attributes still match objectClass filters, and
+    can refreshes skip looking for deleted entries?
+    '''
+    slapd.add_group('mirror3', ldif_path=PREFIX+'add_group.ldif')
+    with ezldap.Mirror(str(tmpdir.join('mirror.sqlite'))) as mirror:
+        mirror.refresh(slapd, 'ou=Group,dc=ezldap,dc=io', attributes=['cn'])
+        assert 'mirror3' in mirror.search_list_t(attributes=['cn'])['cn']
+        assert mirror.search_list('(&(objectClass=posixGroup)(cn=mirror3))')
+
+        slapd.delete('cn=mirror3,ou=Group,dc=ezldap,dc=io')
+        counts = mirror.refresh(slapd, 'ou=Group,dc=ezldap,dc=io',
+            find_deleted=False)
+        assert counts['deleted'] == 0
+        assert mirror.search_list('(cn=mirror3)')
+        assert mirror.refresh(slapd, 'ou=Group,dc=ezldap,dc=io')['deleted'] == 1
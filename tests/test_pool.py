@@ -0,0 +1,97 @@
+'''
+Test checking connections in and out of a ConnectionPool.
+'''
+
+import copy
+import pytest
+import ezldap
+from ldap3.core.exceptions import LDAPCommunicationError
+
+
+@pytest.fixture
+def pool(slapd, config):
+    with ezldap.auto_pool(copy.deepcopy(config), min_size=1, max_size=2) as pool:
+        yield pool
+
+
+def test_pool_checkout(pool):
+    '''
+    Are pooled connections bound and reused after being returned?
+    '''
+    with pool.connection() as con:
+        assert con.who_am_i() == 'dn:cn=Manager,dc=ezldap,dc=io'
+        first = con
+
+    with pool.connection() as con:
+        assert con is first
+
+    assert len(pool) == 1
+
+
+def test_pool_max_size(pool):
+    '''
+    Does the pool refuse to open more than max_size connections?
+    '''
+    with pool.connection() as con1, pool.connection() as con2:
+        assert con1 is not con2
+        assert len(pool) == 2
+        with pytest.raises(ezldap.PoolExhaustedError):
+            pool.checkout(timeout=0.1)
+
+
+def test_pool_rebind_broken(pool):
+    '''
+    Dropped connections should be replaced transparently on checkout.
+    '''
+    with pool.connection() as con:
+        broken = con
+
+    broken.unbind()
+    with pool.connection() as con:
+        assert con is not broken
+        assert con.who_am_i() == 'dn:cn=Manager,dc=ezldap,dc=io'
+
+
+def test_pool_max_lifetime(pool):
+    '''
+    Connections older than max_lifetime should not be handed out again.
+    '''
+    with pool.connection() as con:
+        old = con
+
+    pool.max_lifetime = 0
+    with pool.connection() as con:
+        assert con is not old
+
+
+def test_pool_keeps_min_size(pool):
+    '''
+    Are dropped connections replaced to keep the pool at min_size?
+    '''
+    pool.max_lifetime = 0
+    with pool.connection() as con:
+        old = con
+
+    assert len(pool) == 1
+    pool.max_lifetime = 3600
+    with pool.connection() as con:
+        assert con is not old
+        assert con.who_am_i() == 'dn:cn=Manager,dc=ezldap,dc=io'
+
+    with pytest.raises(LDAPCommunicationError):
+        with pool.connection() as con:
+            raise LDAPCommunicationError('connection lost')
+
+    assert len(pool) == 1
+    with pool.connection() as replacement:
+        assert replacement is not con
+
+
+def test_pool_sizes():
+    '''
+    Are invalid pool sizes rejected?
+    '''
+    for min_size, max_size in [(-1, 2), (0, 0), (3, 2)]:
+        with pytest.raises(ValueError):
+            ezldap.ConnectionPool('ldap://localhost', conf={},
+                min_size=min_size, max_size=max_size)